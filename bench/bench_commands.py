@@ -0,0 +1,106 @@
+# replays a channel log through CassBotCore.privmsg, comparing the old
+# shlex-based command parsing with CommandParser/split_command. The log
+# is generated: mostly ordinary chatter, some of it mentioning the bot,
+# with a few percent of commands, some quoted.
+#
+# usage: python bench/bench_commands.py [num_lines]
+
+import gc
+import random
+import shlex
+import sys
+import time
+from benchutil import cassbot, make_service, make_bot, rate, report
+
+
+class LegacyParseBot(cassbot.CassBotCore):
+    """
+    CassBotCore with the command parsing it did before CommandParser.
+    """
+
+    def privmsg(self, user, channel, message):
+        cmdstr = None
+        if channel == self.nickname:
+            cmdstr = message
+        if message.startswith('%s:' % (self.nickname,)):
+            cmdstr = message[len(self.nickname)+1:]
+        elif self.cmd_prefix is not None and message.startswith(self.cmd_prefix):
+            cmdstr = message[len(self.cmd_prefix):]
+        if cmdstr is not None:
+            parts = shlex.split(cmdstr.strip())
+            cmd = parts[0]
+            args = parts[1:]
+            self.dispatch_command(user, channel, cmd, args)
+
+
+class Commands(cassbot.BaseBotPlugin):
+    calls = 0
+
+    def command_jira(self, bot, user, channel, args):
+        self.calls += 1
+
+    def command_build(self, bot, user, channel, args):
+        self.calls += 1
+
+    def command_blacklist(self, bot, user, channel, args):
+        self.calls += 1
+
+
+CHATTER = [
+    'has anyone seen the compaction stalls on 1.2 lately?',
+    'yeah, CASSANDRA-4321 looks related',
+    'you need to bump the heap, and maybe lower the memtable threshold',
+    "it's in the docs, under 'tuning'",
+    'cassbot is pretty quiet today',
+    'ok thanks, will try that',
+    'http://example.com/some/long/path?with=query&and=stuff',
+    'lol',
+    'did the nightly build pass? the dashboard is red',
+    'cassbot: you there?',
+]
+COMMANDS = [
+    '!jira 4321',
+    '!build trunk',
+    'cassbot: blacklist me',
+    '!jira "CASSANDRA-1234" "CASSANDRA-5678"',
+    "!build 'cassandra-1.2' --verbose",
+]
+
+
+def make_log(n, rng):
+    lines = []
+    for _ in xrange(n):
+        if rng.random() < 0.05:
+            lines.append(rng.choice(COMMANDS))
+        else:
+            lines.append(rng.choice(CHATTER))
+    return lines
+
+
+def main(nlines=100000):
+    lines = make_log(nlines, random.Random(3))
+    serv = make_service([Commands()])
+    for label, botclass in (('before (shlex)', LegacyParseBot),
+                            ('after (CommandParser)', cassbot.CassBotCore)):
+        bot = make_bot(serv, botclass)
+        bot.cmd_prefix = '!'
+        privmsg = bot.privmsg
+        gc.collect()
+        start = time.time()
+        for line in lines:
+            privmsg('nick!user@host', '#cassandra', line)
+        elapsed = time.time() - start
+        report('channel log replay, %s' % label, nlines / elapsed, 'lines/s')
+
+    def split_all(splitter):
+        for cmd in COMMANDS:
+            splitter(cmd[1:])
+    for label, splitter in (('shlex.split', shlex.split),
+                            ('split_command', cassbot.split_command)):
+        report('tokenize commands, %s' % label,
+               rate(split_all, nlines // 10, splitter) * len(COMMANDS), 'commands/s')
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
+
+# vim: set et sw=4 ts=4 :
@@ -0,0 +1,296 @@
+# end-to-end load test: a real CassBotService, with a set of plugins,
+# connected over tcp to the in-process fake IRC server, which plays
+# synthetic (or recorded) channel traffic at it at a fixed rate. Every
+# probe_interval a probe command is mixed in, and the time until the bot's
+# reply comes back is its reply latency. Reports the rate the bot kept
+# up with, reply latencies, and memory use (of the whole process, fake
+# server included).
+#
+# usage: python bench/bench_e2e.py [options]; --help for the list.
+#
+# A recorded traffic file has one raw server line per line, as the server
+# would send it (":nick!user@host PRIVMSG #chan :hello"); blank lines and
+# lines starting with '#' are skipped. The bot joins every channel named in
+# it, and it is replayed from the start again as often as needed.
+
+import gc
+import os
+import re
+import sys
+import time
+import random
+import shutil
+import resource
+import tempfile
+import optparse
+from benchutil import cassbot, report
+from fakeircd import FakeIRCServer
+from twisted.internet import defer, reactor, task
+
+words = ('the a is it to of and cassandra compaction node ring gossip repair '
+         'hint token read write latency timeout flush sstable memtable bloom '
+         'filter row column key range slice query works for me thanks').split()
+
+
+class BenchProbe(cassbot.BaseBotPlugin):
+    def command_probe(self, bot, user, channel, args):
+        return bot.address_msg(user, channel, 'probe-reply %s' % ' '.join(args))
+
+
+class SyntheticTraffic:
+    """
+    Makes up channel traffic, keeping track of who is in which channel so
+    that parts, nick changes and quits are for users who are actually
+    there. weights gives the relative frequency of each kind of event.
+    """
+
+    weights = (('privmsg', 80), ('join', 6), ('part', 5), ('action', 3),
+               ('nick', 3), ('quit', 2), ('names', 1))
+
+    def __init__(self, server, channels, users_per_channel, seed=0):
+        self.server = server
+        self.channels = channels
+        self.random = random.Random(seed)
+        self.serial = 0
+        self.table = []
+        for kind, weight in self.weights:
+            self.table.extend([getattr(self, 'make_' + kind)] * weight)
+        for chan in channels:
+            for _ in range(users_per_channel):
+                server.members(chan).add(self.new_nick())
+
+    def new_nick(self):
+        self.serial += 1
+        return 'user%d' % self.serial
+
+    def someone_in(self, chan):
+        members = self.server.members(chan)
+        if not members:
+            nick = self.new_nick()
+            self.server.join('%s!u@h' % nick, chan)
+            return nick
+        return self.random.sample(members, 1)[0]
+
+    def text(self):
+        n = self.random.randint(3, 15)
+        msg = ' '.join(self.random.choice(words) for _ in range(n))
+        if self.random.random() < 0.02:
+            msg += ' see CASSANDRA-%d' % self.random.randint(1, 9999)
+        return msg
+
+    def next_event(self):
+        chan = self.random.choice(self.channels)
+        self.random.choice(self.table)(chan)
+
+    def make_privmsg(self, chan):
+        self.server.privmsg('%s!u@h' % self.someone_in(chan), chan, self.text())
+
+    def make_action(self, chan):
+        self.server.action('%s!u@h' % self.someone_in(chan), chan, self.text())
+
+    def make_join(self, chan):
+        self.server.join('%s!u@h' % self.new_nick(), chan)
+
+    def make_part(self, chan):
+        self.server.part('%s!u@h' % self.someone_in(chan), chan)
+
+    def make_nick(self, chan):
+        self.server.nick('%s!u@h' % self.someone_in(chan), self.new_nick())
+
+    def make_quit(self, chan):
+        self.server.quit('%s!u@h' % self.someone_in(chan))
+
+    def make_names(self, chan):
+        self.server.names_burst(chan)
+
+
+class RecordedTraffic:
+    def __init__(self, server, lines):
+        self.server = server
+        self.lines = lines
+        self.pos = 0
+
+    def next_event(self):
+        self.server.raw(self.lines[self.pos])
+        self.pos = (self.pos + 1) % len(self.lines)
+
+    @staticmethod
+    def read(path):
+        lines = []
+        for line in open(path):
+            line = line.rstrip('\r\n')
+            if line and not line.startswith('#'):
+                lines.append(line)
+        channels = sorted(set(re.findall(r' (#[^ ,:]+)', '\n'.join(lines))))
+        return lines, channels
+
+
+class LoadRun:
+    tick = 0.01
+    probe_channel_index = 0
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.latencies = []
+        self.probes_sent = {}
+        self.events = 0
+        self.probe_seq = 0
+
+    def on_message(self, client, target, text):
+        m = re.search(r'probe-reply (\d+)', text)
+        if m is not None:
+            sent = self.probes_sent.pop(int(m.group(1)), None)
+            if sent is not None:
+                self.latencies.append(time.time() - sent)
+
+    def send_probe(self):
+        self.probe_seq += 1
+        self.probes_sent[self.probe_seq] = time.time()
+        self.server.privmsg('prober!p@h', self.probe_channel,
+                            '%s: probe %d' % (self.opts.nickname, self.probe_seq))
+        return self.probe_seq
+
+    @defer.inlineCallbacks
+    def run(self):
+        opts = self.opts
+        self.server = FakeIRCServer()
+        self.server.on_message = self.on_message
+        port = reactor.listenTCP(0, self.server, interface='127.0.0.1')
+
+        if opts.replay:
+            lines, channels = RecordedTraffic.read(opts.replay)
+            traffic = RecordedTraffic(self.server, lines)
+        else:
+            channels = ['#chan%d' % n for n in range(opts.channels)]
+            traffic = SyntheticTraffic(self.server, channels, opts.users)
+        self.probe_channel = channels[self.probe_channel_index]
+
+        fd, statefile = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        os.unlink(statefile)
+        log_dir = tempfile.mkdtemp(prefix='bench-irclogs-')
+        try:
+            serv = cassbot.CassBotService('tcp:host=127.0.0.1:port=%d' % port.getHost().port,
+                                          nickname=opts.nickname, init_channels=channels,
+                                          statefile=statefile)
+            # the bot's own flood control would measure nothing but itself
+            serv.state['send_rate'] = 1e6
+            serv.state['send_burst'] = 1e6
+            # nor should its per-user command throttle get in the way of the probes
+            serv.command_scheduler.user_rate = serv.command_scheduler.user_burst = 1e6
+            serv.state['log_dir'] = log_dir
+            classes = list(serv.get_plugin_classes()) + [BenchProbe]
+            serv.get_plugin_classes = lambda: classes
+            with serv.plugin_batch():
+                for name in ['BenchProbe'] + opts.plugins:
+                    serv.enable_plugin_by_name(name)
+            missing = [n for n in opts.plugins
+                       if isinstance(serv.pluginmap.get(n), cassbot.enabled_but_not_found)]
+            if missing:
+                raise SystemExit('plugins not found: %s' % ', '.join(missing))
+
+            gc.collect()
+            rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            started = time.time()
+            serv.startService()
+            yield self.server.wait_for(
+                    lambda: self.server.clients
+                            and len(self.server.clients[0].channels) == len(channels))
+            # the names bursts for those joins have been sent; wait until the
+            # bot has gotten through them
+            seq = self.send_probe()
+            yield self.server.wait_for(lambda: seq not in self.probes_sent)
+            report('connect and join %d channels' % len(channels),
+                   (time.time() - started) * 1000, 'ms')
+            del self.latencies[:]
+
+            per_tick = opts.rate * self.tick
+            owed = [0.0]
+            last_probe = [time.time()]
+            def generate():
+                owed[0] += per_tick
+                while owed[0] >= 1:
+                    traffic.next_event()
+                    self.events += 1
+                    owed[0] -= 1
+                now = time.time()
+                if now - last_probe[0] >= opts.probe_interval:
+                    last_probe[0] = now
+                    self.send_probe()
+            loop = task.LoopingCall(generate)
+            started = time.time()
+            loop.start(self.tick, now=False)
+            yield task.deferLater(reactor, opts.seconds, loop.stop)
+            offered = time.time() - started
+            # everything sent before this probe has been handled once it is answered
+            seq = self.send_probe()
+            yield self.server.wait_for(lambda: seq not in self.probes_sent)
+            elapsed = time.time() - started
+
+            gc.collect()
+            rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            bot = serv.getbot()
+            report('events offered', self.events / offered, 'events/s')
+            report('events handled', self.events / elapsed, 'events/s')
+            report('catch-up after load stopped', (elapsed - offered) * 1000, 'ms')
+            lat = sorted(self.latencies)
+            if lat:
+                for pct in (50, 95, 99):
+                    report('reply latency p%d' % pct,
+                           lat[min(len(lat) - 1, len(lat) * pct // 100)] * 1000, 'ms')
+                report('reply latency max', lat[-1] * 1000, 'ms')
+            report('probes unanswered', len(self.probes_sent), 'probes')
+            report('max rss growth', (rss_before and (rss_after - rss_before)) / 1024.0, 'MB')
+            report('max rss', rss_after / 1024.0, 'MB')
+            report('tracked channel users', len(bot.memberships), 'users')
+            report('live objects', len(gc.get_objects()), 'objects')
+
+            yield serv.stopService()
+            # let the bot's side of the connection close before the port goes,
+            # so it isn't reported as lost
+            yield self.server.wait_for(lambda: not self.server.clients)
+        finally:
+            yield port.stopListening()
+            for name in os.listdir(os.path.dirname(statefile)):
+                if name.startswith(os.path.basename(statefile)):
+                    os.unlink(os.path.join(os.path.dirname(statefile), name))
+            shutil.rmtree(log_dir, ignore_errors=True)
+
+
+def parse_args(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--plugins', default='BotLogger,RegexResponder,Admin',
+                      help='comma-separated plugins to load [%default]')
+    parser.add_option('--rate', type='float', default=2000,
+                      help='events per second to send [%default]')
+    parser.add_option('--seconds', type='float', default=10,
+                      help='how long to keep sending [%default]')
+    parser.add_option('--channels', type='int', default=20,
+                      help='channels, for synthetic traffic [%default]')
+    parser.add_option('--users', type='int', default=200,
+                      help='users per channel, for synthetic traffic [%default]')
+    parser.add_option('--probe-interval', type='float', default=0.1,
+                      help='seconds between reply latency probes [%default]')
+    parser.add_option('--replay', metavar='FILE',
+                      help='replay recorded server lines from FILE instead')
+    parser.add_option('--nickname', default='benchbot')
+    opts, args = parser.parse_args(argv)
+    opts.plugins = [p for p in opts.plugins.split(',') if p]
+    return opts
+
+
+def main(argv):
+    opts = parse_args(argv)
+    d = LoadRun(opts).run()
+    failed = []
+    d.addErrback(failed.append)
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    if failed:
+        failed[0].printTraceback()
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+
+# vim: set et sw=4 ts=4 :
@@ -0,0 +1,130 @@
+# channel membership tracking with 10k users: the old nested dicts of sets
+# of nicks on CassBotCore against the MembershipIndex. Measures the memory
+# held by each and the time taken by renames, parts and quits.
+
+import random
+import time
+import gc
+
+from benchutil import report
+from cassbot import MembershipIndex
+
+NUM_USERS = 10000
+NUM_CHANNELS = 50
+CHANNELS_PER_USER = 3
+NUM_OPS = 2000
+
+
+class LegacyTracker:
+    """
+    The dict-of-sets bookkeeping CassBotCore used to do, method for method.
+    """
+
+    def __init__(self):
+        self.channel_memberships = {}
+        self.chan_modemap = {}
+
+    def join(self, channel, nick):
+        self.channel_memberships.setdefault(channel, set()).add(nick)
+
+    def set_mode(self, channel, arg, mode, beingset):
+        modeset = self.chan_modemap.setdefault(channel, {}).setdefault(arg, set())
+        if beingset:
+            modeset.add(mode)
+        else:
+            modeset.discard(mode)
+
+    def part(self, channel, nick):
+        self.channel_memberships.setdefault(channel, set()).discard(nick)
+        self.chan_modemap.get(channel, {}).pop(nick, None)
+
+    def quit(self, nick, message):
+        # as userQuit did: treats the quit message as a channel name
+        self.part(message, nick)
+
+    def rename(self, oldname, newname):
+        for cm in self.channel_memberships.itervalues():
+            if oldname in cm:
+                cm.add(newname)
+                cm.remove(oldname)
+        for modemap in self.chan_modemap.itervalues():
+            modemap[newname] = modemap.pop(oldname, set())
+
+
+def deep_size(obj, seen=None):
+    """
+    Rough count of the bytes held by obj and everything it refers to
+    through containers and __slots__/__dict__ attributes.
+    """
+
+    import sys
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.iteritems():
+            size += deep_size(k, seen) + deep_size(v, seen)
+    elif isinstance(obj, (set, frozenset, list, tuple)):
+        for item in obj:
+            size += deep_size(item, seen)
+    else:
+        for name in getattr(type(obj), '__slots__', ()):
+            size += deep_size(getattr(obj, name, None), seen)
+        if hasattr(obj, '__dict__'):
+            size += deep_size(obj.__dict__, seen)
+    return size
+
+
+def populate(tracker, rng):
+    channels = ['#chan%d' % i for i in range(NUM_CHANNELS)]
+    nicks = ['user%d' % i for i in range(NUM_USERS)]
+    for nick in nicks:
+        for chan in rng.sample(channels, CHANNELS_PER_USER):
+            tracker.join(chan, nick)
+            if rng.random() < 0.05:
+                tracker.set_mode(chan, nick, 'o', True)
+    return channels, nicks
+
+
+def time_ops(name, tracker, ops):
+    gc.collect()
+    start = time.time()
+    for op in ops:
+        op(tracker)
+    elapsed = time.time() - start
+    report('%s, %d users' % (name, NUM_USERS), elapsed / len(ops) * 1e6, 'us/op')
+
+
+def main():
+    for label, make in (('before (dicts of sets)', LegacyTracker),
+                        ('after (MembershipIndex)', MembershipIndex)):
+        rng = random.Random(7)
+        tracker = make()
+        channels, nicks = populate(tracker, rng)
+        report('memory %s' % label, deep_size(tracker) / 1024.0, 'KiB')
+
+        renames = []
+        for i in range(NUM_OPS):
+            old = nicks[i]
+            renames.append(lambda t, old=old: t.rename(old, old + '_'))
+        time_ops('rename %s' % label, tracker, renames)
+        report('memory after renames %s' % label, deep_size(tracker) / 1024.0, 'KiB')
+
+        parts = [lambda t, n=nicks[i] + '_', c=rng.choice(channels): t.part(c, n)
+                 for i in range(NUM_OPS)]
+        time_ops('part %s' % label, tracker, parts)
+
+        if isinstance(tracker, LegacyTracker):
+            quits = [lambda t, n=nicks[i]: t.quit(n, 'Quit: bye') for i in range(NUM_OPS, 2 * NUM_OPS)]
+        else:
+            quits = [lambda t, n=nicks[i]: t.quit(n) for i in range(NUM_OPS, 2 * NUM_OPS)]
+        time_ops('quit %s' % label, tracker, quits)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: set et sw=4 ts=4 :
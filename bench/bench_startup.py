@@ -0,0 +1,64 @@
+# time to enable the full autoload_modules list and then save state, with
+# a getPlugins rescan on every plugin change (the old behavior) versus the
+# cached PluginRegistry plus batched rescans.
+#
+# usage: python bench/bench_startup.py [repeat]
+
+import os
+import sys
+import time
+import tempfile
+from benchutil import cassbot, report
+from twisted.plugin import getPlugins
+
+autoload_modules = ('Admin', 'BotLogger', 'BuildCommand', 'JiraIntegration',
+                    'LogsCommand', 'OpenManhole', 'RegexResponder')
+
+
+class UncachedService(cassbot.CassBotService):
+    def get_plugin_classes(self):
+        for p in getPlugins(cassbot.IBotPlugin, cassbot.cassbot_plugins):
+            if p is not cassbot.BaseBotPlugin:
+                yield p
+
+    def plugin_batch(self):
+        return NoBatch()
+
+
+class NoBatch:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+def startup_and_save(serv_class, statefile):
+    serv = serv_class('tcp:host=localhost:port=6667')
+    start = time.time()
+    with serv.plugin_batch():
+        for modname in autoload_modules:
+            serv.enable_plugin_by_name(modname)
+    loaded = time.time()
+    serv.saveStateToFile(statefile)
+    return loaded - start, time.time() - loaded
+
+
+def main(repeat=5):
+    fd, statefile = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        for label, serv_class in (('before (rescan every change)', UncachedService),
+                                  ('after (registry, batched)', cassbot.CassBotService)):
+            times = [startup_and_save(serv_class, statefile) for _ in range(repeat)]
+            report('enable %d modules, %s' % (len(autoload_modules), label),
+                   1000 * min(t[0] for t in times), 'ms')
+            report('saveStateToFile, %s' % label,
+                   1000 * min(t[1] for t in times), 'ms')
+    finally:
+        os.unlink(statefile)
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
+
+# vim: set et sw=4 ts=4 :
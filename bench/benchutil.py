@@ -0,0 +1,66 @@
+# shared helpers for the cassbot benchmarks. these all run without a
+# network; the bot's transport is replaced by a line sink.
+
+import os
+import sys
+import time
+import gc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import cassbot
+
+
+class LineSink:
+    def __init__(self):
+        self.lines = []
+
+    def write(self, data):
+        self.lines.append(data)
+
+    def writeSequence(self, seq):
+        self.lines.extend(seq)
+
+    def loseConnection(self):
+        pass
+
+
+def make_service(plugins=()):
+    """
+    Make a CassBotService that never connects anywhere, with the given
+    plugin instances already enabled.
+    """
+
+    serv = cassbot.CassBotService('tcp:host=localhost:port=6667')
+    for p in plugins:
+        serv.pluginmap[p.name()] = p
+    serv.get_plugin_classes = lambda: [p.__class__ for p in plugins]
+    serv.scan_plugins()
+    return serv
+
+
+def make_bot(serv, botclass=cassbot.CassBotCore, nickname='cassbot'):
+    bot = botclass(nickname=nickname)
+    serv.initialize_proto_state(bot)
+    bot.makeConnection(LineSink())
+    del bot.transport.lines[:]
+    return bot
+
+
+def rate(func, n, *a):
+    """
+    Call func(*a) n times and return calls per second.
+    """
+
+    gc.collect()
+    start = time.time()
+    for _ in xrange(n):
+        func(*a)
+    elapsed = time.time() - start
+    return n / elapsed if elapsed else float('inf')
+
+
+def report(name, value, unit='events/s'):
+    print '%-50s %14.1f %s' % (name, value, unit)
+
+# vim: set et sw=4 ts=4 :
@@ -0,0 +1,230 @@
+# a small in-process IRC server for driving a real CassBotService over
+# tcp in benchmarks, without a network. It does just enough for the bot:
+# registration, PING, JOIN (including comma-separated lists), PART, MODE
+# queries and NAMES replies, and it records everything the bot sends.
+# Traffic from other users is made up by calling its methods.
+
+import time
+from twisted.internet import defer, protocol
+from twisted.protocols import basic
+from twisted.words.protocols import irc
+
+
+class FakeIRCConnection(basic.LineOnlyReceiver):
+    delimiter = '\n'
+    MAX_LENGTH = 4096
+
+    def connectionMade(self):
+        self.nickname = None
+        self.registered = False
+        self.channels = set()
+        self.allowance = self.factory.flood_burst
+        self.last_line = time.time()
+        self.factory.clients.append(self)
+
+    def connectionLost(self, reason):
+        if self in self.factory.clients:
+            self.factory.clients.remove(self)
+        self.factory.fire_waiters()
+
+    def send(self, line):
+        self.transport.write(line + '\r\n')
+
+    def numeric(self, code, *params):
+        self.send(':%s %s %s %s' % (self.factory.servername, code, self.nickname or '*',
+                                    ' '.join(params)))
+
+    def over_flood_limit(self):
+        limit = self.factory.flood_rate
+        if limit is None:
+            return False
+        now = time.time()
+        self.allowance = min(self.factory.flood_burst,
+                             self.allowance + (now - self.last_line) * limit)
+        self.last_line = now
+        if self.allowance < 1:
+            return True
+        self.allowance -= 1
+        return False
+
+    def lineReceived(self, line):
+        line = line.rstrip('\r')
+        if not line:
+            return
+        self.factory.received.append((time.time(), line))
+        if self.over_flood_limit():
+            self.factory.flood_kills += 1
+            self.send('ERROR :Closing Link: %s (Excess Flood)' % self.nickname)
+            self.transport.loseConnection()
+            return
+        prefix, command, params = irc.parsemsg(line)
+        method = getattr(self, 'irc_%s' % command.upper(), None)
+        if method is not None:
+            method(params)
+
+    def irc_NICK(self, params):
+        old, self.nickname = self.nickname, params[0]
+        if self.registered:
+            self.send(':%s!bot@fake NICK :%s' % (old, self.nickname))
+
+    def irc_USER(self, params):
+        self.registered = True
+        name = self.factory.servername
+        self.numeric('001', ':Welcome to the fake network %s' % self.nickname)
+        self.numeric('002', ':Your host is %s' % name)
+        self.numeric('003', ':This server was created just now')
+        self.numeric('004', name, 'fakeircd-1', 'iow', 'bklmnopstv')
+        self.numeric('005', 'CHANTYPES=# PREFIX=(ov)@+ CHANMODES=b,k,l,mnpst NICKLEN=30',
+                     ':are supported by this server')
+        self.numeric('375', ':- %s Message of the Day -' % name)
+        self.numeric('372', ':- nothing to see here')
+        self.numeric('376', ':End of /MOTD command.')
+
+    def irc_PING(self, params):
+        self.send(':%s PONG %s :%s' % (self.factory.servername, self.factory.servername,
+                                       params[0] if params else ''))
+
+    def irc_JOIN(self, params):
+        for channel in params[0].split(','):
+            self.channels.add(channel)
+            self.factory.joins += 1
+            self.send(':%s!bot@fake JOIN :%s' % (self.nickname, channel))
+            self.send_names(channel)
+        self.factory.fire_waiters()
+
+    def irc_PART(self, params):
+        for channel in params[0].split(','):
+            self.channels.discard(channel)
+            self.send(':%s!bot@fake PART %s' % (self.nickname, channel))
+
+    def irc_MODE(self, params):
+        if params and params[0][:1] == '#' and len(params) == 1:
+            self.factory.mode_queries += 1
+            self.numeric('324', params[0], '+nt')
+
+    def irc_PRIVMSG(self, params):
+        self.factory.message_from_bot(self, params[0], params[-1])
+
+    irc_NOTICE = irc_PRIVMSG
+
+    def irc_QUIT(self, params):
+        self.transport.loseConnection()
+
+    def send_names(self, channel):
+        """
+        Send a NAMES burst for a channel: as many 353 lines as it takes to
+        list everyone in it, then 366.
+        """
+
+        names = ['@' + self.nickname] + sorted(self.factory.members(channel))
+        line = []
+        size = 0
+        for name in names:
+            if size + len(name) > 400:
+                self.numeric('353', '=', channel, ':' + ' '.join(line))
+                line, size = [], 0
+            line.append(name)
+            size += len(name) + 1
+        if line:
+            self.numeric('353', '=', channel, ':' + ' '.join(line))
+        self.numeric('366', channel, ':End of /NAMES list.')
+
+
+class FakeIRCServer(protocol.ServerFactory):
+    """
+    Listen with reactor.listenTCP(0, server) and point a bot at
+    tcp:host=127.0.0.1:port=<port>. Everything a bot sends is kept in
+    received as (time, line); messages it sends also go to on_message.
+    flood_rate, if set, is how many lines per second (after a burst of
+    flood_burst) a client may send before being disconnected for flooding.
+    """
+
+    protocol = FakeIRCConnection
+    servername = 'fake.irc'
+
+    def __init__(self, flood_rate=None, flood_burst=10):
+        self.clients = []
+        self.received = []
+        self.rosters = {}
+        self.flood_rate = flood_rate
+        self.flood_burst = flood_burst
+        self.flood_kills = 0
+        self.joins = 0
+        self.mode_queries = 0
+        self.on_message = None
+        self.waiters = []
+
+    def members(self, channel):
+        return self.rosters.setdefault(channel, set())
+
+    def message_from_bot(self, client, target, text):
+        if self.on_message is not None:
+            self.on_message(client, target, text)
+        self.fire_waiters()
+
+    def wait_for(self, condition):
+        """
+        Return a Deferred which fires once condition() is true, checked
+        whenever the bot joins something, sends a message or disconnects.
+        """
+
+        d = defer.Deferred()
+        self.waiters.append((condition, d))
+        self.fire_waiters()
+        return d
+
+    def fire_waiters(self):
+        for item in list(self.waiters):
+            condition, d = item
+            if condition():
+                self.waiters.remove(item)
+                d.callback(None)
+
+    def to_channel(self, channel, line):
+        for c in self.clients:
+            if channel in c.channels:
+                c.send(line)
+
+    def to_all(self, line):
+        for c in self.clients:
+            c.send(line)
+
+    # traffic from other (imaginary) users
+
+    def privmsg(self, user, channel, text):
+        self.to_channel(channel, ':%s PRIVMSG %s :%s' % (user, channel, text))
+
+    def action(self, user, channel, text):
+        self.privmsg(user, channel, '\x01ACTION %s\x01' % text)
+
+    def join(self, user, channel):
+        self.members(channel).add(user.split('!', 1)[0])
+        self.to_channel(channel, ':%s JOIN :%s' % (user, channel))
+
+    def part(self, user, channel):
+        self.members(channel).discard(user.split('!', 1)[0])
+        self.to_channel(channel, ':%s PART %s' % (user, channel))
+
+    def nick(self, user, newnick):
+        oldnick = user.split('!', 1)[0]
+        for roster in self.rosters.itervalues():
+            if oldnick in roster:
+                roster.discard(oldnick)
+                roster.add(newnick)
+        self.to_all(':%s NICK :%s' % (user, newnick))
+
+    def quit(self, user, message='bye'):
+        nick = user.split('!', 1)[0]
+        for roster in self.rosters.itervalues():
+            roster.discard(nick)
+        self.to_all(':%s QUIT :%s' % (user, message))
+
+    def names_burst(self, channel):
+        for c in self.clients:
+            if channel in c.channels:
+                c.send_names(channel)
+
+    def raw(self, line):
+        self.to_all(line)
+
+# vim: set et sw=4 ts=4 :
@@ -0,0 +1,384 @@
+# microbenchmarks for the bot's hot paths, none of which need a network.
+# Each one is timed over several runs, in operations per second, and the
+# results can be written out as json and compared against an earlier
+# run's, flagging anything that got slower.
+#
+# usage: python bench/microbench.py [-o results.json] [-c baseline.json]
+#                                   [-t 0.1] [-k substring] [--quick]
+#
+# With -c, exits with status 1 if any benchmark is slower than the
+# baseline: its median run slower by more than the threshold (-t, a
+# fraction), and even its best run slower than the baseline's worst, so
+# that ordinary run-to-run noise isn't flagged.
+
+import gc
+import os
+import sys
+import json
+import time
+import random
+import platform
+import tempfile
+import optparse
+from benchutil import cassbot, make_service, make_bot, report
+from bench_dispatch import make_watcher_plugins
+
+BENCHMARKS = []
+
+def benchmark(name):
+    """
+    Register a benchmark. The decorated function sets things up and
+    returns a function of no arguments doing one operation, which is what
+    gets timed.
+    """
+
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+
+# masks and users
+
+MASKS = ['*!*@*.example.com', 'joe!*@*', '*!~admin@10.0.*', 'b?b!bob@host.example.org']
+USERS = ['joe!joe@host.example.com', 'alice!~admin@10.0.0.5', 'bob!bob@host.example.org',
+         'nobody!x@elsewhere.net']
+
+@benchmark('splituser')
+def bench_splituser():
+    splituser = cassbot.splituser
+    def run():
+        for u in USERS:
+            splituser(u)
+    return run
+
+@benchmark('mask_matches, 4 masks x 4 users')
+def bench_mask_matches():
+    mask_matches = cassbot.mask_matches
+    def run():
+        for m in MASKS:
+            for u in USERS:
+                mask_matches(m, u)
+    return run
+
+
+# privileges
+
+def deep_authmap(depth=20, masks_per_level=10):
+    """
+    An AuthMap where priv0 is granted to priv1, which is granted to priv2,
+    and so on down depth levels, with a few masks at every level.
+    """
+
+    auth = cassbot.AuthMap()
+    for level in range(depth):
+        for m in range(masks_per_level):
+            auth.addPriv('user%d_%d!*@*.example.com' % (level, m), 'priv%d' % level)
+        if level:
+            auth.addPriv('priv%d' % level, 'priv%d' % (level - 1))
+    return auth
+
+@benchmark('AuthMap.userHas, 20 levels deep, cached')
+def bench_userhas_cached():
+    auth = deep_authmap()
+    user = 'user19_5!u@host.example.com'
+    auth.userHas(user, 'priv0')
+    def run():
+        auth.userHas(user, 'priv0')
+    return run
+
+@benchmark('AuthMap.userHas, 20 levels deep, cache misses')
+def bench_userhas_misses():
+    auth = deep_authmap()
+    # more distinct users than the answer cache holds
+    users = ['visitor%d!u@host%d.example.net' % (n, n) for n in range(auth.cache_size * 4)]
+    users.append('user19_5!u@host.example.com')
+    it = [iter(users)]
+    def run():
+        try:
+            user = it[0].next()
+        except StopIteration:
+            it[0] = iter(users)
+            user = it[0].next()
+        auth.userHas(user, 'priv0')
+    return run
+
+@benchmark('AuthMap recompile after a change, 20 levels deep')
+def bench_authmap_compile():
+    auth = deep_authmap()
+    def run():
+        auth.invalidate()
+        auth.userHas('user19_5!u@host.example.com', 'priv0')
+    return run
+
+
+# event dispatch
+
+class NoopCommands(cassbot.BaseBotPlugin):
+    def command_jira(self, bot, user, channel, args):
+        pass
+
+@benchmark('CassBotCore.privmsg, chatter')
+def bench_privmsg_chatter():
+    bot = make_bot(make_service([NoopCommands()]))
+    bot.cmd_prefix = '!'
+    def run():
+        bot.privmsg('nick!user@host', '#cassandra', 'has anyone seen the compaction stalls?')
+    return run
+
+@benchmark('CassBotCore.privmsg, commands')
+def bench_privmsg_command():
+    serv = make_service([NoopCommands()])
+    serv.command_scheduler.user_rate = serv.command_scheduler.user_burst = 1e9
+    bot = make_bot(serv)
+    bot.cmd_prefix = '!'
+    def run():
+        bot.privmsg('nick!user@host', '#cassandra', '!jira "CASSANDRA-1234" 5678')
+    return run
+
+for _n in (1, 10, 50):
+    def _setup(n=_n):
+        bot = make_bot(make_service(make_watcher_plugins(n)))
+        bot.joined('#chan')
+        def run():
+            bot.privmsg('nick!user@host', '#chan', 'hello there')
+        return run
+    benchmark('watch wrapper fan-out, %d plugins' % _n)(_setup)
+
+
+# plugins
+
+def regex_rules(n):
+    from cassbot_plugins.regex_responder import ResponseRule
+    rules = []
+    for i in range(n):
+        kind = i % 3
+        if kind == 0:
+            rules.append(ResponseRule(r'\bticket%d\b' % i, 'see ticket %d' % i))
+        elif kind == 1:
+            rules.append(ResponseRule(r'(?P<word>word%d)s?' % i, '$word!'))
+        else:
+            rules.append(ResponseRule(r'(?i)^hello %d' % i, 'hi'))
+    return rules
+
+for _n in (10, 100, 1000):
+    def _setup(n=_n):
+        from cassbot_plugins.regex_responder import RegexResponder, RuleEngine
+        p = RegexResponder()
+        p.rules = RuleEngine(regex_rules(n))
+        msgs = ['nothing to see here, move along', 'about ticket7 and word8s',
+                'hello 2 everyone', 'the quick brown fox jumps over the lazy dog']
+        def run():
+            for m in msgs:
+                p.apply_all_rules(m)
+        return run
+    benchmark('RegexResponder.apply_all_rules, %d rules, 4 msgs' % _n)(_setup)
+
+@benchmark('JiraInstance.find_ticket_references, 4 msgs')
+def bench_find_ticket_references():
+    from cassbot_plugins.jira import JiraInstance
+    class OfflineJira(JiraInstance):
+        def jira_soap_proxy_auth(self):
+            pass
+    jira = OfflineJira('https://issues.example.org/jira', 'CASSANDRA', shortcode='#')
+    msgs = ['yeah, CASSANDRA-4321 looks related', 'see #1234 and #5678',
+            'nothing about tickets here at all, just chatter about compaction',
+            'CASSANDRA-1 CASSANDRA-22 cassandra-333 #4444']
+    def run():
+        for m in msgs:
+            jira.find_ticket_references(m)
+    return run
+
+
+# channel membership
+
+@benchmark('userRenamed, 50 channels x 2000 users')
+def bench_user_renamed():
+    bot = make_bot(make_service())
+    rng = random.Random(5)
+    channels = ['#chan%d' % n for n in range(50)]
+    for chan in channels:
+        bot.joined(chan)
+        for u in rng.sample(xrange(20000), 2000):
+            bot.userJoined('user%d' % u, chan)
+    for chan in channels[:20]:
+        bot.userJoined('mover', chan)
+    names = ['mover', 'mover_']
+    state = [0]
+    def run():
+        old = names[state[0]]
+        state[0] ^= 1
+        bot.userRenamed(old, names[state[0]])
+    return run
+
+
+# saved state
+
+def big_state_service(statefile):
+    from cassbot_plugins.regex_responder import RegexResponder, RuleEngine
+    from cassbot_plugins.bot_logger import BotLogger
+    responder = RegexResponder()
+    responder.rules = RuleEngine(regex_rules(1000))
+    logger = BotLogger()
+    blacklists = logger.blacklists[cassbot.PRIMARY_NETWORK]
+    for n in range(500):
+        blacklists.setdefault('#chan%d' % (n % 100), cassbot.MaskSet()).add('lurker%d!*@*' % n)
+    serv = make_service([responder, logger])
+    serv.statefile = statefile
+    serv.state['channels'] = set('#chan%d' % n for n in range(500))
+    for n in range(2000):
+        serv.auth.addPriv('user%d!*@*.example.com' % n, 'priv%d' % (n % 20))
+    for n in range(200):
+        serv.auth.addChannelPriv('#chan%d' % n, 'op%d!*@*' % n, 'log_blacklist_admin')
+    return serv
+
+@benchmark('saveStateToFile, large state')
+def bench_save_state():
+    fd, statefile = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    os.unlink(statefile)
+    serv = big_state_service(statefile)
+    def run():
+        serv.saveStateToFile(statefile)
+    run.cleanup = lambda: os.unlink(statefile)
+    return run
+
+@benchmark('loadStateFromFile, large state')
+def bench_load_state():
+    fd, statefile = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    os.unlink(statefile)
+    serv = big_state_service(statefile)
+    serv.saveStateToFile(statefile)
+    def run():
+        serv.loadStateFromFile(statefile)
+        serv.close_journal()
+    def cleanup():
+        for name in os.listdir(os.path.dirname(statefile)):
+            if name.startswith(os.path.basename(statefile)):
+                os.unlink(os.path.join(os.path.dirname(statefile), name))
+    run.cleanup = cleanup
+    return run
+
+
+def measure(func, repeat, min_time):
+    """
+    Time func, calling it enough times in a row for each run to take at
+    least min_time seconds; return operations per second for each of
+    repeat runs.
+    """
+
+    number = 1
+    while True:
+        start = time.time()
+        for _ in xrange(number):
+            func()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    results = [number / elapsed]
+    for _ in range(repeat - 1):
+        gc.collect()
+        start = time.time()
+        for _ in xrange(number):
+            func()
+        results.append(number / (time.time() - start))
+    return results
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def run_all(pattern=None, repeat=7, min_time=0.2):
+    results = {}
+    for name, setup in BENCHMARKS:
+        if pattern and pattern not in name:
+            continue
+        func = setup()
+        try:
+            runs = measure(func, repeat, min_time)
+        finally:
+            getattr(func, 'cleanup', lambda: None)()
+        results[name] = {'ops_per_sec': max(runs), 'median': median(runs), 'runs': runs}
+        report(name, median(runs), 'ops/s')
+    return results
+
+
+def compare(results, baseline, threshold, complete=True):
+    """
+    Print how each result's median compares with the baseline's; return
+    the names of the benchmarks which are slower by more than threshold,
+    with no overlap between this run's runs and the baseline's. If
+    complete, also mention the baseline's benchmarks which weren't run
+    this time.
+    """
+
+    slower = []
+    print
+    print 'compared with baseline (%s):' % baseline.get('timestamp', 'unknown time')
+    for name in sorted(results):
+        if name not in baseline['results']:
+            print '%-58s %s' % (name, 'new')
+            continue
+        new, old = results[name]['runs'], baseline['results'][name]['runs']
+        ratio = median(new) / median(old)
+        flag = ''
+        if ratio < 1 - threshold and max(new) < min(old):
+            flag = '  SLOWER'
+            slower.append(name)
+        elif ratio > 1 + threshold and min(new) > max(old):
+            flag = '  faster'
+        print '%-58s %+7.1f%%%s' % (name, (ratio - 1) * 100, flag)
+    if complete:
+        for name in sorted(set(baseline['results']) - set(results)):
+            print '%-58s %s' % (name, 'not run')
+    return slower
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', metavar='FILE', help='write results to FILE as json')
+    parser.add_option('-c', '--compare', metavar='FILE',
+                      help='compare with the results in FILE from an earlier run')
+    parser.add_option('-t', '--threshold', type='float', default=0.1,
+                      help='slowdown (as a fraction) to flag in comparisons [%default]')
+    parser.add_option('-k', '--filter', metavar='TEXT',
+                      help='only run benchmarks with TEXT in their names')
+    parser.add_option('--quick', action='store_true', help='fewer, shorter runs')
+    opts, args = parser.parse_args(argv)
+
+    baseline = None
+    if opts.compare:
+        with open(opts.compare) as f:
+            baseline = json.load(f)
+    if opts.quick:
+        results = run_all(opts.filter, repeat=3, min_time=0.05)
+    else:
+        results = run_all(opts.filter)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump({
+                'format': 2,
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=1, sort_keys=True)
+    if baseline is not None:
+        slower = compare(results, baseline, opts.threshold, complete=not opts.filter)
+        if slower:
+            print
+            print '%d benchmark(s) slower than the baseline by more than %d%%' \
+                  % (len(slower), opts.threshold * 100)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+
+# vim: set et sw=4 ts=4 :
@@ -2,18 +2,26 @@
 
 from __future__ import with_statement
 
+import os
+import re
 import time
-import shlex
+import sqlite3
+import threading
+from collections import deque, OrderedDict
+from contextlib import contextmanager
 from functools import wraps
 from itertools import imap, izip
 from fnmatch import fnmatch
 from twisted.words.protocols import irc
-from twisted.internet import defer, protocol, endpoints, task
-from twisted.python import log
+from twisted.internet import defer, protocol, endpoints, task, threads
+from twisted.python import failure, log, threadpool
 from twisted.plugin import getPlugins, IPlugin
 from twisted.application import internet, service
+from twisted.web import server
 from zope.interface import Interface, implements, directlyProvides
 import cassbot_plugins
+import metrics
+import webclient
 
 try:
     import cPickle as pickle
@@ -21,6 +29,35 @@ except ImportError:
     import pickle
 
 
+event_count = metrics.counter('cassbot_events_total',
+                              'Bot events (overrideable method calls), by method', ('method',))
+hook_calls = metrics.counter('cassbot_hook_calls_total',
+                             'Plugin hook and command calls, by plugin and method',
+                             ('plugin', 'method'))
+hook_seconds = metrics.histogram('cassbot_hook_seconds',
+                                 'Time plugin hooks and commands held the calling thread '
+                                 '(a sample of calls), by plugin and method',
+                                 ('plugin', 'method'))
+command_seconds = metrics.histogram('cassbot_command_seconds',
+                                    'Time from dispatch until a command finished, by command',
+                                    ('command',))
+command_outcomes = metrics.counter('cassbot_commands_total',
+                                   'Commands run, by command and outcome', ('command', 'outcome'))
+lines_sent = metrics.counter('cassbot_lines_sent_total', 'Lines sent by the outbound queues')
+lines_merged = metrics.counter('cassbot_lines_merged_total',
+                               'Queued lines merged into another line before sending')
+send_wait = metrics.histogram('cassbot_send_wait_seconds',
+                              'Time lines spent in the outbound queues')
+connection_events = metrics.counter('cassbot_connection_events_total',
+                                    'Connections made, lost and failed, by network',
+                                    ('network', 'event'))
+resync_seconds = metrics.histogram('cassbot_resync_seconds',
+                                   'Time from signing on until every channel was synced',
+                                   buckets=(1, 5, 15, 30, 60, 120, 300, 600))
+channel_syncs = metrics.counter('cassbot_channel_syncs_total',
+                                'Channels rejoined after signing on, by outcome', ('outcome',))
+
+
 class enabled_but_not_found:
     def __init__(self):
         self.when_found = defer.Deferred()
@@ -88,6 +125,10 @@ class IBotPluginInstance(Interface):
         and correlated with this plugin, it will be restored to it using
         the loadState() call.
 
+        This may be called at any time while the plugin is running, and the
+        result may be pickled in another thread, so it should not share any
+        mutable objects with the plugin's live state.
+
         If None is returned, no state will be saved for this plugin.
         """
 
@@ -104,6 +145,14 @@ class IBotPluginInstance(Interface):
         state info be available.
         """
 
+    def replayJournal(record):
+        """
+        Apply one change record that this plugin earlier passed to
+        bot.service.journal_plugin_change(). Called after loadState(), once
+        for each change made since the last full state snapshot, in the
+        order they were made.
+        """
+
 class BaseBotPlugin_meta(type):
     def __new__(cls, name, bases, attrs):
         newcls = super(BaseBotPlugin_meta, cls).__new__(cls, name, bases, attrs)
@@ -166,6 +215,10 @@ class BaseBotPlugin(object):
     def loadState(self, s):
         pass
 
+    def replayJournal(self, record):
+        log.msg('Plugin %s has no way to replay journal record %r; dropping it'
+                % (self.name(), record))
+
 
 def noop(*a, **kw):
     pass
@@ -177,6 +230,1101 @@ def removekey(dicty, key):
         pass
 
 
+class HookDispatcher:
+    """
+    Flat per-event tables of the plugin hooks to call, so that dispatching
+    an event doesn't have to look up watchers and their methods every time.
+    Each table is a tuple of (plugin, bound method) pairs, in the same order
+    as the plugins appear in the watcher map. Rebuilt by the service
+    whenever the set of enabled plugins is rescanned.
+
+    If given, wrap is applied to each bound method before it goes in a
+    table (the service uses this to time every hook, and to send
+    @off_reactor hooks to its thread pool).
+    """
+
+    def __init__(self, wrap=None):
+        self.tables = {}
+        self.wrap = wrap
+
+    def rebuild(self, watcher_map):
+        tables = {}
+        for mname, watchers in watcher_map.iteritems():
+            hooks = []
+            for w in watchers:
+                hook = getattr(w, mname, None)
+                if hook is not None:
+                    if self.wrap is not None:
+                        hook = self.wrap(hook)
+                    hooks.append((w, hook))
+            tables[mname] = tuple(hooks)
+        self.tables = tables
+
+    def hooks_for(self, mname):
+        return self.tables.get(mname, ())
+
+
+class ReactorProxy:
+    """
+    Stands in for an object (usually the bot) in code running in a worker
+    thread: calling any of its methods runs the real method in the reactor
+    thread, waits for it and returns the result. Other attributes are read
+    straight from the object.
+    """
+
+    def __init__(self, obj, reactor):
+        self._obj = obj
+        self._reactor = reactor
+
+    def __getattr__(self, name):
+        value = getattr(self._obj, name)
+        if not callable(value):
+            return value
+        def call_in_reactor(*a, **kw):
+            return threads.blockingCallFromThread(self._reactor, value, *a, **kw)
+        return call_in_reactor
+
+
+class PluginThreadPool:
+    """
+    A size-limited thread pool for plugin code that would otherwise block
+    the reactor (see off_reactor). Keeps count of how much work is waiting
+    and running, and how long work waits for a thread.
+    """
+
+    def __init__(self, reactor, size=4, name='cassbot-plugins'):
+        self.reactor = reactor
+        self.pool = threadpool.ThreadPool(0, size, name)
+        self.lock = threading.Lock()
+        self.running = False
+        self.submitted = 0
+        self.started = 0
+        self.finished = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.pool.start()
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.pool.stop()
+
+    def run(self, func, *a, **kw):
+        """
+        Call func(*a, **kw) in the pool; return a Deferred which fires with
+        its result in the reactor thread.
+        """
+
+        self.start()
+        queued = time.time()
+        def timed():
+            wait = time.time() - queued
+            with self.lock:
+                self.started += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            try:
+                return func(*a, **kw)
+            finally:
+                with self.lock:
+                    self.finished += 1
+        self.submitted += 1
+        return threads.deferToThreadPool(self.reactor, self.pool, timed)
+
+    def stats(self):
+        with self.lock:
+            started, finished = self.started, self.finished
+            total_wait, max_wait = self.total_wait, self.max_wait
+        return {
+            'size': self.pool.max,
+            'waiting': self.submitted - started,
+            'running': started - finished,
+            'finished': finished,
+            'avg_wait': total_wait / started if started else 0.0,
+            'max_wait': max_wait,
+        }
+
+
+class ReactorWatchdog:
+    """
+    Notices when the reactor thread has been kept busy: ticks every
+    interval seconds, and logs whenever a tick comes more than threshold
+    seconds late.
+    """
+
+    interval = 0.1
+
+    def __init__(self, clock, threshold=0.25):
+        self.clock = clock
+        self.threshold = threshold
+        self.loop = task.LoopingCall(self.tick)
+        self.loop.clock = clock
+        self.last = None
+        self.stalls = 0
+        self.max_stall = 0.0
+
+    def start(self):
+        self.last = self.clock.seconds()
+        self.loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def tick(self):
+        now = self.clock.seconds()
+        lag = now - self.last - self.interval
+        self.last = now
+        if lag > self.threshold:
+            self.stalls += 1
+            self.max_stall = max(self.max_stall, lag)
+            log.msg('Reactor stalled for %dms' % (lag * 1000))
+
+    def stats(self):
+        return {'stalls': self.stalls, 'max_stall': self.max_stall}
+
+
+class HookTimes(object):
+    """
+    Timings for one plugin method: totals, plus the wall times of the last
+    few calls for percentiles.
+    """
+
+    __slots__ = ('calls', 'wall', 'cpu', 'max_wall', 'slow', 'recent')
+
+    def __init__(self, window):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.max_wall = 0.0
+        self.slow = 0
+        self.recent = deque(maxlen=window)
+
+    def percentiles(self, *points):
+        ordered = sorted(self.recent)
+        if not ordered:
+            return [0.0] * len(points)
+        last = len(ordered) - 1
+        return [ordered[min(last, int(p / 100.0 * len(ordered)))] for p in points]
+
+
+class HookProfiler:
+    """
+    Opt-in timing of plugin hook and command calls, by plugin and method,
+    for finding out which plugin is making the bot lag. Off by default;
+    while it is off, the only cost to a call is checking the enabled flag.
+
+    Times are how long each call held the thread that made it (for an
+    off_reactor method, the pool thread), not how long any Deferred it
+    returned took to fire. CPU time is process-wide, so it will be high
+    for calls that ran alongside busy pool threads.
+
+    capture() also runs every call into one plugin under cProfile, for a
+    while; only one thread at a time can be profiled, so calls made while
+    another is being profiled are just timed.
+    """
+
+    # wall times kept per method, for percentiles
+    window = 512
+    # log calls taking longer than this many seconds
+    slow_threshold = 0.1
+    report_sorts = ('p95', 'total', 'max', 'cpu', 'calls')
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.enabled = False
+        self.enabled_at = None
+        self.lock = threading.Lock()
+        self.times = {}
+        self.capturing = None
+        self.capture_profile = None
+        self.capture_lock = threading.Lock()
+
+    def enable(self):
+        if not self.enabled:
+            self.enabled = True
+            self.enabled_at = self.clock.seconds()
+
+    def disable(self):
+        if self.capturing is None:
+            self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.times = {}
+        if self.enabled:
+            self.enabled_at = self.clock.seconds()
+
+    def measure(self, key, func, a, kw):
+        """
+        Call func(*a, **kw) and record how long it took under key, a
+        (plugin name, method name) tuple.
+        """
+
+        profile = None
+        locked = self.capturing == key[0] and self.capture_lock.acquire(False)
+        if locked:
+            profile = self.capture_profile
+        start = time.time()
+        cpu_start = time.clock()
+        try:
+            if profile is not None:
+                return profile.runcall(func, *a, **kw)
+            return func(*a, **kw)
+        finally:
+            if locked:
+                self.capture_lock.release()
+            wall = time.time() - start
+            cpu = time.clock() - cpu_start
+            with self.lock:
+                t = self.times.get(key)
+                if t is None:
+                    t = self.times[key] = HookTimes(self.window)
+                t.calls += 1
+                t.wall += wall
+                t.cpu += cpu
+                t.max_wall = max(t.max_wall, wall)
+                t.recent.append(wall)
+                if wall > self.slow_threshold:
+                    t.slow += 1
+            if wall > self.slow_threshold:
+                log.msg('Slow plugin call: %s.%s took %dms' % (key[0], key[1], wall * 1000))
+
+    def capture(self, pname, seconds):
+        """
+        Profile every call into the named plugin with cProfile for the
+        given number of seconds (turning on timing meanwhile, if it was
+        off). Return a Deferred which fires with a pstats.Stats afterwards,
+        or None if nothing was called. Only one plugin can be captured at a
+        time; raises ValueError if another capture is still going.
+        """
+
+        import cProfile, pstats
+
+        if self.capturing is not None:
+            raise ValueError('Already profiling %s' % self.capturing)
+        was_enabled = self.enabled
+        self.enable()
+        self.capture_profile = cProfile.Profile()
+        self.capturing = pname
+        d = task.deferLater(self.clock, seconds, lambda: None)
+        def finish(result):
+            if not self.capture_lock.acquire(False):
+                # a profiled call is still running in a pool thread
+                return task.deferLater(self.clock, 0.1, finish, result)
+            try:
+                profile = self.capture_profile
+                self.capturing = self.capture_profile = None
+            finally:
+                self.capture_lock.release()
+            if not was_enabled:
+                self.disable()
+            if isinstance(result, failure.Failure):
+                # cancelled; the capture is over all the same
+                return result
+            try:
+                return pstats.Stats(profile)
+            except TypeError:
+                # no calls were made, so no stats were collected
+                return None
+        return d.addBoth(finish)
+
+    def report(self, count=None, sort='p95'):
+        """
+        Return (plugin, method, calls, total wall, total cpu, p50, p95,
+        p99, max wall, slow calls) rows for the worst methods, worst first,
+        as ordered by sort (one of report_sorts).
+        """
+
+        with self.lock:
+            items = [(key, t.calls, t.wall, t.cpu, t.max_wall, t.slow,
+                      t.percentiles(50, 95, 99)) for (key, t) in self.times.iteritems()]
+        rows = [(pname, mname, calls, wall, cpu, p50, p95, p99, max_wall, slow)
+                for ((pname, mname), calls, wall, cpu, max_wall, slow, (p50, p95, p99))
+                in items]
+        column = {'calls': 2, 'total': 3, 'cpu': 4, 'p95': 6, 'max': 8}[sort]
+        rows.sort(key=lambda row: row[column], reverse=True)
+        return rows[:count]
+
+    def format_report(self, count=None, sort='p95'):
+        return ['%s.%s: %d calls, %.1fms (cpu %.1fms); p50 %.1fms, p95 %.1fms, '
+                'p99 %.1fms, max %.1fms; %d slow'
+                % (pname, mname, calls, wall * 1000, cpu * 1000, p50 * 1000, p95 * 1000,
+                   p99 * 1000, max_wall * 1000, slow)
+                for (pname, mname, calls, wall, cpu, p50, p95, p99, max_wall, slow)
+                in self.report(count, sort)]
+
+    def write_report(self, path, sort='p95'):
+        """
+        Write the full report, one tab-separated row per method, to path.
+        """
+
+        with open(path, 'w') as f:
+            f.write('# plugin\tmethod\tcalls\twall_s\tcpu_s\tp50_s\tp95_s\tp99_s'
+                    '\tmax_s\tslow\n')
+            for row in self.report(sort=sort):
+                f.write('\t'.join(map(str, row)) + '\n')
+
+
+IRC_MAX_LINE = 512
+
+PRIORITY_REPLY = 0
+PRIORITY_BULK = 1
+
+class SendScheduler:
+    """
+    Outbound message queue for one connection. Lines are released through
+    a token bucket (rate lines per second, up to burst at once), so that a
+    long reply can't get the bot killed for flooding.
+
+    Each priority level keeps a FIFO per target, and targets take turns
+    round-robin, so one channel with a huge backlog doesn't starve the
+    others. Replies (PRIORITY_REPLY) always go out before bulk/log-style
+    traffic (PRIORITY_BULK). While lines are held back, short consecutive
+    lines to the same target are merged with the joiner string, as long as
+    the result still fits in one IRC line.
+    """
+
+    # room left for the ":nick!user@host " prefix the server adds when it
+    # relays our line to everyone else
+    prefix_allowance = 100
+
+    def __init__(self, sendfunc, clock, rate=1.0, burst=4, joiner=' | ',
+                 max_line=IRC_MAX_LINE):
+        self.sendfunc = sendfunc
+        self.clock = clock
+        self.rate = float(rate)
+        self.burst = burst
+        self.joiner = joiner
+        self.max_line = max_line
+
+        self.tokens = float(burst)
+        self.last_refill = clock.seconds()
+        self.pump_call = None
+
+        # one dict of {target: deque([[text, enqueue_time], ...])} and one
+        # round-robin deque of targets per priority level
+        self.pending = ({}, {})
+        self.rotation = (deque(), deque())
+        self.waiting = 0
+
+        self.lines_queued = 0
+        self.lines_sent = 0
+        self.lines_merged = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        return now
+
+    def max_text_len(self, target):
+        if self.max_line is None:
+            return None
+        return (self.max_line - len('PRIVMSG %s :\r\n' % (target,))
+                - self.prefix_allowance)
+
+    def enqueue(self, target, text, priority=PRIORITY_REPLY):
+        self.lines_queued += 1
+        now = self.refill()
+        if self.tokens >= 1 and self.waiting == 0:
+            # nothing waiting; skip the queue entirely
+            self.tokens -= 1
+            self.send(target, text, 0.0)
+            return
+        queues = self.pending[priority]
+        q = queues.get(target)
+        if q is None:
+            q = queues[target] = deque()
+            self.rotation[priority].append(target)
+        q.append([text, now])
+        self.waiting += 1
+        self.schedule_pump()
+
+    def depth(self, target=None):
+        if target is None:
+            return self.waiting
+        return sum(len(queues.get(target, ())) for queues in self.pending)
+
+    def next_line(self):
+        for priority, rotation in enumerate(self.rotation):
+            if not rotation:
+                continue
+            target = rotation.popleft()
+            queues = self.pending[priority]
+            q = queues[target]
+            text, queued_at = q.popleft()
+            self.waiting -= 1
+            maxlen = self.max_text_len(target)
+            while q and (maxlen is None or
+                         len(text) + len(self.joiner) + len(q[0][0]) <= maxlen):
+                text = text + self.joiner + q.popleft()[0]
+                self.waiting -= 1
+                self.lines_merged += 1
+                lines_merged.inc()
+            if q:
+                rotation.append(target)
+            else:
+                del queues[target]
+            return target, text, queued_at
+        return None
+
+    def pump(self):
+        self.pump_call = None
+        now = self.refill()
+        while self.tokens >= 1:
+            item = self.next_line()
+            if item is None:
+                break
+            target, text, queued_at = item
+            self.tokens -= 1
+            self.send(target, text, now - queued_at)
+        self.schedule_pump()
+
+    def schedule_pump(self):
+        if self.pump_call is not None or self.waiting == 0:
+            return
+        delay = max(0.0, (1 - self.tokens) / self.rate)
+        self.pump_call = self.clock.callLater(delay, self.pump)
+
+    def send(self, target, text, waited):
+        self.lines_sent += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        lines_sent.inc()
+        send_wait.observe(waited)
+        try:
+            res = self.sendfunc(target, text)
+        except Exception:
+            log.err(None, 'Sending queued line to %s' % (target,))
+        else:
+            if isinstance(res, defer.Deferred):
+                res.addErrback(log.err, 'Sending queued line to %s' % (target,))
+
+    def stop(self):
+        if self.pump_call is not None:
+            self.pump_call.cancel()
+            self.pump_call = None
+        if self.waiting:
+            log.msg('Dropping %d queued outbound lines' % self.waiting)
+        self.pending = ({}, {})
+        self.rotation = (deque(), deque())
+        self.waiting = 0
+
+    def stats(self):
+        per_target = {}
+        for queues in self.pending:
+            for target, q in queues.iteritems():
+                per_target[target] = per_target.get(target, 0) + len(q)
+        sent = self.lines_sent
+        return {
+            'depth': self.waiting,
+            'depth_per_target': per_target,
+            'queued': self.lines_queued,
+            'sent': sent,
+            'merged': self.lines_merged,
+            'avg_wait': self.total_wait / sent if sent else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+
+class RejoinScheduler:
+    """
+    Joins channels for one connection without flooding: channels are
+    packed into comma-separated JOIN lines (at most max_targets channels,
+    and no longer than max_line), and those go out through a token bucket
+    (rate lines per second, up to burst at once). The MODE query for each
+    joined channel waits in the same bucket behind any JOINs still to go.
+
+    start() also begins tracking a resync: every channel asked for is
+    waiting, joining (its JOIN has been sent), synced (its NAMES list has
+    come in) or failed (refused, or not synced within sync_timeout of its
+    JOIN going out). Once
+    none are left waiting or joining, on_complete is called with the
+    sorted lists of synced and failed channels.
+    """
+
+    max_targets = 10
+    sync_timeout = 120
+
+    def __init__(self, send_join, send_mode, clock, rate=0.5, burst=3,
+                 max_line=IRC_MAX_LINE, on_complete=None):
+        self.send_join = send_join
+        self.send_mode = send_mode
+        self.clock = clock
+        self.rate = float(rate)
+        self.burst = burst
+        self.max_line = max_line
+        self.on_complete = on_complete
+
+        self.tokens = float(burst)
+        self.last_refill = clock.seconds()
+        self.pump_call = None
+
+        # channel names as given, and their lowercased forms, for each queue
+        self.joins = deque()
+        self.queued_joins = set()
+        self.modes = deque()
+        self.queued_modes = set()
+
+        # lowercased channel name: state, and the name as given
+        self.states = {}
+        self.names = {}
+        self.started = None
+        self.finished = None
+        # (deadline, lowercased name) for each JOIN sent, in the order sent
+        self.deadlines = deque()
+        self.timeout_call = None
+
+    def refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        return now
+
+    def start(self, channels):
+        """
+        Join all of channels, tracking how far along the resync is.
+        """
+
+        self.cancel_timeout()
+        self.names = dict((chan.lower(), chan) for chan in channels)
+        self.states = dict.fromkeys(self.names, 'waiting')
+        self.started = self.clock.seconds()
+        self.finished = None
+        for chan in sorted(channels):
+            self.join(chan)
+        self.check_done()
+
+    def join(self, channel):
+        key = channel.lower()
+        if key in self.queued_joins:
+            return
+        self.queued_joins.add(key)
+        self.joins.append(channel)
+        self.schedule_pump()
+
+    def query_mode(self, channel):
+        key = channel.lower()
+        if key in self.queued_modes:
+            return
+        self.queued_modes.add(key)
+        self.modes.append(channel)
+        self.schedule_pump()
+
+    def forget(self, channel):
+        """
+        Drop a channel's queued MODE query, once it has been left.
+        """
+
+        key = channel.lower()
+        if key in self.queued_modes:
+            self.queued_modes.discard(key)
+            self.modes = deque(c for c in self.modes if c.lower() != key)
+
+    def set_state(self, channel, state, only_from=('waiting', 'joining')):
+        key = channel.lower()
+        if self.states.get(key) in only_from:
+            self.states[key] = state
+            if state in ('synced', 'failed'):
+                channel_syncs.labels(state).inc()
+                self.check_done()
+
+    def synced(self, channel):
+        self.set_state(channel, 'synced')
+
+    def failed(self, channel):
+        self.set_state(channel, 'failed')
+
+    def timed_out(self):
+        self.timeout_call = None
+        now = self.clock.seconds()
+        late = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            key = self.deadlines.popleft()[1]
+            if self.states.get(key) == 'joining':
+                late.append(self.names[key])
+        if late:
+            log.msg('Gave up waiting for %d channels to sync: %s'
+                    % (len(late), ', '.join(late)))
+        for chan in late:
+            self.failed(chan)
+        self.schedule_timeout()
+
+    def schedule_timeout(self):
+        if self.timeout_call is not None or not self.deadlines:
+            return
+        delay = max(0.0, self.deadlines[0][0] - self.clock.seconds())
+        self.timeout_call = self.clock.callLater(delay, self.timed_out)
+
+    def cancel_timeout(self):
+        if self.timeout_call is not None:
+            self.timeout_call.cancel()
+            self.timeout_call = None
+        self.deadlines.clear()
+
+    def check_done(self):
+        if self.started is None or self.finished is not None:
+            return
+        counts = self.progress()
+        if counts['waiting'] or counts['joining']:
+            return
+        self.finished = self.clock.seconds()
+        self.cancel_timeout()
+        resync_seconds.observe(self.finished - self.started)
+        if self.on_complete is not None:
+            try:
+                self.on_complete(self.channels_in('synced'), self.channels_in('failed'))
+            except Exception:
+                log.err(None, 'Reporting a finished channel resync')
+
+    def channels_in(self, *states):
+        return sorted(self.names[key] for (key, state) in self.states.iteritems()
+                      if state in states)
+
+    def progress(self):
+        """
+        How far the last resync has got: a count of channels in each
+        state, plus seconds elapsed and whether it is done.
+        """
+
+        counts = dict.fromkeys(('waiting', 'joining', 'synced', 'failed'), 0)
+        for state in self.states.itervalues():
+            counts[state] += 1
+        counts['channels'] = len(self.states)
+        counts['done'] = self.finished is not None
+        if self.started is None:
+            counts['elapsed'] = 0.0
+        else:
+            counts['elapsed'] = (self.finished or self.clock.seconds()) - self.started
+        counts['queued_joins'] = len(self.joins)
+        counts['queued_modes'] = len(self.modes)
+        return counts
+
+    def next_batch(self):
+        """
+        Take as many channels off the join queue as fit in one JOIN line.
+        """
+
+        room = None
+        if self.max_line is not None:
+            room = self.max_line - len('JOIN \r\n')
+        batch = []
+        deadline = self.clock.seconds() + self.sync_timeout
+        while self.joins and len(batch) < self.max_targets:
+            chan = self.joins[0]
+            key = chan.lower()
+            size = len(chan) + (1 if batch else 0)
+            if room is not None:
+                if batch and size > room:
+                    break
+                room -= size
+            batch.append(self.joins.popleft())
+            self.queued_joins.discard(key)
+            if self.states.get(key) == 'waiting':
+                self.states[key] = 'joining'
+                self.deadlines.append((deadline, key))
+        self.schedule_timeout()
+        return batch
+
+    def pump(self):
+        self.pump_call = None
+        self.refill()
+        while self.tokens >= 1 and (self.joins or self.modes):
+            self.tokens -= 1
+            if self.joins:
+                send, arg = self.send_join, self.next_batch()
+            else:
+                chan = self.modes.popleft()
+                self.queued_modes.discard(chan.lower())
+                send, arg = self.send_mode, chan
+            try:
+                send(arg)
+            except Exception:
+                log.err(None, 'Sending join/mode request for %r' % (arg,))
+        self.schedule_pump()
+
+    def schedule_pump(self):
+        if self.pump_call is not None or not (self.joins or self.modes):
+            return
+        delay = max(0.0, (1 - self.tokens) / self.rate)
+        self.pump_call = self.clock.callLater(delay, self.pump)
+
+    def stop(self):
+        if self.pump_call is not None:
+            self.pump_call.cancel()
+            self.pump_call = None
+        self.cancel_timeout()
+        self.joins.clear()
+        self.queued_joins.clear()
+        self.modes.clear()
+        self.queued_modes.clear()
+
+
+class CommandScheduler:
+    """
+    Limits on running commands, shared by every connection of a service:
+    at most max_per_command invocations of any one command and
+    max_per_user commands from any one user run at once (the rest wait
+    their turn), each user gets a token bucket of user_burst commands
+    refilled at user_rate per second, and a handler still running after
+    its deadline is cancelled. Users are identified by whatever key the
+    caller passes as the nick; CassBotCore uses (network name, nick), so
+    the same nick on two networks is two users.
+    """
+
+    max_per_command = 4
+    max_per_user = 2
+    user_rate = 0.5
+    user_burst = 5
+    default_deadline = 120
+    # past this many buckets, forget the ones that have refilled
+    max_buckets = 1000
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.command_limits = {}
+        self.user_limits = {}
+        self.buckets = {}
+        self.warned = set()
+        self.counts = dict.fromkeys(('dispatched', 'throttled', 'completed', 'failed',
+                                     'timed_out'), 0)
+        self.per_command = {}
+
+    def allow(self, nick):
+        """
+        Take a token from nick's bucket, if there is one. Returns False if
+        nick has been sending commands too fast.
+        """
+
+        now = self.clock.seconds()
+        tokens, last = self.buckets.get(nick, (self.user_burst, now))
+        tokens = min(self.user_burst, tokens + (now - last) * self.user_rate)
+        if tokens < 1:
+            self.buckets[nick] = (tokens, now)
+            self.counts['throttled'] += 1
+            return False
+        self.buckets[nick] = (tokens - 1, now)
+        self.warned.discard(nick)
+        if len(self.buckets) > self.max_buckets:
+            self.prune_buckets(now)
+        return True
+
+    def prune_buckets(self, now):
+        refill = self.user_rate
+        self.buckets = dict((nick, (tokens, last)) for (nick, (tokens, last))
+                            in self.buckets.iteritems()
+                            if tokens + (now - last) * refill < self.user_burst)
+
+    def should_warn(self, nick):
+        """
+        True the first time nick is throttled since its last allowed command,
+        so the bot doesn't flood a flooder with warnings.
+        """
+
+        if nick in self.warned:
+            return False
+        self.warned.add(nick)
+        return True
+
+    def limit_for(self, limits, key, size):
+        try:
+            return limits[key]
+        except KeyError:
+            sem = limits[key] = defer.DeferredSemaphore(size)
+            return sem
+
+    def forget_idle(self, limits, key):
+        sem = limits.get(key)
+        if sem is not None and sem.tokens == sem.limit and not sem.waiting:
+            del limits[key]
+
+    def run(self, cmd, nick, deadline, func, *a):
+        """
+        Run func(*a) within the limits for cmd and nick, and cancel it if it
+        takes longer than deadline seconds (0 or None for no deadline).
+        Returns a Deferred with its result.
+        """
+
+        self.counts['dispatched'] += 1
+        self.per_command[cmd] = self.per_command.get(cmd, 0) + 1
+        user_limit = self.limit_for(self.user_limits, nick, self.max_per_user)
+        cmd_limit = self.limit_for(self.command_limits, cmd, self.max_per_command)
+        start = self.clock.seconds()
+        d = user_limit.run(cmd_limit.run, self.run_with_deadline, deadline, func, *a)
+        def finished(result):
+            if not isinstance(result, failure.Failure):
+                outcome = 'completed'
+            elif result.check(defer.CancelledError):
+                outcome = 'timed_out'
+            else:
+                outcome = 'failed'
+            self.counts[outcome] += 1
+            command_outcomes.labels(cmd, outcome).inc()
+            command_seconds.labels(cmd).observe(self.clock.seconds() - start)
+            self.forget_idle(self.user_limits, nick)
+            self.forget_idle(self.command_limits, cmd)
+            return result
+        return d.addBoth(finished)
+
+    def run_with_deadline(self, deadline, func, *a):
+        d = defer.maybeDeferred(func, *a)
+        if deadline and not d.called:
+            timer = self.clock.callLater(deadline, d.cancel)
+            def stop_timer(result):
+                if timer.active():
+                    timer.cancel()
+                return result
+            d.addBoth(stop_timer)
+        return d
+
+    def stats(self):
+        running = 0
+        waiting = 0
+        for sem in self.user_limits.itervalues():
+            running += sem.limit - sem.tokens
+            waiting += len(sem.waiting)
+        stats = dict(self.counts)
+        stats['running'] = running
+        stats['waiting'] = waiting
+        stats['per_command'] = dict(self.per_command)
+        return stats
+
+
+class CommandSyntaxError(ValueError):
+    """
+    A command line couldn't be split into words (an unclosed quote, etc).
+    """
+
+
+# one piece of a shell-style command line: whitespace, a run of plain
+# characters, a backslash escape, or a quoted string (whose closing quote
+# may be missing)
+_command_piece = re.compile(r'''(\s+)|([^\s'"\\]+)|\\(.?)|"((?:[^"\\]|\\.)*)(")?|'([^']*)(')?''',
+                            re.S)
+_dquote_escape = re.compile(r'\\([\\"])')
+
+def split_command(cmdstr):
+    """
+    Split a command line into words, the way shlex.split does: quotes group
+    words, and backslashes escape characters. Lines without any quotes or
+    backslashes (nearly all of them) are just split on whitespace. Raises
+    CommandSyntaxError for an unclosed quote or a trailing backslash.
+    """
+
+    if '"' not in cmdstr and "'" not in cmdstr and '\\' not in cmdstr:
+        return cmdstr.split()
+    words = []
+    word = None
+    for m in _command_piece.finditer(cmdstr):
+        space, plain, escaped, dquoted, dclose, squoted, sclose = m.groups()
+        if space is not None:
+            if word is not None:
+                words.append(''.join(word))
+                word = None
+            continue
+        if word is None:
+            word = []
+        if plain is not None:
+            word.append(plain)
+        elif escaped is not None:
+            if not escaped:
+                raise CommandSyntaxError('No escaped character')
+            word.append(escaped)
+        elif dquoted is not None:
+            if dclose is None:
+                raise CommandSyntaxError('No closing quotation')
+            word.append(_dquote_escape.sub(r'\1', dquoted))
+        else:
+            if sclose is None:
+                raise CommandSyntaxError('No closing quotation')
+            word.append(squoted)
+    if word is not None:
+        words.append(''.join(word))
+    return words
+
+
+class CommandParser:
+    """
+    Picks out the messages addressed to the bot as commands ("nick: cmd
+    args" or "<prefix>cmd args", or anything in private) and splits them
+    into words. Most channel traffic is turned away by one startswith()
+    call, without any tokenizing.
+    """
+
+    def __init__(self, nickname, cmd_prefix=None):
+        self.key = (nickname, cmd_prefix)
+        starts = ['%s:' % (nickname,)]
+        if cmd_prefix:
+            starts.append(cmd_prefix)
+        self.starts = tuple(starts)
+        self.prefix_re = re.compile('|'.join(map(re.escape, starts)))
+
+    def command_text(self, message, private=False):
+        """
+        Return the command part of message, or None if it isn't a command.
+        """
+
+        if not message.startswith(self.starts):
+            return message if private else None
+        return message[self.prefix_re.match(message).end():]
+
+    def parse(self, message, private=False):
+        """
+        Return the words of the command in message, or None if it isn't a
+        command. Raises CommandSyntaxError if the command can't be split.
+        """
+
+        cmdstr = self.command_text(message, private)
+        if cmdstr is None:
+            return None
+        return split_command(cmdstr)
+
+
+def intern_name(name):
+    # intern() only takes plain strs
+    if type(name) is str:
+        return intern(name)
+    return name
+
+
+class ChannelState(object):
+    """
+    One channel the bot is in. members is the set of (interned) nicks in
+    it; modes maps a mode argument (a member's nick, None for plain channel
+    modes, a ban mask, etc) to its set of modes, and only has entries for
+    members with some mode ('o' for an op, etc), which are few.
+    """
+
+    __slots__ = ('name', 'members', 'modes')
+
+    def __init__(self, name):
+        self.name = name
+        self.members = set()
+        self.modes = {}
+
+
+class MembershipIndex:
+    """
+    Who is in which channel, with their channel modes. Channels hold sets
+    of nicks, and the one reverse index maps every nick to a tuple of the
+    ChannelState records for the channels it is in (short, so a tuple is
+    cheaper than a set or list here). So renames, parts and quits only
+    touch the channels that user is actually in, however many channels
+    and users the bot can see. Nicks are interned, so each is stored once
+    however many channels it is in.
+    """
+
+    def __init__(self):
+        self.users = {}
+        self.channels = {}
+
+    def channel(self, name):
+        try:
+            return self.channels[name]
+        except KeyError:
+            chan = self.channels[name] = ChannelState(intern_name(name))
+            return chan
+
+    def join(self, channel, nick):
+        chan = self.channel(channel)
+        if nick not in chan.members:
+            nick = intern_name(nick)
+            chan.members.add(nick)
+            self.users[nick] = self.users.get(nick, ()) + (chan,)
+
+    def forget(self, nick, chan):
+        # take chan out of nick's channels, and nick out of the index once
+        # it has none left
+        chans = tuple(c for c in self.users.get(nick, ()) if c is not chan)
+        if chans:
+            self.users[nick] = chans
+        else:
+            self.users.pop(nick, None)
+
+    def part(self, channel, nick):
+        chan = self.channels.get(channel)
+        if chan is None or nick not in chan.members:
+            return
+        chan.members.remove(nick)
+        chan.modes.pop(nick, None)
+        self.forget(nick, chan)
+
+    def quit(self, nick):
+        """
+        Remove nick from every channel; return the names of those channels.
+        """
+
+        chans = self.users.pop(nick, ())
+        for chan in chans:
+            chan.members.remove(nick)
+            chan.modes.pop(nick, None)
+        return [chan.name for chan in chans]
+
+    def rename(self, oldnick, newnick):
+        chans = self.users.pop(oldnick, None)
+        if chans is None:
+            return
+        if newnick in self.users:
+            # stale; nicks are unique on a network
+            self.quit(newnick)
+        newnick = intern_name(newnick)
+        for chan in chans:
+            chan.members.remove(oldnick)
+            chan.members.add(newnick)
+            modes = chan.modes.pop(oldnick, None)
+            if modes is not None:
+                chan.modes[newnick] = modes
+        self.users[newnick] = chans
+
+    def drop_channel(self, channel):
+        chan = self.channels.pop(channel, None)
+        if chan is None:
+            return
+        for nick in chan.members:
+            self.forget(nick, chan)
+
+    def set_mode(self, channel, arg, mode, beingset):
+        chan = self.channel(channel)
+        if beingset:
+            chan.modes.setdefault(arg, set()).add(mode)
+        else:
+            modeset = chan.modes.get(arg)
+            if modeset is not None:
+                modeset.discard(mode)
+                if not modeset and arg in chan.members:
+                    del chan.modes[arg]
+
+    def members(self, channel):
+        chan = self.channels.get(channel)
+        if chan is None:
+            return []
+        return list(chan.members)
+
+    def channels_of(self, nick):
+        return [chan.name for chan in self.users.get(nick, ())]
+
+    def modes_for(self, channel, arg):
+        """
+        Return the set of modes set in channel for arg, which is a nick,
+        some other mode argument, or None for plain channel modes.
+        """
+
+        chan = self.channels.get(channel)
+        if chan is None:
+            return set()
+        return set(chan.modes.get(arg, ()))
+
+    def __len__(self):
+        return len(self.users)
+
+
 class CassBotCore(irc.IRCClient):
     overrideable = (
         'created',
@@ -192,6 +1340,7 @@ class CassBotCore(irc.IRCClient):
         'joined',
         'left',
         'chanSynced',
+        'allChannelsSynced',
         'noticed',
         'modeChanged',
         'serverModeChanged',
@@ -211,6 +1360,12 @@ class CassBotCore(irc.IRCClient):
     )
     mode = 'irc'
     ping_interval = 120
+    send_rate = 1.0
+    send_burst = 4
+    send_joiner = ' | '
+    send_max_line = IRC_MAX_LINE
+    join_rate = 0.5
+    join_burst = 3
 
     def __init__(self, nickname='cassbot'):
         # state that will be saved and reset on this object by the service
@@ -219,14 +1374,16 @@ class CassBotCore(irc.IRCClient):
         self.cmd_prefix = None
 
         self.channels = set()
-        self.chan_modemap = {}
+        self.memberships = MembershipIndex()
         self.is_channel_synced = {}
         self.server_modemap = {}
         self.topic_map = {}
-        self.channel_memberships = {}
         self.is_signed_on = False
         self.init_time = time.time()
         self.pinglooper = None
+        self.send_scheduler = None
+        self.rejoin_scheduler = None
+        self.command_parser = None
 
         for mname in self.overrideable:
             realmethod = getattr(self, mname, noop)
@@ -234,64 +1391,142 @@ class CassBotCore(irc.IRCClient):
             setattr(self, mname, wrappedmethod)
 
     def make_watch_wrapper(self, mname, realmethod):
-        @defer.inlineCallbacks
+        count = event_count.labels(mname)
         def wrapper(*a, **kw):
-            realresult = yield realmethod(*a, **kw)
-            watchers = self.service.watcher_map.get(mname, ())
-            for w in watchers:
-                pluginmethod = getattr(w, mname, noop)
-                try:
-                    yield pluginmethod(self, *a, **kw)
-                except Exception, e:
-                    log.err(None, 'Exception in plugin %s for method %r'
-                                  % (w.name(), mname))
-            defer.returnValue(realresult)
+            count.value += 1
+            try:
+                realresult = realmethod(*a, **kw)
+            except Exception:
+                return defer.fail()
+            if isinstance(realresult, defer.Deferred):
+                return realresult.addCallback(self.run_hooks, mname, 0, a, kw)
+            return self.run_hooks(realresult, mname, 0, a, kw)
         wrapper.func_name = 'wrapper_for_%s' % mname
         return wrapper
 
+    def run_hooks(self, realresult, mname, start, a, kw, hooks=None):
+        """
+        Call the plugin hooks registered for mname, starting at index start,
+        in order. Stays synchronous as long as every hook returns a plain
+        value; once one returns a Deferred, the rest are chained onto it and
+        that Deferred is returned instead. Either way, the eventual result is
+        realresult.
+        """
+
+        if hooks is None:
+            hooks = self.service.dispatcher.hooks_for(mname)
+        for i in xrange(start, len(hooks)):
+            plugin, hook = hooks[i]
+            try:
+                res = hook(self, *a, **kw)
+            except Exception:
+                log.err(None, 'Exception in plugin %s for method %r'
+                              % (plugin.name(), mname))
+                continue
+            if isinstance(res, defer.Deferred):
+                res.addErrback(log.err, 'Exception in plugin %s for method %r'
+                                        % (plugin.name(), mname))
+                res.addCallback(lambda _, i=i:
+                                self.run_hooks(realresult, mname, i + 1, a, kw, hooks))
+                return res
+        return realresult
+
     def add_channel(self, channel):
         self.channels.add(channel)
 
     def leave_channel(self, channel):
         self.channels.discard(channel)
         removekey(self.topic_map, channel)
-        removekey(self.chan_modemap, channel)
         removekey(self.is_channel_synced, channel)
-        removekey(self.channel_memberships, channel)
+        self.memberships.drop_channel(channel)
 
     def dispatch_command(self, user, channel, cmd, args):
         cmd = cmd.lower().replace('-', '_')
+        sched = self.service.command_scheduler
+        nick = (self.network.name, user.split('!', 1)[0])
+        # unknown commands count too, or they could be used to flood the
+        # channel with "command not found" replies
+        if not sched.allow(nick):
+            if sched.should_warn(nick):
+                return self.address_msg(user, channel, "You're sending commands too fast; "
+                                                       "ignoring them for a bit.")
+            return
         mname = 'command_' + cmd
-        dlist = []
+        handlers = []
         for p in self.service.command_map.get(cmd, ()):
             try:
-                pluginmethod = getattr(p, mname)
+                handlers.append((p, getattr(p, mname)))
             except AttributeError:
                 continue
-            d = defer.maybeDeferred(pluginmethod, self, user, channel, args)
-            d.addErrback(self.handle_command_error, p, user, channel, cmd, args)
-            dlist.append(d)
-        if len(dlist) == 0:
+        if len(handlers) == 0:
             return self.command_not_found(user, channel, cmd)
+        dlist = []
+        for p, pluginmethod in handlers:
+            deadline = getattr(pluginmethod, 'deadline', sched.default_deadline)
+            d = sched.run(cmd, nick, deadline, self.service.hook_runner(pluginmethod),
+                          self, user, channel, args)
+            d.addErrback(self.handle_command_error, p, user, channel, cmd, args, deadline)
+            dlist.append(d)
         return defer.DeferredList(dlist)
 
-    def handle_command_error(self, err, plugin, user, channel, cmd, args):
+    def handle_command_error(self, err, plugin, user, channel, cmd, args, deadline=None):
+        if err.check(defer.CancelledError):
+            log.msg('Plugin %s took longer than %ss in %r command; cancelled it'
+                    % (plugin.name(), deadline, cmd))
+            return self.address_msg(user, channel, "The %r command took longer than %ss; "
+                                                   "gave up on it." % (cmd, deadline))
         log.err(err, "Exception in plugin %s while in %r command"
                      % (plugin.name(), cmd))
         return self.address_msg(user, channel,
                                 "Error in the %r command: %s" % (cmd, err.value))
 
-    @defer.inlineCallbacks
-    def address_msg(self, user, channel, msg, prefix=True):
+    def get_send_scheduler(self):
+        if self.send_scheduler is None:
+            self.send_scheduler = SendScheduler(self.msg, self.service.reactor,
+                                                rate=self.send_rate,
+                                                burst=self.send_burst,
+                                                joiner=self.send_joiner,
+                                                max_line=self.send_max_line)
+        return self.send_scheduler
+
+    def get_rejoin_scheduler(self):
+        if self.rejoin_scheduler is None:
+            self.rejoin_scheduler = RejoinScheduler(self.join_batch, self.requestChannelMode,
+                                                    self.service.reactor,
+                                                    rate=self.join_rate,
+                                                    burst=self.join_burst,
+                                                    max_line=self.send_max_line,
+                                                    on_complete=self.allChannelsSynced)
+        return self.rejoin_scheduler
+
+    def resync_progress(self):
+        """
+        How far rejoining the configured channels has got since signing on;
+        see RejoinScheduler.progress.
+        """
+
+        return self.get_rejoin_scheduler().progress()
+
+    def queue_msg(self, dest, msg, priority=PRIORITY_BULK):
+        """
+        Send msg (possibly multiple lines) to dest through the outbound
+        flood-control queue. Returns immediately; the lines go out as the
+        token bucket allows.
+        """
+
+        sched = self.get_send_scheduler()
+        for line in msg.split('\n'):
+            sched.enqueue(dest, line, priority)
+
+    def address_msg(self, user, channel, msg, prefix=True, priority=PRIORITY_REPLY):
         if '!' in user:
             user = user.split('!', 1)[0]
-        transform = lambda m:m
         if channel == self.nickname:
             channel = user
         elif prefix:
-            transform = lambda m: '%s: %s' % (user, m)
-        for line in msg.split('\n'):
-            yield self.msg(channel, transform(line))
+            msg = '\n'.join('%s: %s' % (user, m) for m in msg.split('\n'))
+        self.queue_msg(channel, msg, priority=priority)
+        return defer.succeed(None)
 
     def command_not_found(self, user, channel, cmd):
         return self.address_msg(user, channel, "Sorry, I don't understand '%s'. :(" % cmd)
@@ -304,32 +1539,41 @@ class CassBotCore(irc.IRCClient):
         self.available_umodes = umodes
         self.available_cmodes = cmodes
 
+    def isupport(self, options):
+        targmax = self.supported.getFeature('TARGMAX', {}).get('JOIN')
+        if targmax:
+            sched = self.get_rejoin_scheduler()
+            sched.max_targets = min(RejoinScheduler.max_targets, targmax)
+
     def yourHost(self, info):
         self.serverdaemon_info = info
 
     def luserMe(self, info):
         self.serverhost_info = info
 
+    def get_command_parser(self):
+        if self.command_parser is None \
+                or self.command_parser.key != (self.nickname, self.cmd_prefix):
+            self.command_parser = CommandParser(self.nickname, self.cmd_prefix)
+        return self.command_parser
+
     def privmsg(self, user, channel, message):
-        cmdstr = None
-        if channel == self.nickname:
-            cmdstr = message
-        if message.startswith('%s:' % (self.nickname,)):
-            cmdstr = message[len(self.nickname)+1:]
-        elif self.cmd_prefix is not None and message.startswith(self.cmd_prefix):
-            cmdstr = message[len(self.cmd_prefix):]
-        if cmdstr is not None:
-            parts = shlex.split(cmdstr.strip())
-            cmd = parts[0]
-            args = parts[1:]
-            self.dispatch_command(user, channel, cmd, args)
+        try:
+            parts = self.get_command_parser().parse(message, private=(channel == self.nickname))
+        except CommandSyntaxError, e:
+            self.address_msg(user, channel, "Sorry, I couldn't parse that: %s." % e)
+            return
+        if parts:
+            self.dispatch_command(user, channel, parts[0], parts[1:])
 
     def joined(self, channel):
-        self.channel_memberships[channel] = set()
+        self.memberships.drop_channel(channel)
+        self.memberships.channel(channel)
         self.is_channel_synced[channel] = False
         self.add_channel(channel)
         self.join_channels.add(channel)
-        self.requestChannelMode(channel)
+        # the names list is on its way; the mode can wait its turn
+        self.get_rejoin_scheduler().query_mode(channel)
 
     def leave(self, channel, reason=None):
         self.join_channels.discard(channel)
@@ -337,11 +1581,14 @@ class CassBotCore(irc.IRCClient):
 
     def left(self, channel):
         self.leave_channel(channel)
+        self.get_rejoin_scheduler().forget(channel)
 
     def kickedFrom(self, channel, kicker, message):
         self.leave_channel(channel)
+        sched = self.get_rejoin_scheduler()
+        sched.forget(channel)
         if channel in self.join_channels:
-            self.join(channel)
+            sched.join(channel)
 
     def modeChanged(self, user, channel, beingset, modes, args):
         if len(args) == 0:
@@ -364,49 +1611,45 @@ class CassBotCore(irc.IRCClient):
             removekey(self.server_modemap[user], mode)
 
     def channelModeChanged(self, user, channel, beingset, mode, arg):
-        modeset = self.chan_modemap.setdefault(channel, {}).setdefault(arg, set())
-        if beingset:
-            modeset.add(mode)
-        else:
-            modeset.discard(mode)
+        self.memberships.set_mode(channel, arg, mode, beingset)
 
     def signedOn(self):
         self.factory.prot = self
         self.factory.resetDelay()
-        for chan in self.join_channels:
-            self.join(chan)
+        self.get_rejoin_scheduler().start(self.join_channels)
         self.is_signed_on = True
         self.sign_on_time = time.time()
         self.pinglooper = task.LoopingCall(self.pingServer)
         self.pinglooper.start(self.ping_interval, now=False)
 
     def userJoined(self, user, channel):
-        self.channel_memberships.setdefault(channel, set()).add(user)
+        self.memberships.join(channel, user)
 
     def userLeft(self, user, channel):
-        self.channel_memberships.setdefault(channel, set()).discard(user)
-        removekey(self.chan_modemap.get(channel, {}), user)
+        self.memberships.part(channel, user)
 
     def userKicked(self, kickee, channel, kicker, message):
         self.userLeft(kickee, channel)
 
-    def userQuit(self, user, channel):
-        self.userLeft(user, channel)
+    def userQuit(self, user, quitMessage):
+        self.memberships.quit(user)
         self.server_modemap.pop(user, None)
 
     def chanSynced(self, channel):
         self.is_channel_synced[channel] = True
+        self.get_rejoin_scheduler().synced(channel)
+
+    def allChannelsSynced(self, synced, failed):
+        elapsed = self.get_rejoin_scheduler().progress()['elapsed']
+        log.msg('Synced %d channels in %.1fs%s'
+                % (len(synced), elapsed,
+                   '; could not join %s' % ', '.join(failed) if failed else ''))
 
     def topicUpdated(self, user, channel, newTopic):
         self.topic_map[channel] = newTopic
 
     def userRenamed(self, oldname, newname):
-        for cm in self.channel_memberships.itervalues():
-            if oldname in cm:
-                cm.add(newname)
-                cm.remove(oldname)
-        for modemap in self.chan_modemap.itervalues():
-            modemap[newname] = modemap.pop(oldname, set())
+        self.memberships.rename(oldname, newname)
         modes = self.server_modemap.pop(oldname, None)
         if modes:
             self.server_modemap[newname] = modes
@@ -420,6 +1663,12 @@ class CassBotCore(irc.IRCClient):
         if self.pinglooper is not None:
             self.pinglooper.stop()
             self.pinglooper = None
+        if self.send_scheduler is not None:
+            self.send_scheduler.stop()
+            self.send_scheduler = None
+        if self.rejoin_scheduler is not None:
+            self.rejoin_scheduler.stop()
+            self.rejoin_scheduler = None
         return irc.IRCClient.connectionLost(self, reason)
 
     def pingServer(self):
@@ -432,16 +1681,18 @@ class CassBotCore(irc.IRCClient):
 
     def irc_RPL_NAMREPLY(self, prefix, params):
         channel, nlist = params[-2:]
-        memb = self.channel_memberships.setdefault(channel, set())
-        chanmap = self.chan_modemap.setdefault(channel, {})
+        memb = self.memberships
         for name in nlist.split():
+            modes = []
             if name.startswith('@'):
                 name = name[1:]
-                self.modeChanged(None, channel, True, 'o', (name,))
+                modes.append('o')
             if name.startswith('+'):
                 name = name[1:]
-                self.modeChanged(None, channel, True, 'v', (name,))
-            memb.add(name)
+                modes.append('v')
+            memb.join(channel, name)
+            for m in modes:
+                self.modeChanged(None, channel, True, m, (name,))
 
     def irc_RPL_ENDOFNAMES(self, prefix, params):
         channel = params[-2]
@@ -460,6 +1711,22 @@ class CassBotCore(irc.IRCClient):
     def requestChannelMode(self, channel):
         self.sendLine('MODE %s' % channel)
 
+    def join_batch(self, channels):
+        self.sendLine('JOIN %s' % ','.join(channels))
+
+    def irc_join_refused(self, prefix, params):
+        channel = params[1]
+        log.msg('Could not join %s: %s' % (channel, params[-1]))
+        self.get_rejoin_scheduler().failed(channel)
+
+    irc_ERR_NOSUCHCHANNEL = irc_join_refused
+    irc_ERR_TOOMANYCHANNELS = irc_join_refused
+    irc_ERR_CHANNELISFULL = irc_join_refused
+    irc_ERR_INVITEONLYCHAN = irc_join_refused
+    irc_ERR_BANNEDFROMCHAN = irc_join_refused
+    irc_ERR_BADCHANNELKEY = irc_join_refused
+    irc_ERR_BADCHANMASK = irc_join_refused
+
 def splituser(user):
     parts = user.split('!', 1)
     if len(parts) == 1:
@@ -474,34 +1741,248 @@ def mask_matches(mask, user):
     uparts = splituser(user)
     return all(imap(fnmatch, uparts, mparts))
 
+def joinuser(user):
+    """
+    Flatten a user into the string that regexes from mask_regex are
+    matched against: nick, user and host separated by NULs.
+    """
+    return '\0'.join(splituser(user))
 
-class AuthMap:
-    def __init__(self):
-        self.memberships = {}
-        self.per_channel = {}
+def glob_to_regex(pat):
+    """
+    Translate a shell-style wildcard pattern, as understood by fnmatch, into
+    a regex fragment. Wildcards never match NUL, so that a fragment can't
+    spill over into the next part of a joinuser() string.
+    """
 
-    def addPriv(self, mask, privname):
-        self.memberships.setdefault(privname, set()).add(mask)
+    i, n = 0, len(pat)
+    res = []
+    while i < n:
+        c = pat[i]
+        i += 1
+        if c == '*':
+            res.append('[^\\x00]*')
+        elif c == '?':
+            res.append('[^\\x00]')
+        elif c == '[':
+            j = i
+            if j < n and pat[j] == '!':
+                j += 1
+            if j < n and pat[j] == ']':
+                j += 1
+            while j < n and pat[j] != ']':
+                j += 1
+            if j >= n:
+                res.append('\\[')
+            else:
+                stuff = pat[i:j].replace('\\', '\\\\')
+                i = j + 1
+                if stuff[0] == '!':
+                    stuff = '^\\x00' + stuff[1:]
+                elif stuff[0] == '^':
+                    stuff = '\\' + stuff
+                res.append('[%s]' % stuff)
+        else:
+            res.append(re.escape(c))
+    return ''.join(res)
+
+def escape_glob(text):
+    """
+    Make a wildcard pattern which matches only the given text, even if it
+    has characters like '[' or '?' in it (as some nicks do).
+    """
+
+    return re.sub(r'([*?[])', r'[\1]', text)
+
+def mask_regex(masks):
+    """
+    Compile a collection of nick!user@host masks into one regex which
+    matches joinuser(user) exactly when mask_matches(mask, user) would be
+    true for at least one of the masks. Returns None for no masks.
+    """
+
+    alternatives = ['\\x00'.join(imap(glob_to_regex, splituser(m))) for m in masks]
+    if not alternatives:
+        return None
+    return re.compile('(?:%s)\\Z' % '|'.join(alternatives))
+
+
+_missing = object()
+
+class LRUCache:
+    """
+    Small bounded mapping that forgets the least recently used entries
+    once it holds more than maxsize of them.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            return default
+        self.data[key] = value
+        return value
+
+    def put(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.data.pop(key, default)
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+class MaskSet:
+    """
+    A set of nick!user@host masks, compiled into a single matcher. Answers
+    for individual users are remembered (up to cache_size of them) until the
+    set changes, so checking a busy channel's traffic against a long ignore
+    list costs about the same as checking against a short one.
+
+    Should only be changed through add/discard/update, so that it knows to
+    recompile.
+    """
+
+    cache_size = 4096
+
+    def __init__(self, masks=()):
+        self.masks = set(masks)
+        self.recompile()
+
+    def recompile(self):
+        self.matcher = mask_regex(self.masks)
+        self.verdicts = LRUCache(self.cache_size)
+
+    def add(self, mask):
+        if mask not in self.masks:
+            self.masks.add(mask)
+            self.recompile()
+
+    def discard(self, mask):
+        if mask in self.masks:
+            self.masks.discard(mask)
+            self.recompile()
+
+    def update(self, masks):
+        self.masks.update(masks)
+        self.recompile()
+
+    def matches(self, user):
+        """
+        Return True if the given user matches any of the masks in this set.
+        """
+
+        if self.matcher is None:
+            return False
+        verdict = self.verdicts.get(user, _missing)
+        if verdict is _missing:
+            verdict = self.matcher.match(joinuser(user)) is not None
+            self.verdicts.put(user, verdict)
+        return verdict
+
+    def __contains__(self, mask):
+        return mask in self.masks
+
+    def __iter__(self):
+        return iter(self.masks)
+
+    def __len__(self):
+        return len(self.masks)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, sorted(self.masks))
+
+
+class AuthMap:
+    """
+    Maps privilege names to the masks (or other privilege names) that have
+    them. userHas() answers from a compiled index: each privilege's
+    inheritance graph is flattened into a single regex over every mask
+    reachable from it, the first time that privilege is asked about, and
+    recent (user, privilege) answers are kept in an LRU. Both are thrown
+    away whenever the memberships change.
+    """
+
+    cache_size = 1024
+
+    # the changes that can be recorded in, and replayed from, the journal
+    journaled_ops = ('addPriv', 'removePriv', 'addChannelPriv', 'removeChannelPriv')
+
+    def __init__(self):
+        self.memberships = {}
+        self.per_channel = {}
+        # if set, called with a tuple (opname, args...) for every change
+        self.journal = None
+        self.invalidate()
+
+    def invalidate(self):
+        self.compiled = {}
+        self.results = LRUCache(self.cache_size)
+
+    def record(self, *change):
+        if self.journal is not None:
+            self.journal(change)
+
+    def replay(self, change):
+        opname = change[0]
+        if opname not in self.journaled_ops:
+            raise ValueError('Unknown AuthMap operation %r in journal' % (opname,))
+        getattr(self, opname)(*change[1:])
+
+    def addPriv(self, mask, privname):
+        self.memberships.setdefault(privname, set()).add(mask)
+        self.invalidate()
+        self.record('addPriv', mask, privname)
 
     def removePriv(self, mask, privname):
         try:
             self.memberships[privname].remove(mask)
         except KeyError:
             pass
+        self.invalidate()
+        self.record('removePriv', mask, privname)
 
-    def userHas(self, user, privname, skip=set()):
-        members = self.whoHas(privname)
-        for mask in members:
-            if mask_matches(mask, user):
-                return True
-        # avoid circular paths
-        newskip = skip | set(members)
-        for m in members:
-            if m in skip:
-                continue
-            if self.userHas(user, m, skip=newskip):
-                return True
-        return False
+    def reachable(self, privname):
+        """
+        Everything that is a member of privname, directly or through other
+        privileges. Cycles are fine.
+        """
+
+        seen = set()
+        stack = [privname]
+        while stack:
+            for m in self.memberships.get(stack.pop(), ()):
+                if m not in seen:
+                    seen.add(m)
+                    stack.append(m)
+        return seen
+
+    def matcher_for(self, privname):
+        try:
+            return self.compiled[privname]
+        except KeyError:
+            matcher = self.compiled[privname] = mask_regex(self.reachable(privname))
+            return matcher
+
+    def userHas(self, user, privname):
+        key = (user, privname)
+        result = self.results.get(key, _missing)
+        if result is _missing:
+            matcher = self.matcher_for(privname)
+            result = matcher is not None and matcher.match(joinuser(user)) is not None
+            self.results.put(key, result)
+        return result
 
     def whoHas(self, privname):
         return self.memberships.get(privname, ())
@@ -517,11 +1998,11 @@ class AuthMap:
         return wrap
 
     @_for_channels
-    def addChannelPriv(self, c, mask, privname):
+    def _addChannelPriv(self, c, mask, privname):
         return c.addPriv(mask, privname)
 
     @_for_channels
-    def removeChannelPriv(self, c, mask, privname):
+    def _removeChannelPriv(self, c, mask, privname):
         return c.removePriv(mask, privname)
 
     @_for_channels
@@ -534,8 +2015,16 @@ class AuthMap:
 
     del _for_channels
 
+    def addChannelPriv(self, channel, mask, privname):
+        self._addChannelPriv(channel, mask, privname)
+        self.record('addChannelPriv', channel, mask, privname)
+
+    def removeChannelPriv(self, channel, mask, privname):
+        self._removeChannelPriv(channel, mask, privname)
+        self.record('removeChannelPriv', channel, mask, privname)
+
     def saveState(self):
-        return (self.memberships,
+        return (dict((k, set(v)) for (k, v) in self.memberships.iteritems()),
                 dict((k, v.saveState()) for (k, v) in self.per_channel.iteritems()
                                         if v.memberships))
 
@@ -545,6 +2034,355 @@ class AuthMap:
         for k, v in per_chan_info.iteritems():
             self.per_channel[k] = c = AuthMap()
             c.loadState(v)
+        self.invalidate()
+
+
+class PluginRegistry:
+    """
+    Remembers the plugin classes found by twisted.plugin.getPlugins, keyed
+    by plugin name, and only asks getPlugins again when a module file in
+    the plugin package has been added, removed or touched since the last
+    time (or when invalidate() is called, e.g. after a module reload).
+    """
+
+    def __init__(self, package=cassbot_plugins):
+        self.package = package
+        self.classes = OrderedDict()
+        self.mtimes = None
+
+    def module_mtimes(self):
+        mtimes = {}
+        for path in self.package.__path__:
+            try:
+                names = os.listdir(path)
+            except OSError:
+                continue
+            for name in names:
+                if name.endswith('.py'):
+                    fullpath = os.path.join(path, name)
+                    try:
+                        mtimes[fullpath] = os.stat(fullpath).st_mtime
+                    except OSError:
+                        pass
+        return mtimes
+
+    def invalidate(self):
+        self.mtimes = None
+
+    def refresh(self):
+        mtimes = self.module_mtimes()
+        if mtimes == self.mtimes:
+            return
+        classes = OrderedDict()
+        for p in getPlugins(IBotPlugin, self.package):
+            if p is not BaseBotPlugin:
+                classes[p.name()] = p
+        self.classes = classes
+        self.mtimes = mtimes
+
+    def get_plugin_classes(self):
+        self.refresh()
+        return self.classes.values()
+
+
+# bump when the layout of the state file changes incompatibly
+STATE_FORMAT_VERSION = 1
+# pickle protocol 2 can be read by any python from 2.3 on, unlike -1
+STATE_PICKLE_PROTOCOL = 2
+SQLITE_MAGIC = 'SQLite format 3\x00'
+
+
+class StateStore:
+    """
+    The state file: an sqlite database holding the bot state in separate
+    sections (the core settings, the channel list, the auth map, and one
+    section per plugin), each pickled on its own. Sections are only read
+    when asked for, so a plugin's state is not even unpickled unless the
+    plugin gets loaded, and one unreadable section doesn't spoil the rest.
+
+    Each sqlite connection must stay in the thread that made it, so the
+    writing done by background saves uses a StateStore of its own.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.text_factory = str
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version > STATE_FORMAT_VERSION:
+            self.db.close()
+            raise ValueError('%s is in state format %d; this cassbot only knows up to %d'
+                             % (path, version, STATE_FORMAT_VERSION))
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS sections '
+                            '(name TEXT PRIMARY KEY, version INTEGER, data BLOB)')
+            self.db.execute('PRAGMA user_version = %d' % STATE_FORMAT_VERSION)
+
+    @staticmethod
+    def is_store(path):
+        with open(path, 'rb') as sfile:
+            return sfile.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+    def read(self, name, default=None):
+        """
+        Return the unpickled contents of the named section, or default if
+        there is no such section. Raises ValueError if it can't be read.
+        """
+
+        row = self.db.execute('SELECT version, data FROM sections WHERE name = ?',
+                              (name,)).fetchone()
+        if row is None:
+            return default
+        version, data = row
+        if version > STATE_FORMAT_VERSION:
+            raise ValueError('section %r is in unknown format %d' % (name, version))
+        try:
+            return pickle.loads(str(data))
+        except Exception, e:
+            raise ValueError('section %r is corrupt: %s' % (name, e))
+
+    def names(self):
+        return [row[0] for row in self.db.execute('SELECT name FROM sections')]
+
+    def update(self, sections, removed=()):
+        """
+        Store each (name, value) pair in sections, and delete the sections
+        named in removed, all in one transaction.
+        """
+
+        rows = [(name, STATE_FORMAT_VERSION,
+                 sqlite3.Binary(pickle.dumps(value, STATE_PICKLE_PROTOCOL)))
+                for (name, value) in sections]
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO sections (name, version, data) '
+                                'VALUES (?, ?, ?)', rows)
+            self.db.executemany('DELETE FROM sections WHERE name = ?',
+                                [(name,) for name in removed])
+
+    def close(self):
+        self.db.close()
+
+
+class PluginStates:
+    """
+    Saved plugin states by plugin name, for CassBotService.state['plugins'].
+    Anything not set here since loading is fetched from the state file
+    section 'plugin:<name>' on first access. copy() is cheap and doesn't
+    read anything; the copy only knows which states are in memory and
+    which have been removed, which is all a save needs.
+    """
+
+    def __init__(self, store=None, states=None):
+        self.store = store
+        self.states = dict(states or {})
+        self.removed = set()
+
+    def section(self, pname):
+        return 'plugin:' + pname
+
+    def get(self, pname, default=None):
+        try:
+            return self.states[pname]
+        except KeyError:
+            pass
+        if self.store is None or pname in self.removed:
+            return default
+        try:
+            pstate = self.store.read(self.section(pname), _missing)
+        except Exception:
+            log.err(None, 'Reading saved state for plugin %s; starting it without' % pname)
+            return default
+        if pstate is _missing:
+            return default
+        self.states[pname] = pstate
+        return pstate
+
+    def __getitem__(self, pname):
+        pstate = self.get(pname, _missing)
+        if pstate is _missing:
+            raise KeyError(pname)
+        return pstate
+
+    def __setitem__(self, pname, pstate):
+        self.states[pname] = pstate
+        self.removed.discard(pname)
+
+    def pop(self, pname, default=None):
+        self.removed.add(pname)
+        return self.states.pop(pname, default)
+
+    def copy(self):
+        c = PluginStates(self.store, self.states)
+        c.removed = set(self.removed)
+        return c
+
+    def read_all(self):
+        """
+        Read in every plugin state from the state file that isn't in memory
+        yet, so that all of them get saved even to a different file.
+        """
+
+        if self.store is None:
+            return
+        prefix = self.section('')
+        for name in self.store.names():
+            if name.startswith(prefix):
+                self.get(name[len(prefix):])
+
+    def sections(self):
+        return [(self.section(pname), pstate) for (pname, pstate) in self.states.iteritems()]
+
+    def removed_sections(self):
+        return [self.section(pname) for pname in self.removed]
+
+
+def read_state_file(statefile):
+    """
+    Open the state file and return the core state dict, with the channel
+    list and auth map read in, and the plugin states to be read as needed.
+    Raises IOError if there is no state file, and ValueError if the core
+    section can't be read. State files from older versions, which were
+    one big pickle, are read whole.
+    """
+
+    if not StateStore.is_store(statefile):
+        with open(statefile, 'rb') as sfile:
+            state = pickle.load(sfile)
+        state['plugins'] = PluginStates(None, state.get('plugins'))
+        return state
+    try:
+        store = StateStore(statefile)
+    except sqlite3.DatabaseError, e:
+        raise ValueError('%s is not a usable state file: %s' % (statefile, e))
+    try:
+        state = store.read('core')
+    except (ValueError, sqlite3.DatabaseError), e:
+        store.close()
+        raise ValueError('Reading core state from %s: %s' % (statefile, e))
+    if state is None:
+        store.close()
+        raise ValueError('%s has no core state section' % statefile)
+    for name, key in (('channels', 'channels'), ('auth', 'auth_map')):
+        try:
+            state[key] = store.read(name)
+        except (ValueError, sqlite3.DatabaseError):
+            log.err(None, 'Reading %s from %s' % (name, statefile))
+    state['plugins'] = PluginStates(store)
+    return state
+
+
+def write_state_file(state, statefile):
+    """
+    Save a state snapshot (as returned by CassBotService.snapshot_state)
+    to statefile, in one transaction. Plugin states which were never
+    loaded are left alone. A state file in the old single-pickle format
+    is moved aside to statefile.pickle-old first.
+    """
+
+    if os.path.exists(statefile) and not StateStore.is_store(statefile):
+        os.rename(statefile, statefile + '.pickle-old')
+    state = dict(state)
+    plugins = state.pop('plugins')
+    sections = [('channels', state.pop('channels', set())),
+                ('auth', state.pop('auth_map', None))]
+    sections.append(('core', state))
+    sections.extend(plugins.sections())
+    store = StateStore(statefile)
+    try:
+        store.update(sections, plugins.removed_sections())
+    finally:
+        store.close()
+
+
+class StateJournal:
+    """
+    Append-only log of the small state changes (new privileges, blacklist
+    entries, etc) made since the last full snapshot of the state file, so
+    that they survive a crash without the whole state being pickled again
+    for each one.
+
+    Records are pickled one after another into statefile.journal.N. Each
+    snapshot starts a new N and remembers it as 'journal_seq', so loading
+    only has to replay the journals from that one on, and the older ones
+    can be deleted once the snapshot is safely written.
+    """
+
+    def __init__(self, statefile):
+        self.statefile = statefile
+        self.seq = None
+        self.jfile = None
+
+    def path(self, seq):
+        return '%s.journal.%d' % (self.statefile, seq)
+
+    def existing(self):
+        """
+        Return the sequence numbers of the journal files on disk, in order.
+        """
+
+        dirname, basename = os.path.split(os.path.abspath(self.statefile))
+        prefix = basename + '.journal.'
+        try:
+            names = os.listdir(dirname)
+        except OSError:
+            return []
+        return sorted(int(name[len(prefix):]) for name in names
+                      if name.startswith(prefix) and name[len(prefix):].isdigit())
+
+    def read(self, from_seq=0):
+        """
+        Yield every record in the journal files numbered from_seq or later,
+        in the order they were written. A record cut short by a crash ends
+        its file.
+        """
+
+        for seq in self.existing():
+            if seq < from_seq:
+                continue
+            with open(self.path(seq), 'rb') as jfile:
+                while True:
+                    try:
+                        record = pickle.load(jfile)
+                    except EOFError:
+                        break
+                    except Exception:
+                        log.err(None, 'Bad record in %s; ignoring the rest of it'
+                                      % self.path(seq))
+                        break
+                    yield record
+
+    def start(self, seq):
+        self.close()
+        self.jfile = open(self.path(seq), 'ab')
+        self.seq = seq
+
+    def rotate(self):
+        """
+        Start appending to a new journal file, and return its number.
+        """
+
+        self.start(self.seq + 1)
+        return self.seq
+
+    def append(self, record):
+        pickle.dump(record, self.jfile, STATE_PICKLE_PROTOCOL)
+        self.jfile.flush()
+
+    def size(self):
+        return self.jfile.tell()
+
+    def discard_before(self, seq):
+        for old in self.existing():
+            if old < seq:
+                try:
+                    os.unlink(self.path(old))
+                except OSError:
+                    log.err(None, 'Removing old journal %s' % self.path(old))
+
+    def close(self):
+        if self.jfile is not None:
+            self.jfile.close()
+            self.jfile = None
 
 
 class CassBotFactory(protocol.ReconnectingClientFactory):
@@ -552,21 +2390,128 @@ class CassBotFactory(protocol.ReconnectingClientFactory):
 
     def buildProtocol(self, addr):
         p = protocol.ReconnectingClientFactory.buildProtocol(self, addr)
-        self.service.initialize_proto_state(p)
+        self.network.initialize_proto_state(p)
+        connection_events.labels(self.network.name, 'made').inc()
         return p
 
     def clientConnectionFailed(self, connector, reason):
         log.err(reason, 'Connection failed')
+        connection_events.labels(self.network.name, 'failed').inc()
         protocol.ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
 
     def clientConnectionLost(self, connector, reason):
-        log.err(reason, 'Connection lost')
+        if self.continueTrying:
+            log.err(reason, 'Connection lost')
+        else:
+            # disconnected on purpose
+            log.msg('Disconnected: %s' % reason.getErrorMessage())
+        connection_events.labels(self.network.name, 'lost').inc()
         protocol.ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
 
+# the name of the network a CassBotService is created with
+PRIMARY_NETWORK = 'main'
+
+class IRCNetwork:
+    """
+    One connection kept up by a CassBotService. Plugins and saved state
+    belong to the service and are shared by all of its networks; each
+    network has its own endpoint, its own nickname, command prefix, channel
+    list and privileges (its part of the saved state), and its own bot
+    protocol instance, which tracks the channels and users it sees. Nicks
+    on one network say nothing about who is who on another, so privileges
+    are never shared between them.
+    """
+
+    protocol_factory_class = CassBotFactory
+
+    def __init__(self, service, name, desc, nickname='cassbot', init_channels=(),
+                 cmd_prefix=None):
+        self.service = service
+        self.name = name
+        self.endpoint_desc = desc
+        # for a network with no saved state yet
+        self.defaults = {
+            'nickname': nickname,
+            'channels': set(init_channels),
+            'cmd_prefix': cmd_prefix,
+        }
+        self.auth = AuthMap()
+        self.setupConnectionParams(desc)
+
+    def setupConnectionParams(self, desc):
+        self.endpoint = endpoints.clientFromString(self.service.reactor, desc)
+        self.pfactory = self.protocol_factory_class()
+
+    def get_state(self):
+        return self.service.network_state(self)
+
+    def load_auth_state(self):
+        auth_dat = self.get_state().get('auth_map')
+        if auth_dat is not None:
+            self.auth.loadState(auth_dat)
+
+    def connect(self):
+        self.pfactory.service = self.service
+        self.pfactory.network = self
+        connect_endpoint_without_fuss(self.service.reactor, self.endpoint, self.pfactory)
+
+    def disconnect(self):
+        self.pfactory.stopTrying()
+        try:
+            self.getbot().transport.loseConnection()
+        except AttributeError:
+            pass
+        self.pfactory.service = None
+
+    def getbot(self):
+        return getattr(self.pfactory, 'prot', None)
+
+    def join(self, channelname, channelkey=None):
+        bot = self.getbot()
+        self.get_state().setdefault('channels', set()).add(channelname)
+        if bot is not None:
+            return bot.join(channelname, key=channelkey)
+
+    def leave(self, channelname, reason=None):
+        bot = self.getbot()
+        self.get_state().get('channels', set()).discard(channelname)
+        if bot is not None:
+            return bot.leave(channelname, reason=reason)
+
+    def initialize_proto_state(self, proto):
+        state = self.get_state()
+        proto.nickname = state['nickname']
+        proto.join_channels = state.setdefault('channels', set())
+        proto.cmd_prefix = state.get('cmd_prefix', None)
+        proto.send_rate = state.get('send_rate', proto.send_rate)
+        proto.send_burst = state.get('send_burst', proto.send_burst)
+        proto.join_rate = state.get('join_rate', proto.join_rate)
+        proto.join_burst = state.get('join_burst', proto.join_burst)
+        proto.service = self.service
+        proto.network = self
+
+    def __str__(self):
+        return '%s [%s]%s' % (self.name, self.endpoint_desc,
+                              ' (connected)' if self.getbot() is not None else '')
+
+
 class CassBotService(service.MultiService):
     plugin_scan_period = 240
     default_statefile = 'cassbot.state.db'
-    protocol_factory_class = CassBotFactory
+    autosave_period = 600
+    # once the journal grows past this many bytes, fold it into a new snapshot
+    journal_compact_size = 256 * 1024
+    # threads for @off_reactor plugin methods and run_off_reactor
+    plugin_pool_size = 4
+    # log when the reactor is kept busy longer than this many seconds
+    stall_threshold = 0.25
+    # time one in this many calls to each plugin hook; timing every one
+    # would cost about as much as dispatching it
+    hook_sample_every = 64
+    # serve metrics over http on this port (on metrics_interface only)
+    metrics_port = None
+    metrics_interface = '127.0.0.1'
+    network_class = IRCNetwork
 
     def __init__(self, desc, nickname='cassbot', init_channels=(), reactor=None,
                  statefile=None):
@@ -577,19 +2522,47 @@ class CassBotService(service.MultiService):
             'nickname': nickname,
             'channels': set(init_channels),
             'cmd_prefix': None,
-            'plugins': {},
+            'plugins': PluginStates(),
         }
-        self.auth = AuthMap()
 
         if reactor is None:
             from twisted.internet import reactor
         self.reactor = reactor
 
+        # shared by all plugins that talk http
+        self.http = webclient.shared_client(reactor)
+        self.command_scheduler = CommandScheduler(reactor)
+        self.plugin_pool = PluginThreadPool(reactor, self.plugin_pool_size)
+        self.watchdog = ReactorWatchdog(reactor, self.stall_threshold)
+        # per-plugin hook timings; off until an admin turns it on
+        self.profiler = HookProfiler(reactor)
+
+        # every connection this service keeps up, by name; the first one
+        # (the primary network) keeps its settings at the top level of the
+        # state, for compatibility with single-network state files
+        self.networks = OrderedDict()
         self.setupConnectionParams(desc)
+        # the primary network's privileges, which were the only ones before
+        # there could be more than one network
+        self.auth = self.primary.auth
 
         self.watcher_map = {}
         self.command_map = {}
+        self.dispatcher = HookDispatcher(wrap=self.hook_runner)
+        self.plugin_registry = PluginRegistry()
         self.scanning_now = False
+        self.batch_depth = 0
+        self.scan_pending = False
+
+        self.save_lock = defer.DeferredLock()
+        self.autosaver = task.LoopingCall(self.autosave)
+        self.autosaver.clock = self.reactor
+
+        # opened by startService, once the last snapshot has been loaded
+        self.journal = None
+        # journaled changes for plugins which are enabled but not loaded yet,
+        # keyed by plugin name
+        self.pending_journal = {}
 
         # all 'enabled' or 'loaded' plugins have an entry in here, keyed by
         # the plugin name (as given by the .name() classmethod).
@@ -597,45 +2570,176 @@ class CassBotService(service.MultiService):
 
     def setupConnectionParams(self, desc):
         self.endpoint_desc = desc
-        self.endpoint = endpoints.clientFromString(self.reactor, desc)
-        self.pfactory = self.protocol_factory_class()
+        self.primary = self.add_network(
+                self.network_class(self, PRIMARY_NETWORK, desc,
+                                   nickname=self.state['nickname']))
+
+    def add_network(self, network):
+        """
+        Add another connection to this service (an IRCNetwork, or some
+        subclass of it). It is connected right away if the service is
+        already running.
+        """
+
+        if network.name in self.networks:
+            raise ValueError('There is already a network named %r' % (network.name,))
+        self.networks[network.name] = network
+        if self.running:
+            network.load_auth_state()
+            if self.journal is not None:
+                network.auth.journal = self.auth_journaler(network)
+            network.connect()
+        return network
+
+    def network_state(self, network):
+        if network is self.primary:
+            return self.state
+        netstates = self.state.setdefault('networks', {})
+        try:
+            return netstates[network.name]
+        except KeyError:
+            netstate = netstates[network.name] = dict(network.defaults)
+            netstate['channels'] = set(network.defaults['channels'])
+            return netstate
 
     def setupConnection(self):
-        self.pfactory.service = self
-        connect_endpoint_without_fuss(self.reactor, self.endpoint, self.pfactory)
+        for network in self.networks.itervalues():
+            network.connect()
 
     def teardownConnection(self):
-        self.pfactory.stopTrying()
-        try:
-            self.getbot().transport.loseConnection()
-        except AttributeError:
-            pass
-        self.pfactory.service = None
+        for network in self.networks.itervalues():
+            network.disconnect()
 
     def getbot(self):
-        return getattr(self.pfactory, 'prot', None)
+        return self.primary.getbot()
+
+    def bots(self):
+        """
+        Return the bot protocol instances of all connected networks.
+        """
+
+        return [bot for bot in (n.getbot() for n in self.networks.itervalues())
+                if bot is not None]
 
     def startService(self):
         res = service.MultiService.startService(self)
         try:
             self.loadStateFromFile(self.statefile)
         except (IOError, ValueError):
-            pass
+            # no usable snapshot, but there may still be journaled changes
+            self.open_journal(self.statefile, 0)
         self.setupConnection()
+        period = self.state.get('autosave_period', self.autosave_period)
+        if period:
+            self.autosaver.start(period, now=False)
+        self.watchdog.threshold = self.state.get('stall_threshold', self.stall_threshold)
+        self.watchdog.start()
+        port = self.state.get('metrics_port', self.metrics_port)
+        if port:
+            self.start_metrics_server(port)
         return res
 
+    def start_metrics_server(self, port):
+        """
+        Serve the metrics registry at http://<metrics_interface>:port/metrics,
+        as a child service.
+        """
+
+        site = server.Site(metrics.MetricsResource(metrics.REGISTRY))
+        site.noisy = False
+        metrics_server = internet.TCPServer(port, site, interface=self.metrics_interface,
+                                            reactor=self.reactor)
+        metrics_server.setName('metrics')
+        metrics_server.setServiceParent(self)
+        return metrics_server
+
     def stopService(self):
-        self.saveStateToFile(self.statefile)
+        if self.autosaver.running:
+            self.autosaver.stop()
+        # wait for any background save in progress, so it can't clobber
+        # this one
+        d = self.save_lock.run(self.saveStateToFile, self.statefile)
+        d.addErrback(log.err, 'Saving state on shutdown')
+        d.addBoth(lambda _: self.close_journal())
+        self.watchdog.stop()
+        self.plugin_pool.stop()
         self.teardownConnection()
-        return service.MultiService.stopService(self)
+        self.http.close()
+        return defer.gatherResults([d, defer.maybeDeferred(service.MultiService.stopService, self)])
 
-    @staticmethod
-    def get_plugin_classes():
-        for p in getPlugins(IBotPlugin, cassbot_plugins):
-            if p is not BaseBotPlugin:
-                yield p
+    def get_plugin_classes(self):
+        return self.plugin_registry.get_plugin_classes()
+
+    def run_off_reactor(self, func, *a, **kw):
+        """
+        Run func(*a, **kw) in the plugin thread pool; return a Deferred
+        with the result.
+        """
+
+        return self.plugin_pool.run(func, *a, **kw)
+
+    def hook_runner(self, method):
+        """
+        Return a plugin hook or command method ready to be called by the
+        bot: the method itself, or for an @off_reactor one, a function
+        which runs it in the plugin thread pool with a ReactorProxy of the
+        bot in place of the bot. Either way, its calls are counted in the
+        cassbot_hook_calls_total metric, the time one in hook_sample_every
+        of them holds the reactor thread is recorded in
+        cassbot_hook_seconds, and while the service's profiler is enabled,
+        the method's own calls are timed by it too.
+        """
+
+        owner = getattr(method, 'im_self', None)
+        key = (owner.name() if owner is not None else '-', method.__name__)
+        calls = hook_calls.labels(*key)
+        timer = hook_seconds.labels(*key)
+        sample_every = self.hook_sample_every
+        profiler = self.profiler
+        if getattr(method, 'off_reactor', False):
+            # profile the call in the pool thread, where it actually runs
+            def profiled(*a, **kw):
+                if profiler.enabled:
+                    return profiler.measure(key, method, a, kw)
+                return method(*a, **kw)
+            def call(bot, *a, **kw):
+                return self.run_off_reactor(profiled, ReactorProxy(bot, self.reactor), *a, **kw)
+        else:
+            call = method
+        def run(*a, **kw):
+            calls.value += 1
+            if profiler.enabled and call is method:
+                return profiler.measure(key, method, a, kw)
+            if calls.value % sample_every:
+                return call(*a, **kw)
+            start = time.time()
+            try:
+                return call(*a, **kw)
+            finally:
+                timer.observe(time.time() - start)
+        return run
+
+    @contextmanager
+    def plugin_batch(self):
+        """
+        Context manager for enabling or disabling a bunch of plugins at
+        once: any plugin rescans asked for inside the block are put off
+        until the end of it, and then done only once.
+        """
+
+        self.batch_depth += 1
+        try:
+            yield
+        finally:
+            self.batch_depth -= 1
+            if self.batch_depth == 0 and self.scan_pending:
+                self.scan_plugins()
 
     def scan_plugins(self):
+        if self.batch_depth > 0:
+            self.scan_pending = True
+            return
+        self.scan_pending = False
         # wrap _really_scan_plugins, in case some callback inside
         # that method asks for another scan.
         if self.scanning_now:
@@ -679,6 +2783,7 @@ class CassBotService(service.MultiService):
             except Exception:
                 log.err(None, 'Exception in plugin %s for implementedCommands request'
                               % (p.name(),))
+        self.dispatcher.rebuild(self.watcher_map)
 
     def enable_plugin_by_name(self, pname):
         """
@@ -716,6 +2821,8 @@ class CassBotService(service.MultiService):
             if pstate:
                 log.msg('Loading state for plugin %s' % pname)
                 p.loadState(pstate)
+            for record in self.pending_journal.pop(pname, ()):
+                p.replayJournal(record)
         except Exception:
             self.pluginmap.pop(pname, None)
             deferred.errback()
@@ -743,23 +2850,14 @@ class CassBotService(service.MultiService):
                 self.state['plugins'][pname] = pstate
         self.scan_plugins()
 
-    def join(self, channelname, channelkey=None):
-        bot = self.getbot()
-        self.state.setdefault('channels', set()).add(channelname)
-        if bot is not None:
-            return bot.join(channelname, key=channelkey)
+    def join(self, channelname, channelkey=None, network=None):
+        return (network or self.primary).join(channelname, channelkey)
 
-    def leave(self, channelname, reason=None):
-        bot = self.getbot()
-        self.state.get('channels', set()).discard(channelname)
-        if bot is not None:
-            return bot.leave(channelname, reason=reason)
+    def leave(self, channelname, reason=None, network=None):
+        return (network or self.primary).leave(channelname, reason)
 
     def initialize_proto_state(self, proto):
-        proto.nickname = self.state['nickname']
-        proto.join_channels = self.state.setdefault('channels', set())
-        proto.cmd_prefix = self.state.get('cmd_prefix', None)
-        proto.service = self
+        self.primary.initialize_proto_state(proto)
 
     def initialize_plugin_state(self, plugin):
         try:
@@ -772,28 +2870,189 @@ class CassBotService(service.MultiService):
             except Exception:
                 log.err(None, "Trying to load state in plugin %s" % plugin.name())
 
+    def snapshot_state(self):
+        """
+        Return a copy of the full bot state, as it would be saved, with the
+        current state of every loaded plugin. Nothing gets disabled.
+        """
+
+        for network in self.networks.itervalues():
+            # so there is somewhere to save its privileges
+            network.get_state()
+        state = dict(self.state)
+        state['channels'] = set(self.state.get('channels', ()))
+        if 'networks' in self.state:
+            state['networks'] = dict((name, dict(netstate, channels=set(netstate.get('channels', ()))))
+                                     for (name, netstate) in self.state['networks'].iteritems())
+        state['plugins'] = plugin_states = self.state['plugins'].copy()
+        state['plugins_enabled'] = self.pluginmap.keys()
+        for pname, p in self.pluginmap.items():
+            if isinstance(p, enabled_but_not_found):
+                continue
+            try:
+                pstate = p.saveState()
+            except Exception:
+                log.err(None, 'Trying to save state for plugin %s' % pname)
+                continue
+            if pstate is None:
+                plugin_states.pop(pname, None)
+            else:
+                plugin_states[pname] = pstate
+        state['auth_map'] = self.primary.auth.saveState()
+        for network in self.networks.itervalues():
+            if network is not self.primary:
+                state['networks'][network.name]['auth_map'] = network.auth.saveState()
+        state['pending_journal'] = dict((pname, list(records)) for (pname, records)
+                                        in self.pending_journal.iteritems())
+        return state
+
+    def start_snapshot(self, statefile):
+        """
+        Snapshot the state for writing to statefile. If that is the file
+        the journal belongs to, changes from here on go to a new journal,
+        and the snapshot records which one.
+        """
+
+        state = self.snapshot_state()
+        state.pop('journal_seq', None)
+        plugins = state['plugins']
+        if plugins.store is not None and \
+                os.path.abspath(plugins.store.path) != os.path.abspath(statefile):
+            # the states of plugins which haven't been loaded are only in
+            # the file they were loaded from
+            plugins.read_all()
+        if self.journal is not None and self.journal.statefile == statefile:
+            state['journal_seq'] = self.journal.rotate()
+        return state
+
+    def snapshot_written(self, state):
+        """
+        The given snapshot is safely on disk; the journals it covers can go.
+        """
+
+        if self.journal is not None and 'journal_seq' in state:
+            self.journal.discard_before(state['journal_seq'])
+
     def saveStateToFile(self, statefile):
-        # XXX: this disables plugins when capturing their state to save. it
-        # probably shouldn't, so that admins can save settings whenever they
-        # like without restarting the whole bot
+        state = self.start_snapshot(statefile)
+        write_state_file(state, statefile)
+        self.snapshot_written(state)
+
+    def saveStateInBackground(self, statefile=None):
+        """
+        Snapshot the state now, then pickle it and write it out in a worker
+        thread. Returns a Deferred which fires once it is safely on disk.
+        Only one save runs at a time.
+        """
+
+        if statefile is None:
+            statefile = self.statefile
+        def save():
+            state = self.start_snapshot(statefile)
+            d = threads.deferToThreadPool(self.reactor, self.reactor.getThreadPool(),
+                                          write_state_file, state, statefile)
+            d.addCallback(lambda _: self.snapshot_written(state))
+            return d
+        return self.save_lock.run(save)
 
-        self.state['plugins_enabled'] = self.pluginmap.keys()
-        for pname in self.state['plugins_enabled']:
-            self.disable_plugin(pname)
-        self.state['auth_map'] = self.auth.saveState()
-        with open(statefile, 'w') as sfile:
-            pickle.dump(self.state, sfile, -1)
+    def autosave(self):
+        d = self.saveStateInBackground()
+        d.addErrback(log.err, 'Autosaving state')
 
     def loadStateFromFile(self, statefile):
-        with open(statefile, 'r') as sfile:
-            self.state = pickle.load(sfile)
-        auth_dat = self.state.get('auth_map')
-        if auth_dat is not None:
-            self.auth.loadState(auth_dat)
-        for pname in self.state.get('plugins_enabled', ()):
-            d = self.enable_plugin_by_name(pname)
-            d.addErrback(log.err, "Loading plugin %s" % pname)
+        self.state = read_state_file(statefile)
+        for network in self.networks.itervalues():
+            network.load_auth_state()
+        self.pending_journal = self.state.pop('pending_journal', {})
+        with self.plugin_batch():
+            for pname in self.state.get('plugins_enabled', ()):
+                d = self.enable_plugin_by_name(pname)
+                d.addErrback(log.err, "Loading plugin %s" % pname)
         self.state['channels'] = set(self.state.get('channels', ()))
+        self.open_journal(statefile, self.state.get('journal_seq', 0))
+
+    def open_journal(self, statefile, from_seq):
+        """
+        Replay the changes journaled since the snapshot that was just
+        loaded, then start a fresh journal for new ones.
+        """
+
+        self.close_journal()
+        journal = StateJournal(statefile)
+        replayed = 0
+        for record in journal.read(from_seq):
+            try:
+                self.replay_journal_record(record)
+            except Exception:
+                log.err(None, 'Replaying journal record %r' % (record,))
+            replayed += 1
+        if replayed:
+            log.msg('Replayed %d journaled state changes' % replayed)
+        journal.start(max(journal.existing() + [from_seq]) + 1)
+        self.journal = journal
+        for network in self.networks.itervalues():
+            network.auth.journal = self.auth_journaler(network)
+
+    def close_journal(self):
+        for network in self.networks.itervalues():
+            network.auth.journal = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def replay_journal_record(self, record):
+        kind = record[0]
+        if kind == 'auth':
+            # records from before there could be more than one network
+            # have no network name, and belong to the primary one
+            netname = record[2] if len(record) > 2 else self.primary.name
+            try:
+                network = self.networks[netname]
+            except KeyError:
+                raise ValueError('Privilege change for unknown network %r' % (netname,))
+            network.auth.replay(record[1])
+        elif kind == 'plugin':
+            pname, change = record[1:]
+            p = self.pluginmap.get(pname)
+            if p is None or isinstance(p, enabled_but_not_found):
+                # applied once the plugin gets loaded, or kept in the next
+                # snapshot until then
+                self.pending_journal.setdefault(pname, []).append(change)
+            else:
+                p.replayJournal(change)
+        else:
+            raise ValueError('Unknown journal record type %r' % (kind,))
+
+    def append_journal(self, record):
+        if self.journal is None:
+            return
+        try:
+            self.journal.append(record)
+        except Exception:
+            log.err(None, 'Writing state change %r to journal' % (record,))
+            return
+        if self.journal.size() > self.journal_compact_size and not self.save_lock.locked:
+            log.msg('State journal has grown past %d bytes; compacting'
+                    % self.journal_compact_size)
+            self.saveStateInBackground().addErrback(log.err, 'Compacting state journal')
+
+    def auth_journaler(self, network):
+        def record_auth_change(change):
+            if network is self.primary:
+                self.append_journal(('auth', change))
+            else:
+                self.append_journal(('auth', change, network.name))
+        return record_auth_change
+
+    def journal_plugin_change(self, plugin, change):
+        """
+        Record a small, pickleable description of a change a plugin has just
+        made to its own state. It will be passed back to the plugin's
+        replayJournal() method if the bot has to reload its state before
+        the next full snapshot.
+        """
+
+        self.append_journal(('plugin', plugin.name(), change))
 
     def __str__(self):
         return '<%s object [%s]%s>' % (
@@ -816,13 +3075,40 @@ def require_priv(privname):
         command_name = command_name[len('command_'):]
         @wraps(f)
         def wrapper(self, bot, user, channel, args):
-            if not bot.service.auth.userHas(user, privname):
+            if not bot.network.auth.userHas(user, privname):
                 return bot.address_msg(user, channel, 'command %s requires privilege %s'
                                                       % (command_name, privname))
             return f(self, bot, user, channel, args)
         return wrapper
     return make_wrapper
 
+def command_deadline(seconds):
+    """
+    Decorator for command_* methods on cassbot plugins which are expected
+    to take a while: the command is cancelled only after the given number
+    of seconds, instead of CommandScheduler.default_deadline. None means
+    never.
+    """
+    def make_wrapper(f):
+        f.deadline = seconds
+        return f
+    return make_wrapper
+
+def off_reactor(f):
+    """
+    Decorator for plugin hook and command_* methods which are slow or
+    block: they are run in the service's plugin thread pool instead of the
+    reactor thread. The bot passed to them is a ReactorProxy, so calls
+    like bot.address_msg() are safely run back in the reactor thread, but
+    anything else shared with the rest of the bot must be left alone or
+    handed over with reactor.callFromThread. Their return values (or
+    exceptions) are delivered back to the reactor as usual. A command
+    deadline only abandons the result; the thread still runs to the end.
+    """
+
+    f.off_reactor = True
+    return f
+
 def require_priv_in_channel(privname):
     """
     Decorator meant to be applied to command_* methods on cassbot plugins.
@@ -838,7 +3124,7 @@ def require_priv_in_channel(privname):
         command_name = command_name[len('command_'):]
         @wraps(f)
         def wrapper(self, bot, user, channel, args):
-            if not bot.service.auth.channelUserHas(channel, user, privname):
+            if not bot.network.auth.channelUserHas(channel, user, privname):
                 return bot.address_msg(user, channel,
                                'command %s requires privilege %s in this channel'
                                % (command_name, privname))
@@ -1,12 +1,25 @@
+import os
 from cassbot import (BaseBotPlugin, enabled_but_not_found, require_priv,
-                     require_priv_in_channel, natural_list)
+                     require_priv_in_channel, command_deadline, natural_list, PRIORITY_BULK)
 from twisted.internet import defer
 from twisted.python import failure, log
 from twisted.plugin import getModule
+import metrics
 
 def makelist(i):
     return ', '.join(sorted(i)) if i else 'none'
 
+def profile_lines(stats, count):
+    stats.sort_stats('cumulative')
+    lines = []
+    for func in stats.fcn_list[:count]:
+        primitive, calls, own, cumulative, callers = stats.stats[func]
+        filename, line, funcname = func
+        lines.append('%s:%d(%s): %d calls, %.1fms cumulative, %.1fms own'
+                     % (os.path.basename(filename), line, funcname, calls,
+                        cumulative * 1000, own * 1000))
+    return lines
+
 class Admin(BaseBotPlugin):
     @defer.inlineCallbacks
     def command_modules(self, bot, user, channel, args):
@@ -73,7 +86,7 @@ class Admin(BaseBotPlugin):
             yield bot.address_msg(user, channel, 'usage: modreload [modulenames]')
             return
         for arg in args:
-            output = self.do_mod_reload(bot.service, arg)
+            output = yield self.do_mod_reload(bot.service, arg)
             yield bot.address_msg(user, channel, output)
 
     @require_priv('admin')
@@ -100,7 +113,7 @@ class Admin(BaseBotPlugin):
             yield bot.address_msg(user, channel, 'usage: part [channelname]')
             return
         try:
-            bot.service.leave(args[0])
+            bot.service.leave(args[0], network=bot.network)
         except Exception:
             f = failure.Failure()
             yield bot.address_msg(user, channel, f.getErrorMessage())
@@ -114,19 +127,216 @@ class Admin(BaseBotPlugin):
         if len(args) != 0:
             yield bot.address_msg(user, channel, 'usage: channels')
             return
-        yield bot.address_msg(user, channel, 'configured to join: %s'
-                                             % natural_list(sorted(bot.join_channels)))
+        p = bot.resync_progress()
+        if p['done']:
+            synced = 'synced %d, failed %d in %.1fs' % (p['synced'], p['failed'], p['elapsed'])
+        else:
+            synced = 'rejoining: %d synced, %d joining, %d waiting, %d failed so far' % (
+                    p['synced'], p['joining'], p['waiting'], p['failed'])
+        yield bot.address_msg(user, channel, 'configured to join: %s (%s)'
+                                             % (natural_list(sorted(bot.join_channels)), synced))
+
+    @require_priv('admin')
+    def command_sendqueue(self, bot, user, channel, args):
+        if len(args) != 0:
+            return bot.address_msg(user, channel, 'usage: sendqueue')
+        s = bot.get_send_scheduler().stats()
+        backlog = ['%s=%d' % item for item in sorted(s['depth_per_target'].iteritems())]
+        return bot.address_msg(user, channel,
+                'outbound queue: %d lines waiting (%s); %d sent, %d merged; '
+                'wait avg %.2fs, max %.2fs'
+                % (s['depth'], makelist(backlog), s['sent'], s['merged'],
+                   s['avg_wait'], s['max_wait']))
+
+    @require_priv('admin')
+    def command_dispatchstats(self, bot, user, channel, args):
+        if len(args) != 0:
+            return bot.address_msg(user, channel, 'usage: dispatchstats')
+        s = bot.service.command_scheduler.stats()
+        busiest = sorted(s['per_command'].iteritems(), key=lambda item: item[1], reverse=True)[:5]
+        return bot.address_msg(user, channel,
+                'commands: %d dispatched, %d running, %d waiting; %d completed, %d failed, '
+                '%d timed out, %d throttled. busiest: %s'
+                % (s['dispatched'], s['running'], s['waiting'], s['completed'], s['failed'],
+                   s['timed_out'], s['throttled'],
+                   makelist(['%s=%d' % item for item in busiest])))
+
+    @require_priv('admin')
+    def command_threadstats(self, bot, user, channel, args):
+        if len(args) != 0:
+            return bot.address_msg(user, channel, 'usage: threadstats')
+        p = bot.service.plugin_pool.stats()
+        w = bot.service.watchdog.stats()
+        return bot.address_msg(user, channel,
+                'plugin threads: %d/%d busy, %d waiting, %d done; wait avg %.1fms, '
+                'max %.1fms. reactor stalls: %d, longest %dms'
+                % (p['running'], p['size'], p['waiting'], p['finished'],
+                   p['avg_wait'] * 1000, p['max_wait'] * 1000,
+                   w['stalls'], w['max_stall'] * 1000))
+
+    @require_priv('admin')
+    def command_metrics(self, bot, user, channel, args):
+        if len(args) > 1:
+            return bot.address_msg(user, channel, 'usage: metrics [<name prefix>]')
+        lines = metrics.REGISTRY.summary(args[0] if args else 'cassbot_')
+        if not lines:
+            return bot.address_msg(user, channel, 'Nothing recorded yet.')
+        # this can be long; let it queue behind interactive replies
+        return bot.address_msg(user, channel, '\n'.join(lines), priority=PRIORITY_BULK)
+
+    profile_usage = ('usage: profile on|off|reset | report [<count>] [<sort>] | '
+                     'dump <file> [<sort>] | capture <module> <seconds> [<file>]')
+    # where profile dump and capture write their files, unless the bot
+    # state says otherwise
+    profile_dir = 'profiles'
+
+    def profile_path(self, serv, filename):
+        """
+        Where a profile file named on IRC goes: only ever a plain file in
+        the profile directory, whatever path was given. Returns None if
+        there is no usable file name in it.
+        """
+
+        name = os.path.basename(filename)
+        if name in ('', '.', '..'):
+            return None
+        dirname = serv.state.get('profile_dir', self.profile_dir)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        return os.path.join(dirname, name)
+
+    # a capture takes as long as it was asked to
+    @command_deadline(None)
+    @require_priv('admin')
+    @defer.inlineCallbacks
+    def command_profile(self, bot, user, channel, args):
+        profiler = bot.service.profiler
+        sub = args[0] if args else None
+        if sub in ('on', 'off', 'reset') and len(args) == 1:
+            getattr(profiler, {'on': 'enable', 'off': 'disable', 'reset': 'reset'}[sub])()
+            if sub == 'off' and profiler.capturing is not None:
+                yield bot.address_msg(user, channel, 'Profiling stays on until the capture '
+                                                     'of %s finishes.' % profiler.capturing)
+                return
+            state = 'on' if profiler.enabled else 'off'
+            yield bot.address_msg(user, channel, 'kay. profiling is %s.' % state)
+        elif sub == 'report' and len(args) <= 3:
+            count = 5
+            sort = 'p95'
+            for arg in args[1:]:
+                if arg.isdigit():
+                    count = int(arg)
+                elif arg in profiler.report_sorts:
+                    sort = arg
+                else:
+                    yield bot.address_msg(user, channel, 'Sort by one of: %s.'
+                                                         % natural_list(profiler.report_sorts))
+                    return
+            lines = profiler.format_report(count, sort)
+            if not lines:
+                state = 'on' if profiler.enabled else 'off'
+                lines = ['Nothing profiled yet (profiling is %s).' % state]
+            yield bot.address_msg(user, channel, '\n'.join(lines))
+        elif sub == 'dump' and len(args) in (2, 3):
+            sort = args[2] if len(args) == 3 else 'p95'
+            if sort not in profiler.report_sorts:
+                yield bot.address_msg(user, channel, 'Sort by one of: %s.'
+                                                     % natural_list(profiler.report_sorts))
+                return
+            try:
+                path = self.profile_path(bot.service, args[1])
+                if path is None:
+                    yield bot.address_msg(user, channel, self.profile_usage)
+                    return
+                profiler.write_report(path, sort)
+            except (IOError, OSError), e:
+                yield bot.address_msg(user, channel, 'Could not write %s: %s' % (args[1], e))
+            else:
+                yield bot.address_msg(user, channel, 'Profile written to %s.' % path)
+        elif sub == 'capture' and len(args) in (3, 4) and args[2].isdigit():
+            yield self.do_profile_capture(bot, user, channel, args[1], int(args[2]),
+                                          args[3] if len(args) == 4 else None)
+        else:
+            yield bot.address_msg(user, channel, self.profile_usage)
+
+    @defer.inlineCallbacks
+    def do_profile_capture(self, bot, user, channel, modname, seconds, filename):
+        p = bot.service.pluginmap.get(modname)
+        if p is None or isinstance(p, enabled_but_not_found):
+            yield bot.address_msg(user, channel, 'Module %s is not loaded.' % modname)
+            return
+        path = None
+        if filename is not None:
+            try:
+                path = self.profile_path(bot.service, filename)
+            except (IOError, OSError), e:
+                yield bot.address_msg(user, channel, 'Could not write %s: %s' % (filename, e))
+                return
+            if path is None:
+                yield bot.address_msg(user, channel, self.profile_usage)
+                return
+        try:
+            d = bot.service.profiler.capture(modname, seconds)
+        except ValueError, e:
+            yield bot.address_msg(user, channel, str(e))
+            return
+        yield bot.address_msg(user, channel, 'Profiling %s for %ds.' % (modname, seconds))
+        stats = yield d
+        if stats is None:
+            yield bot.address_msg(user, channel, 'No calls into %s while profiling.' % modname)
+        elif path is not None:
+            try:
+                stats.dump_stats(path)
+            except (IOError, OSError), e:
+                yield bot.address_msg(user, channel, 'Could not write %s: %s' % (path, e))
+            else:
+                yield bot.address_msg(user, channel, 'Profile of %s written to %s.'
+                                                     % (modname, path))
+        else:
+            yield bot.address_msg(user, channel, '\n'.join(profile_lines(stats, 8)),
+                                  priority=PRIORITY_BULK)
+
+    @require_priv('admin')
+    @defer.inlineCallbacks
+    def command_save(self, bot, user, channel, args):
+        if len(args) != 0:
+            yield bot.address_msg(user, channel, 'usage: save')
+            return
+        try:
+            yield bot.service.saveStateInBackground()
+        except Exception:
+            f = failure.Failure()
+            log.err(f, "Saving state on command from %r" % (user,))
+            yield bot.address_msg(user, channel, 'Could not save state: %s' % f.getErrorMessage())
+        else:
+            yield bot.address_msg(user, channel, 'State saved to %s.' % bot.service.statefile)
 
     @require_priv('admin')
     def command_die(self, bot, user, channel, args):
         bot.service.reactor.callLater(0, bot.service.stopService)
 
+    @defer.inlineCallbacks
     def do_mod_reload(self, serv, modname):
         try:
             p = serv.pluginmap[modname]
         except KeyError:
-            return 'Module %s is not loaded.' % modname
+            defer.returnValue('Module %s is not loaded.' % modname)
         mod = getModule(p.__module__).load()
-        reload(mod)
-        serv.disable_plugin(modname)
-        return self.do_mod_enable(serv, modname)
+        # recompiling a big module can take a while, so it happens in a pool
+        # thread; every plugin from the module is disabled first, so none
+        # of its code runs in the reactor while the module is swapped out
+        others = [pname for (pname, q) in serv.pluginmap.items()
+                  if pname != modname and getattr(q, '__module__', None) == mod.__name__]
+        with serv.plugin_batch():
+            for pname in [modname] + others:
+                serv.disable_plugin(pname)
+        try:
+            yield serv.run_off_reactor(reload, mod)
+        finally:
+            serv.plugin_registry.invalidate()
+            with serv.plugin_batch():
+                for pname in others:
+                    serv.enable_plugin_by_name(pname).addErrback(
+                            log.err, 'Re-enabling plugin %s after reload' % pname)
+            output = self.do_mod_enable(serv, modname)
+        defer.returnValue(output)
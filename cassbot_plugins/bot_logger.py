@@ -1,40 +1,114 @@
-from cassbot import BaseBotPlugin, natural_list
+import os
+import re
+import time
+import calendar
+from cassbot import BaseBotPlugin, MaskSet, natural_list, escape_glob, PRIMARY_NETWORK
+from logstore import LogStore
+from logindex import LogIndex, terms_for, nick_term, user_term, make_position, \
+                     split_position, contains, USER_PREFIX
 from twisted.internet import defer
 from twisted.python import log
 
+logged_speaker = re.compile(r'^(?:<([^>]+)>|\* (\S+)) ')
+relative_day = re.compile(r'^(\d+)d$')
+
+def parse_day(arg, clock):
+    """
+    Turn a search date (YYYY-MM-DD, or <N>d for N days ago) into the unix
+    time of the start of that (UTC) day.
+    """
+
+    m = relative_day.match(arg)
+    if m is not None:
+        now = clock.seconds()
+        return int(now - now % 86400) - int(m.group(1)) * 86400
+    return calendar.timegm(time.strptime(arg, '%Y-%m-%d'))
+
 class BotLogger(BaseBotPlugin):
+    # for the primary network
     eterno_blacklist = {'#cassandra': ('evn',), '#cassandra-dev': ('evn',)}
+    # where channel logs go, unless the bot state says otherwise (see logstore)
+    log_dir = 'irclogs'
+    # search results per reply, and how far a search can be paged
+    search_page_size = 5
+    search_max_pages = 20
 
     def __init__(self):
-        self.per_channel_blacklist = \
-                dict((chan, set(blist))
-                     for (chan, blist) in self.eterno_blacklist.iteritems())
+        # by network name, then channel
+        self.blacklists = {
+            PRIMARY_NETWORK: dict((chan, MaskSet(blist))
+                                  for (chan, blist) in self.eterno_blacklist.iteritems()),
+        }
+        # made on first use, once there's a bot to get settings from
+        self.store = None
+        # search indexes, by channel log directory
+        self.indexes = {}
 
     def saveState(self):
-        return self.per_channel_blacklist
+        # the state is saved periodically, on shutdown and when the plugin
+        # is disabled; those are all good times to write out buffered lines
+        if self.store is not None:
+            self.store.flush()
+        for index in self.indexes.itervalues():
+            index.flush()
+        return dict((netname, dict((chan, set(bl)) for (chan, bl) in channels.iteritems()))
+                    for (netname, channels) in self.blacklists.iteritems())
 
     def loadState(self, state):
-        if isinstance(state, dict):
-            self.per_channel_blacklist = state
-        else:
-            log.msg("Warning: discarding uncompliant per_channel_blacklist %r"
-                    % (state,))
+        if not isinstance(state, dict):
+            log.msg("Warning: discarding uncompliant blacklists %r" % (state,))
+            return
+        blacklists = {}
+        for key, value in state.iteritems():
+            if isinstance(value, dict):
+                channels = blacklists.setdefault(key, {})
+                for chan, blist in value.iteritems():
+                    channels[chan] = MaskSet(blist)
+            else:
+                # saved before blacklists were kept per network
+                blacklists.setdefault(PRIMARY_NETWORK, {})[key] = MaskSet(value)
+        self.blacklists = blacklists
+
+    def replayJournal(self, record):
+        op, chan, mask = record[:3]
+        # records from before blacklists were kept per network have no
+        # network name
+        netname = record[3] if len(record) > 3 else PRIMARY_NETWORK
+        bl = self.blacklists.setdefault(netname, {}).setdefault(chan, MaskSet())
+        if op == 'blacklist':
+            bl.add(mask)
+        elif op == 'unblacklist':
+            bl.discard(mask)
+
+    def get_blacklist(self, bot, chan):
+        """
+        The blacklist for chan on bot's network, or None if there is none.
+        """
+
+        return self.blacklists.get(bot.network.name, {}).get(chan)
+
+    def journal_change(self, bot, op, chan, mask):
+        bot.service.journal_plugin_change(self, (op, chan, mask, bot.network.name))
 
     def command_blacklist(self, bot, user, chan, args):
-        bl = self.per_channel_blacklist.setdefault(chan, set())
+        bl = self.blacklists.setdefault(bot.network.name, {}).setdefault(chan, MaskSet())
         if len(args) == 0:
             return bot.address_msg(user, chan,
                     'usage: "blacklist me" OR "blacklist [name [name2 [...]]]". '
                     'Second form requires log_blacklist_admin privilege in this '
                     'channel. Shell-style wildcards are ok.')
         if len(args) == 1 and args[0] in ('me', user):
-            bl.add(user)
+            # the user's own hostmask is not a pattern, whatever is in it
+            mask = escape_glob(user)
+            bl.add(mask)
+            self.journal_change(bot, 'blacklist', chan, mask)
             return bot.address_msg(user, chan, 'Blacklisting you for %s.' % chan)
-        if bot.service.auth.channelUserHas(chan, user, 'log_blacklist_admin'):
+        if bot.network.auth.channelUserHas(chan, user, 'log_blacklist_admin'):
             added = []
             for arg in args:
                 if arg not in bl:
                     bl.add(arg)
+                    self.journal_change(bot, 'blacklist', chan, arg)
                     added.append(arg)
             return bot.address_msg(user, chan, 'Blacklisted %s'
                                                % natural_list(map(repr, added)))
@@ -43,22 +117,28 @@ class BotLogger(BaseBotPlugin):
                 'privilege in this channel.')
 
     def command_unblacklist(self, bot, user, chan, args):
-        bl = self.per_channel_blacklist.setdefault(chan, set())
+        bl = self.blacklists.setdefault(bot.network.name, {}).setdefault(chan, MaskSet())
         if len(args) == 0:
             return bot.address_msg(user, chan,
                     'usage: "unblacklist me" OR "unblacklist [name [name2 [...]]]". '
                     'Second form requires log_blacklist_admin privilege in this '
                     'channel. Shell-style wildcards are ok.')
         if len(args) == 1 and args[0] in ('me', user):
-            if user in bl:
-                bl.discard(user)
+            # entries made by "blacklist me" before it escaped the hostmask
+            # are the plain hostmask
+            mine = [m for m in (escape_glob(user), user) if m in bl]
+            if mine:
+                for mask in mine:
+                    bl.discard(mask)
+                    self.journal_change(bot, 'unblacklist', chan, mask)
                 return bot.address_msg(user, chan, 'Unblacklisting you for %s.' % chan)
             return bot.address_msg(user, chan, 'You are not blacklisted in %s.' % chan)
-        if bot.service.auth.channelUserHas(chan, user, 'log_blacklist_admin'):
+        if bot.network.auth.channelUserHas(chan, user, 'log_blacklist_admin'):
             found = []
             for arg in args:
                 if arg in bl:
                     bl.discard(arg)
+                    self.journal_change(bot, 'unblacklist', chan, arg)
                     found.append(arg)
             return bot.address_msg(user, chan, 'Unblacklisted %s'
                                                % natural_list(map(repr, found)))
@@ -68,71 +148,216 @@ class BotLogger(BaseBotPlugin):
 
     def command_show(self, bot, user, chan, args):
         if len(args) == 1 and args[0] == 'blacklist':
-            bl = map(repr, sorted(self.per_channel_blacklist.get(chan, ())))
+            bl = map(repr, sorted(self.get_blacklist(bot, chan) or ()))
             return bot.address_msg(user, chan, 'Blacklist for %s: %s'
                                                % (chan, natural_list(bl)))
 
-    def irclog(self, *a, **kw):
-        kw['mtype'] = 'irclog'
-        return log.msg(*a, **kw)
+    search_usage = ('usage: search [<channel>] [from:<nick>] [since:<date>] [until:<date>] '
+                    '[page:<n>] <words>. Dates are YYYY-MM-DD, or <n>d for n days ago.')
+
+    @defer.inlineCallbacks
+    def command_search(self, bot, user, chan, args):
+        channel = chan
+        if args and args[0][:1] in '#&!+':
+            channel = args.pop(0)
+        opts = {'page': '1'}
+        words = []
+        for arg in args:
+            key, sep, value = arg.partition(':')
+            if sep and key in ('from', 'since', 'until', 'page') and value:
+                opts[key] = value
+            else:
+                words.append(arg)
+        terms = set()
+        for w in words:
+            terms.update(terms_for(w))
+        if 'from' in opts:
+            terms.add(nick_term(opts['from']))
+        if channel == bot.nickname or not terms or not opts['page'].isdigit():
+            yield bot.address_msg(user, chan, self.search_usage)
+            return
+        if channel.lower() != chan.lower() and not self.is_member(bot, user, channel):
+            # otherwise anyone could read secret channels the bot is in
+            yield bot.address_msg(user, chan, 'You can only search %s while you are in it.'
+                                              % channel)
+            return
+        page = int(opts['page'])
+        if not 1 <= page <= self.search_max_pages:
+            yield bot.address_msg(user, chan, 'Only pages 1 to %d can be shown; try '
+                                              'narrowing the search.' % self.search_max_pages)
+            return
+        store = self.get_store(bot)
+        try:
+            since = parse_day(opts['since'], store.clock) if 'since' in opts else None
+            until = parse_day(opts['until'], store.clock) + 86399 if 'until' in opts else None
+        except ValueError:
+            yield bot.address_msg(user, chan, self.search_usage)
+            return
+
+        index = self.get_index(bot, channel)
+        found = []
+        skip = (page - 1) * self.search_page_size
+        before = None
+        while len(found) <= self.search_page_size:
+            # the lines themselves are read in a pool thread, a batch at a
+            # time, and the search picks up again after the last one (runs
+            # may have been merged meanwhile, so everything is looked up again)
+            hidden = self.hidden_lines(bot, index, channel)
+            batch = []
+            for pos, ts in index.search(terms, since, until, before):
+                before = pos
+                if not any(contains(sources, pos) for sources in hidden):
+                    batch.append(split_position(pos))
+                    if len(batch) > skip + self.search_page_size - len(found):
+                        break
+            if not batch:
+                break
+            lines = yield store.read_lines(bot.network.name, channel, batch)
+            for line in lines:
+                if line is None:
+                    continue
+                # lines indexed without the speaker's hostmask go by the nick
+                m = logged_speaker.match(line[1])
+                if m is not None and \
+                        self.is_blacklisted(bot, m.group(1) or m.group(2), channel):
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                found.append(line)
+        if not found:
+            yield bot.address_msg(user, chan, 'No %smatches in %s.'
+                                              % ('more ' if page > 1 else '', channel))
+            return
+        more = len(found) > self.search_page_size
+        lines = ['[%s] %s' % (time.strftime('%Y-%m-%d %H:%M', time.gmtime(ts)), text)
+                 for (ts, text) in found[:self.search_page_size]]
+        if more:
+            lines.append('(more with page:%d)' % (page + 1))
+        yield bot.address_msg(user, chan, '\n'.join(lines), prefix=False)
+
+    def hidden_lines(self, bot, index, channel):
+        """
+        Return the postings for lines from anyone blacklisted in channel
+        now, whenever they were said.
+        """
+
+        bl = self.get_blacklist(bot, channel)
+        if not bl:
+            return []
+        return [index.sources(t) for t in index.terms_with_prefix(USER_PREFIX)
+                if bl.matches(t[len(USER_PREFIX):])]
+
+    def is_member(self, bot, user, channel):
+        nick = user.split('!', 1)[0]
+        return channel.lower() in [c.lower() for c in bot.memberships.channels_of(nick)]
+
+    def is_blacklisted(self, bot, user, chan):
+        bl = self.get_blacklist(bot, chan)
+        if bl is None:
+            return False
+        # entries may be bare nicks or full nick!user@host masks
+        return bl.matches(user.split('!', 1)[0]) or bl.matches(user)
+
+    def get_store(self, bot):
+        if self.store is None:
+            serv = bot.service
+            self.store = LogStore(serv.state.get('log_dir', self.log_dir), serv.reactor,
+                                  run_job=serv.run_off_reactor)
+        return self.store
+
+    def get_index(self, bot, chan):
+        dirname = self.get_store(bot).channel_dir(bot.network.name, chan)
+        index = self.indexes.get(dirname)
+        if index is None:
+            index = self.indexes[dirname] = LogIndex(os.path.join(dirname, 'index'),
+                                                     run_job=bot.service.run_off_reactor)
+        return index
+
+    def irclog(self, bot, chan, text):
+        """
+        Log a line for the given channel (or for the network as a whole,
+        if chan is None). Returns its position in the log store.
+        """
+
+        return self.get_store(bot).add(bot.network.name, chan, text)
+
+    def index_line(self, bot, chan, position, user, text):
+        if chan == bot.nickname:
+            # private conversations aren't searchable
+            return
+        terms = terms_for(text)
+        terms.add(nick_term(user.split('!', 1)[0]))
+        # so the line can be hidden if they are blacklisted later on
+        terms.add(user_term(user))
+        self.get_index(bot, chan).add(make_position(*position), self.store.clock.seconds(),
+                                      terms)
 
     def signedOn(self, bot):
-        self.irclog("Signed on as %s." % (bot.nickname,))
+        self.irclog(bot, None, "Signed on as %s." % (bot.nickname,))
+
+    def allChannelsSynced(self, bot, synced, failed):
+        self.irclog(bot, None, "Rejoined %d channels%s." % (
+                len(synced), "; couldn't join %s" % ', '.join(failed) if failed else ''))
 
     def joined(self, bot, channel):
-        self.irclog("Joined %s." % (channel,))
+        self.irclog(bot, channel, "Joined %s." % (channel,))
 
     def left(self, bot, channel):
-        self.irclog("Left %s." % (channel,))
+        self.irclog(bot, channel, "Left %s." % (channel,))
 
     def noticed(self, bot, user, chan, msg):
-        self.irclog("NOTICE -!- [%s] <%s> %s" % (chan, user, msg))
+        self.irclog(bot, chan, "NOTICE -!- <%s> %s" % (user, msg))
 
     def modeChanged(self, bot, user, chan, being_set, modes, args):
-        self.irclog("MODE -!- %s %s modes %r in %r for %r" % (
+        self.irclog(bot, chan, "MODE -!- %s %s modes %r for %r" % (
             user,
             'set' if being_set else 'unset',
             modes,
-            chan,
             args
         ))
 
     def kickedFrom(self, bot, chan, kicker, msg):
-        self.irclog('KICKED -!- from %s by %s [%s]' % (chan, kicker, msg))
+        self.irclog(bot, chan, 'KICKED -!- from %s by %s [%s]' % (chan, kicker, msg))
 
     def nickChanged(self, bot, nick):
-        self.irclog('NICKCHANGE -!- my nick changed to %s' % (nick,))
+        self.irclog(bot, None, 'NICKCHANGE -!- my nick changed to %s' % (nick,))
 
     def userJoined(self, bot, user, chan):
-        self.irclog('%s joined %s' % (user, chan))
+        self.irclog(bot, chan, '%s joined %s' % (user, chan))
 
     def userLeft(self, bot, user, chan):
-        self.irclog('%s left %s' % (user, chan))
+        self.irclog(bot, chan, '%s left %s' % (user, chan))
 
     def userQuit(self, bot, user, msg):
-        self.irclog('%s quit [%s]' % (user, msg))
+        self.irclog(bot, None, '%s quit [%s]' % (user, msg))
 
     def userKicked(self, bot, kickee, chan, kicker, msg):
-        self.irclog('%s was kicked from %s by %s [%s]' % (kickee, chan, kicker, msg))
+        self.irclog(bot, chan, '%s was kicked from %s by %s [%s]' % (kickee, chan, kicker, msg))
 
     def topicUpdated(self, bot, user, chan, newtopic):
-        self.irclog('[%s] -!- topic changed by %s to %r' % (chan, user, newtopic))
+        self.irclog(bot, chan, '-!- topic changed by %s to %r' % (user, newtopic))
 
     def userRenamed(self, bot, oldname, newname):
-        self.irclog('RENAME %s is now known as %s' % (oldname, newname))
+        line = 'RENAME %s is now known as %s' % (oldname, newname)
+        # the bot has already moved the user's memberships to the new name
+        for chan in bot.memberships.channels_of(newname) or (None,):
+            self.irclog(bot, chan, line)
 
     def receivedMOTD(self, bot, motd):
-        self.irclog('MOTD %s' % (motd,))
+        self.irclog(bot, None, 'MOTD %s' % (motd,))
 
     def msg(self, bot, dest, msg, length=None):
-        self.irclog('[%s] <%s> %s' % (dest, bot.nickname, msg))
+        self.irclog(bot, dest, '<%s> %s' % (bot.nickname, msg))
 
     def action(self, bot, user, chan, data):
-        user = user.split('!', 1)[0]
-        if user not in self.per_channel_blacklist.get(chan, ()):
-            self.irclog('[%s] * %s %s' % (chan, user, data))
+        if not self.is_blacklisted(bot, user, chan):
+            nick = user.split('!', 1)[0]
+            pos = self.irclog(bot, chan, '* %s %s' % (nick, data))
+            self.index_line(bot, chan, pos, user, data)
 
     def privmsg(self, bot, user, channel, msg):
-        user = user.split('!', 1)[0]
-        if user not in self.per_channel_blacklist.get(channel, ()):
-            self.irclog('[%s] <%s> %s' % (channel, user, msg))
+        if not self.is_blacklisted(bot, user, channel):
+            nick = user.split('!', 1)[0]
+            pos = self.irclog(bot, channel, '<%s> %s' % (nick, msg))
+            self.index_line(bot, channel, pos, user, msg)
@@ -1,5 +1,5 @@
 from cassbot import BaseBotPlugin
-from twisted.web import client, error
+from twisted.web import error
 from twisted.internet import defer
 
 class BuildCommand(BaseBotPlugin):
@@ -14,7 +14,7 @@ class BuildCommand(BaseBotPlugin):
         url = '%s/%s/polling?token=%s' % (self.build_url, args[0], self.build_token)
         msg = "request sent!"
         try:
-            res = yield client.getPage(url)
+            res = yield bot.service.http.request('GET', url)
         except error.Error, e:
             # Hudson returns a 404 even when this request succeeds :/
             if e.status == '404':
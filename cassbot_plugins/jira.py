@@ -1,10 +1,17 @@
 import re
+import time
 from string import Template
 from itertools import chain
-from twisted.internet import defer, error
+from twisted.internet import defer
 from twisted.python import log
-from twisted.web import soap, error as web_error
-from cassbot import BaseBotPlugin, mask_matches, require_priv
+from twisted.web import error as web_error
+from cassbot import BaseBotPlugin, MaskSet, LRUCache, require_priv
+from webclient import shared_client, OutboundHTTP, CircuitOpenError
+import metrics
+import SOAPpy
+
+api_call_seconds = metrics.histogram('cassbot_jira_call_seconds',
+                                     'JIRA API call latency, by project', ('project',))
 
 def weed_duplicates(elements):
     already = set()
@@ -19,16 +26,182 @@ def listconcat(iterator_of_iterators):
 class NotAuthenticatedError(Exception):
     pass
 
+class TicketNotFoundError(Exception):
+    pass
+
+class SOAPProxy:
+    """
+    Stand-in for twisted.web.soap.Proxy which sends its requests through
+    the bot's shared OutboundHTTP client (so they get pooled connections,
+    timeouts, backoff and the circuit breaker) instead of opening a new
+    connection with getPage every time.
+    """
+
+    def __init__(self, url, http=None, namespace=None, header=None):
+        self.url = url
+        self.http = http or shared_client()
+        self.namespace = namespace
+        self.header = header
+
+    def _cbGotResult(self, result):
+        result = SOAPpy.parseSOAPRPC(result)
+        if hasattr(result, 'Result'):
+            return result.Result
+        elif len(result) == 1:
+            return result[0]
+        else:
+            return result
+
+    def callRemote(self, method, *args, **kwargs):
+        payload = SOAPpy.buildSOAP(args=args, kw=kwargs, method=method,
+                                   header=self.header, namespace=self.namespace)
+        return self.http.request('POST', self.url, body=payload,
+                                 headers={'Content-Type': 'text/xml', 'SOAPAction': method}) \
+                        .addCallback(self._cbGotResult)
+
+class TicketCache:
+    """
+    Remembers ticket lookups for a while (each entry carries its own ttl),
+    keeping at most maxsize entries, least recently used first out. While a
+    lookup for some key is running, further requests for that key wait on
+    the same lookup instead of starting their own.
+    """
+
+    def __init__(self, maxsize=500, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.entries = LRUCache(maxsize)
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def resize(self, maxsize):
+        self.entries.maxsize = maxsize
+        while len(self.entries) > maxsize:
+            self.entries.data.popitem(last=False)
+
+    def flush(self):
+        self.entries.clear()
+
+    def cached(self, key):
+        """
+        Return a Deferred for key if it is cached or already being looked
+        up, or None if a new lookup is needed.
+        """
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > self.reactor.seconds():
+                self.hits += 1
+                return defer.succeed(value)
+            self.entries.pop(key)
+        waiters = self.inflight.get(key)
+        if waiters is not None:
+            self.coalesced += 1
+            d = defer.Deferred()
+            waiters.append(d)
+            return d
+        return None
+
+    def get(self, key, fetch):
+        """
+        Return a Deferred firing with the value for key. If there is no
+        fresh cached value and no lookup already running for key, call
+        fetch(key), which should return (or fire with) a (value, ttl) pair.
+        The value is cached for ttl seconds, or not at all if ttl is None.
+        """
+
+        d = self.cached(key)
+        if d is not None:
+            return d
+        self.misses += 1
+        self.inflight[key] = []
+        d = defer.maybeDeferred(fetch, key)
+        d.addCallbacks(self.fetched, self.fetch_failed,
+                       callbackArgs=(key,), errbackArgs=(key,))
+        return d
+
+    def get_many(self, keys, fetch_many):
+        """
+        Like get(), but for several keys at once. All the keys that need a
+        new lookup are passed together in one call to fetch_many(keys),
+        which should fire with a dict mapping each of them to a (value, ttl)
+        pair. Returns a Deferred firing with the list of values, in the same
+        order as keys.
+        """
+
+        results = []
+        missing = []
+        for key in keys:
+            d = self.cached(key)
+            if d is None:
+                self.misses += 1
+                d = defer.Deferred()
+                self.inflight[key] = [d]
+                missing.append(key)
+            results.append(d)
+        if missing:
+            d = defer.maybeDeferred(fetch_many, missing)
+            d.addCallbacks(self.fetched_many, self.fetch_many_failed,
+                           callbackArgs=(missing,), errbackArgs=(missing,))
+        return defer.gatherResults(results, consumeErrors=True)
+
+    def fetched_many(self, results, keys):
+        for key in keys:
+            self.fetched(results[key], key)
+
+    def fetch_many_failed(self, f, keys):
+        for key in keys:
+            self.fetch_failed(f, key)
+
+    def fetched(self, result, key):
+        value, ttl = result
+        if ttl is not None:
+            self.entries.put(key, (self.reactor.seconds() + ttl, value))
+        for d in self.inflight.pop(key, ()):
+            d.callback(value)
+        return value
+
+    def fetch_failed(self, f, key):
+        for d in self.inflight.pop(key, ()):
+            d.errback(f)
+        return f
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'maxsize': self.entries.maxsize,
+            'inflight': len(self.inflight),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+        }
+
 class JiraInstance:
     num_api_tries = 3
+    max_concurrent_calls = 2
+    max_batch_size = 50
+    cache_ttl = 300
+    cache_negative_ttl = 60
+    cache_size = 500
 
-    def __init__(self, base_url, projectname, shortcode=None, username=None, password=None, min_ticket=0):
+    def __init__(self, base_url, projectname, shortcode=None, username=None, password=None, min_ticket=0,
+                 cache_ttl=None, cache_size=None):
         self.base_url = base_url.rstrip('/')
         self.set_shortcode(shortcode)
         self.set_projectname(projectname)
         self.username = username
         self.password = password
         self.min_ticket = min_ticket
+        if cache_ttl is not None:
+            self.cache_ttl = cache_ttl
+        if cache_size is not None:
+            self.cache_size = cache_size
+        self.ticket_cache = TicketCache(self.cache_size)
+        self.api_semaphore = defer.DeferredSemaphore(self.max_concurrent_calls)
         self.proxy = self.jira_soap_proxy()
         self.proxy_auth = None
         self.jira_soap_proxy_auth()
@@ -47,7 +220,7 @@ class JiraInstance:
             self.shortcode_re = re.compile(r'''(?:^|[[\s({<>:",@*'~])%s(?P<num>\d+)\b''' % re.escape(shortcode))
 
     def jira_soap_proxy(self):
-        return soap.Proxy(self.make_jira_soap_url())
+        return SOAPProxy(self.make_jira_soap_url())
 
     def jira_soap_proxy_auth(self):
         return self.proxy.callRemote('login', self.username, self.password) \
@@ -71,11 +244,13 @@ class JiraInstance:
     @classmethod
     def from_save_data(cls, savedata):
         return cls(savedata['base_url'], savedata['projectname'], savedata['shortcode'],
-                   savedata['username'], savedata['password'], min_ticket=savedata.get('min_ticket', 0))
+                   savedata['username'], savedata['password'], min_ticket=savedata.get('min_ticket', 0),
+                   cache_ttl=savedata.get('cache_ttl'), cache_size=savedata.get('cache_size'))
 
     def to_save_data(self):
         return {'base_url': self.base_url, 'projectname': self.projectname, 'shortcode': self.shortcode,
-                'username': self.username, 'password': self.password, 'min_ticket': self.min_ticket}
+                'username': self.username, 'password': self.password, 'min_ticket': self.min_ticket,
+                'cache_ttl': self.cache_ttl, 'cache_size': self.cache_size}
 
     def find_short_ticket_references(self, message):
         tickets = [int(tm.group('num')) for tm in self.shortcode_re.finditer(message)]
@@ -90,64 +265,248 @@ class JiraInstance:
     def make_link(self, ticketnum):
         return '%s/browse/%s-%d' % (self.base_url, self.projectname, ticketnum)
 
+    def make_key(self, ticketnum):
+        return '%s-%d' % (self.projectname, ticketnum)
+
     def fetch_ticket_info(self, ticketnum):
-        return self.jira_soap_auth_call('getIssue', '%s-%d' % (self.projectname, ticketnum))
+        return self.jira_soap_auth_call('getIssue', self.make_key(ticketnum))
+
+    def fetch_tickets_info(self, ticketnums):
+        jql = 'key in (%s)' % ', '.join(map(self.make_key, ticketnums))
+        return self.jira_soap_auth_call('getIssuesFromJqlSearch', jql, len(ticketnums))
 
     @defer.inlineCallbacks
+    def call_with_retries(self, fetcher, *args):
+        """
+        Run one of the fetch_* methods, retrying (and re-authenticating, after
+        a backoff) on API errors up to num_api_tries times. Connection-level
+        retries are left to the shared http client. Fires with None if it
+        never succeeded, or fails with TicketNotFoundError if JIRA says a
+        requested ticket doesn't exist. At most max_concurrent_calls of
+        these are outstanding against this instance at once.
+        """
+
+        yield self.api_semaphore.acquire()
+        try:
+            for attempt in range(self.num_api_tries):
+                if attempt > 0:
+                    yield self.proxy.http.backoff(attempt - 1)
+                start = time.time()
+                try:
+                    try:
+                        result = yield fetcher(*args)
+                    finally:
+                        api_call_seconds.labels(self.projectname).observe(time.time() - start)
+                except NotAuthenticatedError:
+                    log.msg("(Not fetching JIRA ticket data; not authenticated)")
+                    break
+                except CircuitOpenError, e:
+                    log.msg("(Not fetching JIRA ticket data; %s)" % (e,))
+                    break
+                except web_error.Error, e:
+                    if 'does not exist' in str(e.response):
+                        raise TicketNotFoundError()
+                    log.err(None, "JIRA API problem [try %d]\n--------\n%s\n--------\n" % (attempt + 1, e.response))
+                    yield self.jira_soap_proxy_auth()
+                except OutboundHTTP.transient_errors, e:
+                    log.err(None, "JIRA connection error\n--------\n%s\n--------\n" % (e,))
+                    break
+                except Exception, e:
+                    log.err(None, "Unexpected error fetching JIRA ticket data.")
+                    break
+                else:
+                    defer.returnValue(result)
+        finally:
+            self.api_semaphore.release()
+
     def link_ticket(self, ticketnum):
+        return self.ticket_cache.get(ticketnum, self.lookup_ticket)
+
+    def link_tickets(self, ticketnums):
+        """
+        Return a Deferred firing with the link texts for all the given
+        tickets, in the same order. Tickets that aren't cached are fetched
+        in batches of up to max_batch_size per API call.
+        """
+
+        ticketnums = list(ticketnums)
+        batches = [self.ticket_cache.get_many(ticketnums[i:i+self.max_batch_size], self.lookup_tickets)
+                   for i in range(0, len(ticketnums), self.max_batch_size)]
+        d = defer.gatherResults(batches, consumeErrors=True)
+        d.addCallback(lambda results: listconcat(results))
+        return d
+
+    @defer.inlineCallbacks
+    def lookup_ticket(self, ticketnum):
+        """
+        Fetch the ticket and fire with a (link text, ttl) pair for the
+        ticket cache. Tickets JIRA says don't exist are cached for the
+        shorter cache_negative_ttl; other failures aren't cached at all.
+        """
+
         ticket_url = self.make_link(ticketnum)
-        for attempt in range(self.num_api_tries):
-            try:
-                ticketdata = yield self.fetch_ticket_info(ticketnum)
-            except NotAuthenticatedError:
-                log.msg("(Not fetching JIRA ticket data; not authenticated)")
-                break
-            except web_error.Error, e:
-                log.err(None, "JIRA API problem [try %d]\n--------\n%s\n--------\n" % (attempt + 1, e.response))
-                yield self.jira_soap_proxy_auth()
-            except error.ConnectError, e:
-                log.err(None, "JIRA connection error [try %d]\n--------\n%s\n--------\n" % (attempt + 1, e))
-            except Exception, e:
-                log.err(None, "Unexpected error fetching JIRA ticket data.")
-                break
+        try:
+            ticketdata = yield self.call_with_retries(self.fetch_ticket_info, ticketnum)
+        except TicketNotFoundError:
+            defer.returnValue((ticket_url, self.cache_negative_ttl))
+        if ticketdata is None:
+            defer.returnValue((ticket_url, None))
+        defer.returnValue(('%s : %s' % (ticket_url, ticketdata.summary), self.cache_ttl))
+
+    @defer.inlineCallbacks
+    def lookup_tickets(self, ticketnums):
+        """
+        Fetch several tickets with one JQL search, firing with a dict of
+        ticketnum -> (link text, ttl) like lookup_ticket gives. JIRA rejects
+        the whole search if any of the keys doesn't exist, so in that case
+        fall back to looking them up one by one.
+        """
+
+        if len(ticketnums) == 1:
+            result = yield self.lookup_ticket(ticketnums[0])
+            defer.returnValue({ticketnums[0]: result})
+        try:
+            issues = yield self.call_with_retries(self.fetch_tickets_info, ticketnums)
+        except TicketNotFoundError:
+            results = yield defer.gatherResults(map(self.lookup_ticket, ticketnums))
+            defer.returnValue(dict(zip(ticketnums, results)))
+        summaries = {}
+        for issue in issues or ():
+            summaries[str(issue.key)] = issue.summary
+        results = {}
+        for tnum in ticketnums:
+            ticket_url = self.make_link(tnum)
+            summary = summaries.get(self.make_key(tnum))
+            if summary is not None:
+                results[tnum] = ('%s : %s' % (ticket_url, summary), self.cache_ttl)
+            elif issues is not None:
+                results[tnum] = (ticket_url, self.cache_negative_ttl)
             else:
-                defer.returnValue('%s : %s' % (ticket_url, ticketdata.summary))
-        defer.returnValue(ticket_url)
+                results[tnum] = (ticket_url, None)
+        defer.returnValue(results)
 
     def reply_to_text(self, message, outputcb):
-        ticketnums = weed_duplicates(self.find_ticket_references(message))
-        return defer.DeferredList([self.link_ticket(tnum).addCallback(outputcb) for tnum in ticketnums])
+        return self.reply_to_tickets(self.find_ticket_references(message), outputcb)
+
+    @defer.inlineCallbacks
+    def reply_to_tickets(self, ticketnums, outputcb):
+        links = yield self.link_tickets(weed_duplicates(ticketnums))
+        for link in links:
+            yield outputcb(link)
+
+class TicketScanner:
+    """
+    Finds ticket references for a whole set of JiraInstances in one pass
+    over a message, instead of running each instance's shortcode_re and
+    projectname_re separately. Every distinct project key and shortcode
+    gets a named group in a combined regex; the name of the group that
+    matched says which instances the ticket belongs to.
+    """
+
+    # what may precede a ticket reference; same as in JiraInstance
+    lead_chars = r'''[[\s({<>:",@*'~]'''
+
+    # python's re module can't cope with more than 100 named groups in one
+    # pattern, so very large sets of instances get split across several
+    max_groups = 90
+
+    def __init__(self, instances=()):
+        self.routes = {}
+        alternatives = []
+        keys = {}
+        for inst in instances:
+            refs = [('p', inst.projectname + '-')]
+            if inst.shortcode is not None:
+                refs.append(('s', inst.shortcode))
+            for kind, literal in refs:
+                gname = keys.get((kind, literal))
+                if gname is None:
+                    gname = keys[kind, literal] = 'g%d' % len(keys)
+                    alternatives.append(r'%s(?P<%s>\d+)\b' % (re.escape(literal), gname))
+                    self.routes[gname] = []
+                self.routes[gname].append((inst, kind == 's'))
+        self.regexes = []
+        for i in range(0, len(alternatives), self.max_groups):
+            self.regexes.append(re.compile(r'(?:^|(?<=%s))(?:%s)'
+                                           % (self.lead_chars,
+                                              '|'.join(alternatives[i:i+self.max_groups]))))
+
+    def scan(self, message):
+        """
+        Return a list of (instance, [ticketnum, ...]) pairs for the instances
+        referenced in message, in order of first reference. Short references
+        below an instance's min_ticket are dropped.
+        """
+
+        found = {}
+        order = []
+        for regex in self.regexes:
+            for m in regex.finditer(message):
+                num = int(m.group(m.lastgroup))
+                for inst, is_short in self.routes[m.lastgroup]:
+                    if is_short and num < inst.min_ticket:
+                        continue
+                    nums = found.get(inst)
+                    if nums is None:
+                        nums = found[inst] = []
+                        order.append(inst)
+                    nums.append(num)
+        return [(inst, found[inst]) for inst in order]
 
 class JiraIntegration(BaseBotPlugin):
     def __init__(self):
         BaseBotPlugin.__init__(self)
         self.jira_instances = []
-        self.link_ignore_list = []
+        self.link_ignore_list = MaskSet()
+        self.scanner = TicketScanner()
 
     def loadState(self, state):
-        self.link_ignore_list = state.get('link_ignore_list', [])
+        self.link_ignore_list = MaskSet(state.get('link_ignore_list', ()))
         instance_data = state.get('jira_instances', [])
         self.jira_instances = map(JiraInstance.from_save_data, instance_data)
+        self.scanner = TicketScanner(self.jira_instances)
 
     def saveState(self):
         return {
-            'link_ignore_list': self.link_ignore_list,
+            'link_ignore_list': list(self.link_ignore_list),
             'jira_instances': [j.to_save_data() for j in self.jira_instances],
         }
 
+    def replayJournal(self, record):
+        if record[0] == 'add_jira':
+            self.jira_instances.append(JiraInstance.from_save_data(record[1]))
+            self.scanner = TicketScanner(self.jira_instances)
+        elif record[0] == 'set_cache':
+            projectname, setting, value = record[1:]
+            for j in self.jira_instances:
+                if j.projectname == projectname:
+                    self.set_cache_param(j, setting, value)
+
+    def set_cache_param(self, j, setting, value):
+        if setting == 'ttl':
+            j.cache_ttl = value
+        else:
+            j.cache_size = value
+            j.ticket_cache.resize(value)
+
     def respond(self, msg, outputcb):
-        return defer.DeferredList([j.reply_to_text(msg, outputcb) for j in self.jira_instances])
+        d = defer.DeferredList([j.reply_to_tickets(nums, outputcb)
+                                for (j, nums) in self.scanner.scan(msg)],
+                               consumeErrors=True)
+        def log_failures(results):
+            for success, result in results:
+                if not success:
+                    log.err(result, 'Looking up JIRA tickets')
+        return d.addCallback(log_failures)
 
     def privmsg(self, bot, user, channel, msg):
-        for m in self.link_ignore_list:
-            if mask_matches(m, user):
-                return
+        if self.link_ignore_list.matches(user):
+            return
         return self.respond(msg, lambda r: bot.address_msg(user, channel, r, prefix=False))
 
     def action(self, bot, user, channel, msg):
-        for m in self.link_ignore_list:
-            if mask_matches(m, user):
-                return
+        if self.link_ignore_list.matches(user):
+            return
         return self.respond(msg, lambda r: bot.address_msg(user, channel, r, prefix=False))
 
     @require_priv('admin')
@@ -166,7 +525,10 @@ class JiraIntegration(BaseBotPlugin):
         else:
             yield bot.address_msg(user, channel, 'usage: add-jira <base_url> <projectname> [<shortcode> [<username> <password>]] [min=<N>]')
             return
-        self.jira_instances.append(JiraInstance(base_url, projectname, shortcode, username, password, min_ticket=tmin))
+        j = JiraInstance(base_url, projectname, shortcode, username, password, min_ticket=tmin)
+        self.jira_instances.append(j)
+        self.scanner = TicketScanner(self.jira_instances)
+        bot.service.journal_plugin_change(self, ('add_jira', j.to_save_data()))
 
     @require_priv('admin')
     @defer.inlineCallbacks
@@ -176,3 +538,34 @@ class JiraIntegration(BaseBotPlugin):
             return
         for j in self.jira_instances:
             yield bot.address_msg(user, channel, '%s: base_url=%r, shortcode=%r' % (j.projectname, j.base_url, j.shortcode))
+
+    @require_priv('admin')
+    def command_jira_cache(self, bot, user, channel, args):
+        usage = 'usage: jira-cache stats | jira-cache flush [<projectname>] | ' \
+                'jira-cache set <projectname> ttl|size <N>'
+        if not args or args[0] not in ('stats', 'flush', 'set'):
+            return bot.address_msg(user, channel, usage)
+        if args[0] == 'set':
+            if len(args) != 4 or args[2] not in ('ttl', 'size') or not args[3].isdigit():
+                return bot.address_msg(user, channel, usage)
+            instances = [j for j in self.jira_instances if j.projectname == args[1]]
+        else:
+            instances = [j for j in self.jira_instances if j.projectname in args[1:] or len(args) == 1]
+        if not instances:
+            return bot.address_msg(user, channel, 'No matching JIRA instances.')
+        lines = []
+        for j in instances:
+            if args[0] == 'flush':
+                j.ticket_cache.flush()
+                lines.append('%s: flushed.' % j.projectname)
+            elif args[0] == 'set':
+                self.set_cache_param(j, args[2], int(args[3]))
+                bot.service.journal_plugin_change(self, ('set_cache', j.projectname, args[2],
+                                                         int(args[3])))
+                lines.append('%s: cache %s set to %s.' % (j.projectname, args[2], args[3]))
+            else:
+                s = j.ticket_cache.stats()
+                lines.append('%s: %d/%d cached (ttl %ds), %d in flight; %d hits, %d misses, '
+                             '%d coalesced' % (j.projectname, s['size'], s['maxsize'], j.cache_ttl,
+                                               s['inflight'], s['hits'], s['misses'], s['coalesced']))
+        return bot.address_msg(user, channel, '\n'.join(lines))
@@ -1,8 +1,9 @@
 import re
+import time
+import sre_parse
+import sre_constants
 from string import Template
-from itertools import chain
-from twisted.internet import defer
-from cassbot import BaseBotPlugin, mask_matches
+from cassbot import BaseBotPlugin, MaskSet, require_priv
 
 def weed_duplicates(elements):
     already = set()
@@ -11,44 +12,207 @@ def weed_duplicates(elements):
             already.add(e)
             yield e
 
+def required_literal(pattern):
+    """
+    Find the longest run of plain characters that every match of the given
+    regex source must contain, or None if there isn't an obvious one.
+    Only looks at the top level of the pattern (and inside plain groups),
+    which is enough for the kind of rules people actually write.
+    """
+
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (sre_constants.error, TypeError):
+        return None
+    if parsed.pattern.flags & sre_constants.SRE_FLAG_IGNORECASE:
+        return None
+
+    best = []
+    run = []
+    def walk(items):
+        for op, av in items:
+            if op == sre_constants.LITERAL and av < 128:
+                run.append(chr(av))
+                continue
+            if op == sre_constants.SUBPATTERN:
+                walk(av[1])
+                continue
+            if len(run) > len(best):
+                best[:] = run
+            del run[:]
+    walk(parsed)
+    if len(run) > len(best):
+        best = run
+    return ''.join(best) or None
+
+
+class ResponseRule:
+    def __init__(self, pattern, response):
+        self.regex = re.compile(pattern)
+        self.response = response
+        self.template = Template(response)
+        self.literal = required_literal(pattern)
+        self.checks = 0
+        self.matches = 0
+        self.elapsed = 0.0
+
+    def apply(self, msg):
+        start = time.time()
+        results = [self.template.safe_substitute(m.groupdict())
+                   for m in self.regex.finditer(msg)]
+        self.elapsed += time.time() - start
+        self.checks += 1
+        self.matches += len(results)
+        return results
+
+
+class RuleEngine:
+    """
+    Applies a list of ResponseRules to messages without running every rule
+    on every message. Each rule's required literal (if it has one) goes into
+    a single prefilter regex; one pass of that over a message tells which
+    literals are present, and only the rules whose literal was seen (plus
+    those with no literal at all) get their full pattern run.
+
+    The rule list and everything compiled from it are swapped in together
+    as one tuple, and never changed in place.
+    """
+
+    def __init__(self, rules=()):
+        self.compile(list(rules))
+
+    @property
+    def rules(self):
+        return self.compiled[0]
+
+    def compile(self, rules):
+        always = []
+        by_literal = {}
+        for index, rule in enumerate(rules):
+            if rule.literal is None:
+                always.append(index)
+            else:
+                by_literal.setdefault(rule.literal, []).append(index)
+
+        # at any position, the lookahead picks the longest literal that
+        # starts there; every shorter literal starting there is a prefix of
+        # that one, so remember those too
+        literals = sorted(by_literal, key=len, reverse=True)
+        implied = dict((lit, [l for l in literals if lit.startswith(l)])
+                       for lit in literals)
+        prefilter = None
+        if literals:
+            prefilter = re.compile('(?=(%s))' % '|'.join(map(re.escape, literals)))
+        self.compiled = (rules, always, by_literal, implied, prefilter)
+
+    def add_rule(self, rule):
+        self.compile(self.rules + [rule])
+
+    def remove_rules(self, pattern):
+        """
+        Remove every rule with the given regex source; return how many.
+        """
+
+        before = self.rules
+        self.compile([r for r in before if r.regex.pattern != pattern])
+        return len(before) - len(self.rules)
+
+    def candidates(self, msg, compiled=None):
+        rules, always, by_literal, implied, prefilter = compiled or self.compiled
+        if prefilter is None:
+            return always
+        seen = set()
+        for m in prefilter.finditer(msg):
+            seen.update(implied[m.group(1)])
+        if not seen:
+            return always
+        indices = set(always)
+        for lit in seen:
+            indices.update(by_literal[lit])
+        return sorted(indices)
+
+    def apply(self, msg):
+        compiled = self.compiled
+        rules = compiled[0]
+        responses = []
+        for index in self.candidates(msg, compiled):
+            responses.extend(rules[index].apply(msg))
+        return responses
+
+
 class RegexResponder(BaseBotPlugin):
     def __init__(self):
         BaseBotPlugin.__init__(self)
-        self.response_rules = []
-        self.link_ignore_list = []
+        self.rules = RuleEngine()
+        self.link_ignore_list = MaskSet()
 
     def loadState(self, state):
-        self.link_ignore_list = state.get('link_ignore_list', [])
+        self.link_ignore_list = MaskSet(state.get('link_ignore_list', ()))
         newrules = state.get('response_rules', [])
-        self.response_rules = [(re.compile(r), sub) for (r, sub) in newrules]
+        self.rules = RuleEngine(ResponseRule(r, sub) for (r, sub) in newrules)
 
     def saveState(self):
         return {
-            'link_ignore_list': self.link_ignore_list,
-            'response_rules': [(r.pattern, sub) for (r, sub) in self.response_rules],
+            'link_ignore_list': list(self.link_ignore_list),
+            'response_rules': [(r.regex.pattern, r.response) for r in self.rules.rules],
         }
 
-    def apply_rule(self, msg, pat, response):
-        for m in pat.finditer(msg):
-            yield Template(response).safe_substitute(m.groupdict())
+    def replayJournal(self, record):
+        if record[0] == 'add_response':
+            self.rules.add_rule(ResponseRule(record[1], record[2]))
+        elif record[0] == 'remove_response':
+            self.rules.remove_rules(record[1])
 
     def apply_all_rules(self, msg):
-        return chain(*[self.apply_rule(msg, pat, r) for (pat, r) in self.response_rules])
+        return self.rules.apply(msg)
 
-    @defer.inlineCallbacks
-    def respond(self, msg, outputcb):
-        responses = self.apply_all_rules(msg)
-        for response in weed_duplicates(responses):
-            yield outputcb(response)
+    # not @off_reactor: matching is cheap with the prefilter, and replies
+    # (and the hooks after this one) shouldn't wait on a thread
+    def respond(self, bot, user, channel, msg):
+        for response in weed_duplicates(self.apply_all_rules(msg)):
+            bot.address_msg(user, channel, response, prefix=False)
 
     def privmsg(self, bot, user, channel, msg):
-        for m in self.link_ignore_list:
-            if mask_matches(m, user):
-                return
-        return self.respond(msg, lambda r: bot.address_msg(user, channel, r, prefix=False))
+        if self.link_ignore_list.matches(user):
+            return
+        self.respond(bot, user, channel, msg)
 
     def action(self, bot, user, channel, msg):
-        for m in self.link_ignore_list:
-            if mask_matches(m, user):
-                return
-        return self.respond(msg, lambda r: bot.address_msg(user, channel, r, prefix=False))
+        if self.link_ignore_list.matches(user):
+            return
+        self.respond(bot, user, channel, msg)
+
+    @require_priv('admin')
+    def command_rule_stats(self, bot, user, channel, args):
+        if len(args) > 1 or (args and not args[0].isdigit()):
+            return bot.address_msg(user, channel, 'usage: rule-stats [<count>]')
+        count = int(args[0]) if args else 10
+        rules = sorted(self.rules.rules, key=lambda r: r.elapsed, reverse=True)[:count]
+        if not rules:
+            return bot.address_msg(user, channel, 'No response rules loaded.')
+        lines = ['%r: %d matches in %d checks, %.1fms' % (r.regex.pattern, r.matches,
+                                                          r.checks, r.elapsed * 1000)
+                 for r in rules]
+        return bot.address_msg(user, channel, '\n'.join(lines))
+
+    @require_priv('admin')
+    def command_add_response(self, bot, user, channel, args):
+        if len(args) != 2:
+            return bot.address_msg(user, channel, 'usage: add-response <regex> <response>')
+        try:
+            rule = ResponseRule(args[0], args[1])
+        except re.error, e:
+            return bot.address_msg(user, channel, 'Bad regex %r: %s' % (args[0], e))
+        self.rules.add_rule(rule)
+        bot.service.journal_plugin_change(self, ('add_response', args[0], args[1]))
+        return bot.address_msg(user, channel, 'kay.')
+
+    @require_priv('admin')
+    def command_remove_response(self, bot, user, channel, args):
+        if len(args) != 1:
+            return bot.address_msg(user, channel, 'usage: remove-response <regex>')
+        removed = self.rules.remove_rules(args[0])
+        if not removed:
+            return bot.address_msg(user, channel, 'No response rule for %r.' % args[0])
+        bot.service.journal_plugin_change(self, ('remove_response', args[0]))
+        return bot.address_msg(user, channel, 'Removed %d response rule(s).' % removed)
@@ -0,0 +1,402 @@
+# full-text index over the channel logs in a logstore.LogStore
+#
+# Each channel's index is a handful of immutable run files plus the
+# postings added since the last one was written, kept in memory. A run is:
+#
+#   header   magic, term count, and where the sections below start
+#   postings for each term in turn: (position, timestamp) records, sorted
+#            by position; a position is segment id << 32 | line offset
+#   terms    all the terms, sorted, back to back
+#   table    per term: (term offset, term length, postings offset, count)
+#
+# Runs are memory-mapped and searched in place. New runs are written every
+# so often; once merge_factor runs of about the same size pile up at the
+# end of the list, they are merged into one, so there are only ever a few
+# runs per size tier. Runs cover consecutive ranges of positions, so a
+# merge just concatenates each term's postings in run order.
+
+from __future__ import with_statement
+
+import os
+import re
+import mmap
+import heapq
+import struct
+from bisect import bisect_left
+from itertools import imap
+from twisted.internet import defer
+from twisted.python import log
+
+HEADER = struct.Struct('<4sIIII')
+TERM_ENTRY = struct.Struct('<IIII')
+POSTING = struct.Struct('<QI')
+MAGIC = 'CBX1'
+
+run_name = re.compile(r'^run-(\d{8})-(\d{8})\.idx$')
+
+word = re.compile(r'\w+', re.UNICODE)
+
+# the longest word worth indexing, in characters
+MAX_TERM = 40
+
+def terms_for(text):
+    """
+    Split text into the lowercased words to index it (or look it up) by.
+    """
+
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return set(w.encode('utf-8') for w in word.findall(text.lower())
+               if 1 < len(w) <= MAX_TERM)
+
+def nick_term(nick):
+    # can't collide with a word; those never contain '@'
+    return '@' + nick.lower()
+
+USER_PREFIX = '!'
+
+def user_term(user):
+    """
+    The term for lines said by the given nick!user@host, as it was at the
+    time, so they can be found again by mask (see LogIndex.terms_with_prefix).
+    """
+
+    return USER_PREFIX + user
+
+def make_position(seg_id, offset):
+    return seg_id << 32 | offset
+
+def split_position(pos):
+    return pos >> 32, pos & 0xffffffff
+
+
+class Postings:
+    """
+    The postings for one term in one run, read straight out of the mmap.
+    Indexing gives positions, so bisect works on it.
+    """
+
+    def __init__(self, data, start, count):
+        self.data = data
+        self.start = start
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, n):
+        if not 0 <= n < self.count:
+            raise IndexError(n)
+        return POSTING.unpack_from(self.data, self.start + n * POSTING.size)[0]
+
+    def timestamp(self, n):
+        return POSTING.unpack_from(self.data, self.start + n * POSTING.size)[1]
+
+
+class MemoryPostings:
+    """
+    Postings for one term which haven't been written to a run yet.
+    """
+
+    def __init__(self):
+        self.positions = []
+        self.timestamps = []
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, n):
+        return self.positions[n]
+
+    def timestamp(self, n):
+        return self.timestamps[n]
+
+
+class Run:
+    def __init__(self, path, first, last):
+        self.path = path
+        self.first = first
+        self.last = last
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.nterms, self.terms_at, self.table_at, self.count = \
+                HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not an index run' % path)
+
+    def term_at(self, n):
+        offset, length, post_at, count = TERM_ENTRY.unpack_from(
+                self.data, self.table_at + n * TERM_ENTRY.size)
+        start = self.terms_at + offset
+        return self.data[start:start + length], post_at, count
+
+    def find(self, term):
+        """
+        Return the number of the first term in the run not less than term.
+        """
+
+        lo, hi = 0, self.nterms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term_at(mid)[0] < term:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def lookup(self, term):
+        n = self.find(term)
+        if n < self.nterms:
+            found, post_at, count = self.term_at(n)
+            if found == term:
+                return Postings(self.data, post_at, count)
+        return None
+
+    def iterterms(self, first=0):
+        for n in xrange(first, self.nterms):
+            yield self.term_at(n)
+
+    def close(self):
+        self.data.close()
+
+
+def write_run(path, terms):
+    """
+    Write a run file from (term, postings bytes, count) triples, in term
+    order. The postings may be given as a list of byte strings, to be
+    written one after the other.
+    """
+
+    tmp = path + '.tmp'
+    table = []
+    blob = []
+    blob_size = 0
+    total = 0
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, 0, 0, 0, 0))
+        for term, chunks, count in terms:
+            table.append(TERM_ENTRY.pack(blob_size, len(term), f.tell(), count))
+            for chunk in chunks:
+                f.write(chunk)
+            blob.append(term)
+            blob_size += len(term)
+            total += count
+        terms_at = f.tell()
+        f.write(''.join(blob))
+        table_at = f.tell()
+        f.write(''.join(table))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(table), terms_at, table_at, total))
+    os.rename(tmp, path)
+
+def write_memory_run(path, postings):
+    def terms():
+        for term in sorted(postings):
+            p = postings[term]
+            yield term, [''.join(POSTING.pack(pos, ts)
+                                 for (pos, ts) in zip(p.positions, p.timestamps))], len(p)
+    write_run(path, terms())
+
+def merge_runs(path, runs):
+    """
+    Write one run holding everything in the given runs, which must be in
+    position order.
+    """
+
+    def keyed(n, run):
+        for term, post_at, count in run.iterterms():
+            yield (term, n), post_at, count
+    def terms():
+        merged = heapq.merge(*[keyed(n, run) for (n, run) in enumerate(runs)])
+        current = None
+        chunks = []
+        total = 0
+        for (term, n), post_at, count in merged:
+            if term != current:
+                if current is not None:
+                    yield current, chunks, total
+                current, chunks, total = term, [], 0
+            chunks.append(runs[n].data[post_at:post_at + count * POSTING.size])
+            total += count
+        if current is not None:
+            yield current, chunks, total
+    write_run(path, terms())
+
+
+class LogIndex:
+    """
+    The search index for one channel's logs, kept in dirname. New lines
+    are added with add(); they are searchable right away, and written out
+    as a run once flush_postings have piled up (or on flush()). Writing
+    and merging runs are done with run_job, as with LogStore, one job at a
+    time.
+    """
+
+    flush_postings = 20000
+    merge_factor = 4
+
+    def __init__(self, dirname, run_job=None):
+        self.dirname = dirname
+        self.run_job = run_job or defer.maybeDeferred
+        self.lock = defer.DeferredLock()
+        self.runs = []
+        self.memory = {}
+        self.memory_count = 0
+        # postings handed off to be written, oldest first
+        self.writing = []
+        self.next_seq = 0
+        self.load_runs()
+
+    def load_runs(self):
+        if not os.path.isdir(self.dirname):
+            os.makedirs(self.dirname)
+        found = []
+        for name in os.listdir(self.dirname):
+            m = run_name.match(name)
+            if m is not None:
+                found.append((int(m.group(1)), -int(m.group(2)), name))
+        # a merged run sorts before the ones it was merged from
+        found.sort()
+        for first, last, name in found:
+            last = -last
+            path = os.path.join(self.dirname, name)
+            if self.runs and first <= self.runs[-1].last:
+                # left over from a merge that was interrupted before
+                # cleaning up; the merged run covers it
+                os.remove(path)
+                continue
+            try:
+                self.runs.append(Run(path, first, last))
+            except (ValueError, EnvironmentError, mmap.error):
+                log.err(None, 'Loading index run %s' % path)
+            self.next_seq = last + 1
+
+    def add(self, position, timestamp, terms):
+        for term in terms:
+            p = self.memory.get(term)
+            if p is None:
+                p = self.memory[term] = MemoryPostings()
+            p.positions.append(position)
+            p.timestamps.append(int(timestamp))
+        self.memory_count += len(terms)
+        if self.memory_count >= self.flush_postings:
+            self.flush()
+
+    def flush(self):
+        """
+        Start writing the in-memory postings out as a new run. Returns a
+        Deferred which fires once it is written.
+        """
+
+        if not self.memory:
+            return defer.succeed(None)
+        postings = self.memory
+        self.writing.append(postings)
+        self.memory = {}
+        self.memory_count = 0
+        seq = self.next_seq
+        self.next_seq += 1
+        path = os.path.join(self.dirname, 'run-%08d-%08d.idx' % (seq, seq))
+        def written(result):
+            self.runs.append(Run(path, seq, seq))
+            self.writing.remove(postings)
+            self.maybe_merge()
+        d = self.lock.run(self.run_job, write_memory_run, path, postings)
+        d.addCallback(written)
+        d.addErrback(log.err, 'Writing index run %s' % path)
+        return d
+
+    def maybe_merge(self):
+        """
+        Merge the newest runs if there are merge_factor of them which are
+        no bigger than the smallest of them times merge_factor.
+        """
+
+        tail = self.runs[-self.merge_factor:]
+        if len(tail) < self.merge_factor or self.lock.locked:
+            return
+        smallest = min(r.count for r in tail)
+        if max(r.count for r in tail) > smallest * self.merge_factor:
+            return
+        path = os.path.join(self.dirname, 'run-%08d-%08d.idx' % (tail[0].first, tail[-1].last))
+        def merged(result):
+            new = Run(path, tail[0].first, tail[-1].last)
+            at = self.runs.index(tail[0])
+            self.runs[at:at + len(tail)] = [new]
+            for r in tail:
+                r.close()
+                os.remove(r.path)
+            self.maybe_merge()
+        d = self.lock.run(self.run_job, merge_runs, path, tail)
+        d.addCallback(merged)
+        d.addErrback(log.err, 'Merging index runs into %s' % path)
+        return d
+
+    def sources(self, term):
+        """
+        Return all the postings for a term, oldest first.
+        """
+
+        found = []
+        for r in self.runs:
+            p = r.lookup(term)
+            if p is not None:
+                found.append(p)
+        for postings in self.writing + [self.memory]:
+            p = postings.get(term)
+            if p is not None:
+                found.append(p)
+        return found
+
+    def terms_with_prefix(self, prefix):
+        """
+        Return the set of every term in the index starting with prefix.
+        """
+
+        found = set()
+        for r in self.runs:
+            for term, post_at, count in r.iterterms(r.find(prefix)):
+                if not term.startswith(prefix):
+                    break
+                found.add(term)
+        for postings in self.writing + [self.memory]:
+            found.update(t for t in postings if t.startswith(prefix))
+        return found
+
+    def search(self, terms, since=None, until=None, before=None):
+        """
+        Yield (position, timestamp) for each line containing all the given
+        terms, newest first, between the since and until timestamps, and
+        (if given) before the position before.
+        """
+
+        if not terms:
+            return
+        lists = sorted((self.sources(t) for t in terms), key=lambda s: sum(imap(len, s)))
+        rarest, others = lists[0], lists[1:]
+        for p in reversed(rarest):
+            last = len(p) if before is None else bisect_left(p, before)
+            for n in xrange(last - 1, -1, -1):
+                ts = p.timestamp(n)
+                if until is not None and ts > until:
+                    continue
+                if since is not None and ts < since:
+                    return
+                pos = p[n]
+                if all(contains(sources, pos) for sources in others):
+                    yield pos, ts
+
+    def close(self):
+        for r in self.runs:
+            r.close()
+        self.runs = []
+
+
+def contains(sources, pos):
+    for p in sources:
+        n = bisect_left(p, pos)
+        if n < len(p) and p[n] == pos:
+            return True
+    return False
+
+# vim: set et sw=4 ts=4 :
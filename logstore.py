@@ -0,0 +1,539 @@
+# on-disk storage for channel logs
+#
+# Each network/channel pair gets a directory of segments, one or more per
+# (UTC) day:
+#
+#   <basedir>/<network>/<channel>/<YYYY-MM-DD>.<part>.log   still being written
+#   <basedir>/<network>/<channel>/<YYYY-MM-DD>.<part>.logz  closed, compressed
+#   <basedir>/<network>/<channel>/<YYYY-MM-DD>.<part>.idx   index for the .log
+#   <basedir>/<network>/<channel>/<YYYY-MM-DD>.<part>.zidx  index for the .logz
+#
+# Lines are "<unix time>\t<text>\n". A segment is closed when its day ends
+# or when it grows past max_segment_bytes. Closing compresses it block by
+# block, each block being a separate zlib stream, so a block can be read
+# without decompressing anything before it. The index has one entry per
+# block: the time of its first line, and where it starts in the raw and
+# the stored (compressed) data.
+
+from __future__ import with_statement
+
+import os
+import re
+import time
+import calendar
+import zlib
+import struct
+import urllib
+from bisect import bisect_right
+from itertools import imap
+from twisted.internet import defer
+from twisted.python import log
+
+INDEX_ENTRY = struct.Struct('<dQQ')
+
+segment_name = re.compile(r'^(\d{4}-\d\d-\d\d)\.(\d+)\.(log|logz)$')
+
+# directory used for lines that don't belong to any one channel
+SERVER_LOG = '-server-'
+
+
+def day_of(timestamp):
+    return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+def segment_id(day, part):
+    """
+    A number for the segment, which sorts the same way segments do in time:
+    days since the epoch, times 1000, plus the part number.
+    """
+
+    return calendar.timegm(time.strptime(day, '%Y-%m-%d')) // 86400 * 1000 + part
+
+def segment_name_for(seg_id):
+    day = time.strftime('%Y-%m-%d', time.gmtime(seg_id // 1000 * 86400))
+    return '%s.%03d' % (day, seg_id % 1000)
+
+def safe_name(name):
+    """
+    Make a network or channel name usable as a single directory name.
+    """
+
+    if not name:
+        return SERVER_LOG
+    return urllib.quote(name.lower(), safe='#&+!-_.')
+
+def read_index(path):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return []
+    usable = len(data) - len(data) % INDEX_ENTRY.size
+    return [INDEX_ENTRY.unpack_from(data, pos) for pos in xrange(0, usable, INDEX_ENTRY.size)]
+
+def write_index(path, entries):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(''.join(INDEX_ENTRY.pack(*e) for e in entries))
+    os.rename(tmp, path)
+
+def read_stored_index(base):
+    """
+    Read the index of a compressed segment. Segments compressed by older
+    versions have it in the .idx file.
+    """
+
+    return read_index(base + '.zidx') or read_index(base + '.idx')
+
+def parse_line(line):
+    try:
+        ts, text = line.rstrip('\n').split('\t', 1)
+        return float(ts), text
+    except ValueError:
+        # a line cut short by a crash, most likely
+        return None
+
+def index_lines(path, block_size):
+    """
+    Rebuild the index for a raw segment by reading through it.
+    """
+
+    entries = []
+    offset = 0
+    block = block_size
+    with open(path, 'rb') as f:
+        for line in f:
+            if block >= block_size:
+                parsed = parse_line(line)
+                if parsed is not None:
+                    entries.append((parsed[0], offset, offset))
+                    block = 0
+            offset += len(line)
+            block += len(line)
+    return entries
+
+def compress_segment(base, index, level=6):
+    """
+    Compress the raw segment base + '.log' into base + '.logz', one zlib
+    stream per index block, with an index of the compressed offsets in
+    base + '.zidx', and remove the raw file and its index. The .zidx is in
+    place before the .logz is, so there is never a .logz without an index
+    to read it by, and the raw segment stays usable until it is removed.
+    """
+
+    raw, stored = base + '.log', base + '.logz'
+    entries = []
+    with open(raw, 'rb') as src:
+        with open(stored + '.tmp', 'wb') as dst:
+            for n, (ts, offset, _) in enumerate(index):
+                src.seek(offset)
+                if n + 1 < len(index):
+                    data = src.read(index[n + 1][1] - offset)
+                else:
+                    data = src.read()
+                entries.append((ts, offset, dst.tell()))
+                dst.write(zlib.compress(data, level))
+    write_index(base + '.zidx', entries)
+    os.rename(stored + '.tmp', stored)
+    remove_raw_segment(base)
+    return stored
+
+def remove_raw_segment(base):
+    for ext in ('.log', '.idx'):
+        try:
+            os.remove(base + ext)
+        except OSError:
+            pass
+
+
+class Segment:
+    """
+    A segment still being written. Lines are kept in memory until the
+    store flushes them; the file is only open while being written to.
+    """
+
+    def __init__(self, base, day, part):
+        self.base = base
+        self.day = day
+        self.part = part
+        self.id = segment_id(day, part)
+        self.size = 0
+        self.index = []
+        self.block = 0
+        self.pending = []
+        self.pending_index = []
+
+    def add(self, timestamp, text, block_size):
+        """
+        Buffer a line; return where it will start in the segment.
+        """
+
+        offset = self.size
+        line = '%.3f\t%s\n' % (timestamp, text.replace('\n', ' '))
+        if not self.index or self.block >= block_size:
+            entry = (timestamp, offset, offset)
+            self.index.append(entry)
+            self.pending_index.append(entry)
+            self.block = 0
+        self.pending.append(line)
+        self.size += len(line)
+        self.block += len(line)
+        return offset
+
+    def flush(self):
+        if not self.pending:
+            return
+        with open(self.base + '.log', 'ab') as f:
+            f.write(''.join(self.pending))
+        with open(self.base + '.idx', 'ab') as f:
+            f.write(''.join(INDEX_ENTRY.pack(*e) for e in self.pending_index))
+        self.pending = []
+        self.pending_index = []
+
+    def drop_pending(self):
+        """
+        Forget lines which couldn't be written, so that the size and index
+        match what is on disk again.
+        """
+
+        self.size -= sum(imap(len, self.pending))
+        self.index = [e for e in self.index if e[1] < self.size]
+        self.block = self.size - self.index[-1][1] if self.index else 0
+        self.pending = []
+        self.pending_index = []
+
+
+class LogStore:
+    """
+    Per-channel, per-day segmented log files. add() only buffers the line;
+    buffered lines are written out in batches, flush_delay seconds after
+    the first one, or as soon as flush_lines are waiting. Closed segments
+    are compressed with run_job, which should take (func, *args) and
+    return a Deferred (the bot passes its run_off_reactor, so compression
+    happens in a pool thread); by default it runs them right away.
+    """
+
+    flush_delay = 2.0
+    flush_lines = 512
+    max_segment_bytes = 16 * 1024 * 1024
+    block_size = 64 * 1024
+    compress_level = 6
+
+    def __init__(self, basedir, clock, run_job=None):
+        self.basedir = basedir
+        self.clock = clock
+        self.run_job = run_job or defer.maybeDeferred
+        # open segments, by (network, channel) directory
+        self.segments = {}
+        self.dirnames = {}
+        self.pending_lines = 0
+        self.flush_call = None
+        # Deferreds for segments being compressed, by base name
+        self.compressing = {}
+        # the last compressed block read by read_line: ((base, block), data)
+        self.block_cache = None
+
+    def channel_dir(self, network, channel):
+        try:
+            return self.dirnames[network, channel]
+        except KeyError:
+            d = self.dirnames[network, channel] = os.path.join(
+                    self.basedir, safe_name(network), safe_name(channel))
+            return d
+
+    def add(self, network, channel, text, timestamp=None):
+        """
+        Log a line of text for a channel (None for the network as a whole).
+        Return (segment id, offset), which read_line() can find it by.
+        """
+
+        if timestamp is None:
+            timestamp = self.clock.seconds()
+        dirname = self.channel_dir(network, channel)
+        seg = self.segments.get(dirname)
+        day = day_of(timestamp)
+        if seg is None:
+            seg = self.segments[dirname] = self.open_segment(dirname, day)
+        elif seg.day != day or seg.size >= self.max_segment_bytes:
+            self.close_segment(dirname)
+            seg = self.segments[dirname] = self.open_segment(dirname, day)
+        offset = seg.add(timestamp, text, self.block_size)
+        self.pending_lines += 1
+        if self.pending_lines >= self.flush_lines:
+            self.flush()
+        elif self.flush_call is None:
+            self.flush_call = self.clock.callLater(self.flush_delay, self.flush)
+        return seg.id, offset
+
+    def flush(self):
+        if self.flush_call is not None:
+            if self.flush_call.active():
+                self.flush_call.cancel()
+            self.flush_call = None
+        self.pending_lines = 0
+        for dirname, seg in self.segments.items():
+            try:
+                seg.flush()
+            except (IOError, OSError):
+                log.err(None, 'Writing log segment %s' % seg.base)
+                # don't keep piling up lines for a file that can't be written
+                seg.drop_pending()
+        self.close_finished_days()
+
+    def list_segments(self, dirname):
+        """
+        Return (day, part, extension) for each segment in a channel
+        directory, oldest first.
+        """
+
+        try:
+            names = os.listdir(dirname)
+        except OSError:
+            return []
+        found = []
+        for name in names:
+            m = segment_name.match(name)
+            if m is not None:
+                found.append((m.group(1), int(m.group(2)), m.group(3)))
+        found.sort()
+        return found
+
+    def open_segment(self, dirname, day):
+        """
+        Pick up today's raw segment for a channel where it was left off
+        (closing any older ones left behind, as after a crash), or start a
+        new one.
+        """
+
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        last_part = -1
+        resume = None
+        for segday, part, ext in self.list_segments(dirname):
+            base = os.path.join(dirname, '%s.%03d' % (segday, part))
+            if segday == day:
+                last_part = max(last_part, part)
+            if ext != 'log' or base in self.compressing:
+                continue
+            if os.path.exists(base + '.logz') and os.path.exists(base + '.zidx'):
+                # compressed, but not cleaned up after (a crash, most likely)
+                remove_raw_segment(base)
+                continue
+            if resume is not None:
+                self.compress(resume, index_lines(resume + '.log', self.block_size))
+            resume = base
+        if resume is not None:
+            size = os.path.getsize(resume + '.log')
+            if resume.endswith('%s.%03d' % (day, last_part)) and size < self.max_segment_bytes:
+                with open(resume + '.log', 'rb+') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != '\n':
+                        # finish off a line cut short by a crash
+                        f.write('\n')
+                        size += 1
+                seg = Segment(resume, day, last_part)
+                seg.size = size
+                seg.index = [e for e in read_index(resume + '.idx') if e[1] < size]
+                if not seg.index and size:
+                    seg.index = index_lines(resume + '.log', self.block_size)
+                    write_index(resume + '.idx', seg.index)
+                if seg.index:
+                    seg.block = size - seg.index[-1][1]
+                return seg
+            self.compress(resume, index_lines(resume + '.log', self.block_size))
+        part = last_part + 1
+        return Segment(os.path.join(dirname, '%s.%03d' % (day, part)), day, part)
+
+    def close_segment(self, dirname):
+        seg = self.segments.pop(dirname, None)
+        if seg is None:
+            return
+        seg.flush()
+        if seg.size:
+            self.compress(seg.base, seg.index)
+
+    def compress(self, base, index):
+        if not index:
+            # nothing usable in it
+            for ext in ('.log', '.idx'):
+                if os.path.exists(base + ext):
+                    os.remove(base + ext)
+            return
+        d = self.compressing[base] = self.run_job(compress_segment, base, index,
+                                                  self.compress_level)
+        def done(result):
+            self.compressing.pop(base, None)
+            return result
+        d.addBoth(done)
+        d.addErrback(log.err, 'Compressing log segment %s' % base)
+
+    def close_finished_days(self):
+        """
+        Close every open segment from an earlier day than today, so quiet
+        channels get their logs compressed too.
+        """
+
+        today = day_of(self.clock.seconds())
+        for dirname, seg in self.segments.items():
+            if seg.day < today:
+                self.close_segment(dirname)
+
+    def stop(self):
+        """
+        Write out everything buffered; return a Deferred which fires when
+        any compression in progress has finished. Open segments are left
+        raw, to be picked up again by the next open_segment.
+        """
+
+        self.flush()
+        self.segments = {}
+        return defer.DeferredList(self.compressing.values())
+
+    def read(self, network, channel, start=None, end=None):
+        """
+        Yield (timestamp, text) for the logged lines of a channel between
+        start and end (unix times; either may be None), oldest first.
+        """
+
+        dirname = self.channel_dir(network, channel)
+        seg = self.segments.get(dirname)
+        if seg is not None:
+            seg.flush()
+        first_day = day_of(start) if start is not None else None
+        last_day = day_of(end) if end is not None else None
+        for day, part, ext in self.list_segments(dirname):
+            if (first_day is not None and day < first_day) \
+                    or (last_day is not None and day > last_day):
+                continue
+            base = os.path.join(dirname, '%s.%03d' % (day, part))
+            if ext == 'log' and os.path.exists(base + '.logz'):
+                # compressed meanwhile; the .logz entry covers it
+                continue
+            for ts, text in self.read_segment(base, ext, start, end):
+                yield ts, text
+
+    def read_segment(self, base, ext, start=None, end=None):
+        if ext == 'log':
+            index = read_index(base + '.idx')
+        else:
+            index = read_stored_index(base)
+        if not index:
+            return
+        first = 0
+        if start is not None:
+            first = max(0, bisect_right([e[0] for e in index], start) - 1)
+        try:
+            f = open('%s.%s' % (base, ext), 'rb')
+        except IOError:
+            # compressed and removed since it was listed
+            if ext == 'log':
+                for item in self.read_segment(base, 'logz', start, end):
+                    yield item
+            return
+        with f:
+            if ext == 'log':
+                f.seek(index[first][1])
+                lines = iter(f)
+            else:
+                lines = self.iter_stored_lines(f, base, index, first)
+            for line in lines:
+                parsed = parse_line(line)
+                if parsed is None:
+                    continue
+                if start is not None and parsed[0] < start:
+                    continue
+                if end is not None and parsed[0] > end:
+                    return
+                yield parsed
+
+    def read_line(self, network, channel, seg_id, offset):
+        """
+        Return (timestamp, text) for the line logged at the given position
+        (as returned by add), or None if it can't be found.
+        """
+
+        dirname = self.channel_dir(network, channel)
+        seg = self.segments.get(dirname)
+        if seg is not None and seg.id == seg_id:
+            seg.flush()
+        return self.fetch_line(dirname, seg_id, offset)
+
+    def read_lines(self, network, channel, positions):
+        """
+        Look up a number of (segment id, offset) positions at once, as
+        read_line does, with run_job. Returns a Deferred which fires with
+        a list of the results, in the same order.
+        """
+
+        dirname = self.channel_dir(network, channel)
+        seg = self.segments.get(dirname)
+        if seg is not None:
+            seg.flush()
+        return self.run_job(self.fetch_lines, dirname, positions)
+
+    def fetch_lines(self, dirname, positions):
+        return [self.fetch_line(dirname, seg_id, offset) for (seg_id, offset) in positions]
+
+    def fetch_line(self, dirname, seg_id, offset):
+        base = os.path.join(dirname, segment_name_for(seg_id))
+        try:
+            with open(base + '.log', 'rb') as f:
+                f.seek(offset)
+                return parse_line(f.readline())
+        except IOError:
+            pass
+        index = read_stored_index(base)
+        n = bisect_right([e[1] for e in index], offset) - 1
+        if n < 0:
+            return None
+        key = (base, n)
+        cached = self.block_cache
+        if cached is None or cached[0] != key:
+            try:
+                with open(base + '.logz', 'rb') as f:
+                    data = self.iter_blocks(f, index, n, n + 1).next()
+            except (IOError, StopIteration, zlib.error):
+                return None
+            cached = self.block_cache = (key, data)
+        data = cached[1]
+        start = offset - index[n][1]
+        return parse_line(data[start:data.find('\n', start) + 1])
+
+    def iter_blocks(self, f, index, first, last=None):
+        for n in xrange(first, len(index) if last is None else last):
+            f.seek(index[n][2])
+            if n + 1 < len(index):
+                data = f.read(index[n + 1][2] - index[n][2])
+            else:
+                data = f.read()
+            yield zlib.decompress(data)
+
+    def iter_block_lines(self, f, index, first):
+        for data in self.iter_blocks(f, index, first):
+            for line in data.splitlines(True):
+                yield line
+
+    def iter_stored_lines(self, f, base, index, first):
+        """
+        Yield the lines of a compressed segment from block first on. If a
+        block won't decompress (as when a crash left an index which doesn't
+        go with the .logz), carry on from the raw file if it's still there.
+        """
+
+        seen = 0
+        try:
+            for line in self.iter_block_lines(f, index, first):
+                seen += 1
+                yield line
+        except zlib.error, e:
+            try:
+                raw = open(base + '.log', 'rb')
+            except IOError:
+                log.msg('Compressed log segment %s is unreadable: %s' % (base, e))
+                return
+            with raw:
+                raw.seek(index[first][1])
+                for n, line in enumerate(raw):
+                    if n >= seen:
+                        yield line
+
+# vim: set et sw=4 ts=4 :
@@ -0,0 +1,266 @@
+# counters, gauges and histograms for cassbot internals
+
+from bisect import bisect_left
+from twisted.web import resource
+
+
+class CounterValue(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class GaugeValue(object):
+    __slots__ = ('value', 'func')
+
+    def __init__(self):
+        self.value = 0
+        self.func = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, func):
+        """
+        Read the gauge's value by calling func() whenever it is collected,
+        instead of keeping it up to date.
+        """
+
+        self.func = func
+
+    def get(self):
+        if self.func is not None:
+            return self.func()
+        return self.value
+
+
+class HistogramValue(object):
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # one more than bounds, for values above the last one
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric(object):
+    """
+    A named metric, with one value per combination of label values. Look
+    up the value for a set of labels once with labels() and keep it, to
+    keep updates on hot paths down to an attribute increment. A metric
+    without labels can be updated directly.
+    """
+
+    kind = None
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        if not self.labelnames:
+            self.default = self.labels()
+
+    def make_value(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError('%s takes labels %r' % (self.name, self.labelnames))
+        try:
+            return self.children[values]
+        except KeyError:
+            child = self.children[values] = self.make_value()
+            return child
+
+    def label_text(self, values, extra=()):
+        pairs = zip(self.labelnames, values) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, escape_label(v)) for (k, v) in pairs)
+
+    def samples(self):
+        """
+        Yield (name suffix, label text, value) for each value to export.
+        """
+
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def make_value(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.default.value += amount
+
+    def samples(self):
+        for values, child in sorted(self.children.iteritems()):
+            yield '', self.label_text(values), child.value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def make_value(self):
+        return GaugeValue()
+
+    def set(self, value):
+        self.default.value = value
+
+    def set_function(self, func):
+        self.default.set_function(func)
+
+    def samples(self):
+        for values, child in sorted(self.children.iteritems()):
+            yield '', self.label_text(values), child.get()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    # seconds; suits anything from a hook call to an http request
+    default_buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+    def __init__(self, name, doc, labelnames=(), buckets=None):
+        self.bounds = tuple(sorted(buckets or self.default_buckets))
+        Metric.__init__(self, name, doc, labelnames)
+
+    def make_value(self):
+        return HistogramValue(self.bounds)
+
+    def observe(self, value):
+        self.default.observe(value)
+
+    def samples(self):
+        for values, child in sorted(self.children.iteritems()):
+            cumulative = 0
+            for bound, count in zip(self.bounds + ('+Inf',), child.counts):
+                cumulative += count
+                yield '_bucket', self.label_text(values, [('le', bound)]), cumulative
+            yield '_sum', self.label_text(values), child.sum
+            yield '_count', self.label_text(values), child.count
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Registry:
+    """
+    All the metrics in the process, by name. Asking for a metric that is
+    already registered returns the existing one (so reloading a module
+    which makes its metrics at import time doesn't lose their values), as
+    long as it is of the same kind.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def get_or_create(self, cls, name, doc, labelnames=(), **kw):
+        try:
+            metric = self.metrics[name]
+        except KeyError:
+            metric = self.metrics[name] = cls(name, doc, labelnames, **kw)
+            return metric
+        if not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+            raise ValueError('Metric %s is already registered differently' % name)
+        return metric
+
+    def counter(self, name, doc, labelnames=()):
+        return self.get_or_create(Counter, name, doc, labelnames)
+
+    def gauge(self, name, doc, labelnames=()):
+        return self.get_or_create(Gauge, name, doc, labelnames)
+
+    def histogram(self, name, doc, labelnames=(), buckets=None):
+        return self.get_or_create(Histogram, name, doc, labelnames, buckets=buckets)
+
+    def expose(self):
+        """
+        Return all metrics in the Prometheus text exposition format.
+        """
+
+        lines = []
+        for name, metric in sorted(self.metrics.iteritems()):
+            lines.append('# HELP %s %s' % (name, metric.doc))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+            for suffix, labels, value in metric.samples():
+                lines.append('%s%s%s %s' % (name, suffix, labels, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, prefix=''):
+        """
+        Return short human-readable lines for the metrics whose names start
+        with prefix: counter and gauge values, and histogram counts and
+        averages.
+        """
+
+        lines = []
+        for name, metric in sorted(self.metrics.iteritems()):
+            if not name.startswith(prefix):
+                continue
+            for values, child in sorted(metric.children.iteritems()):
+                label = metric.label_text(values)
+                if isinstance(child, HistogramValue):
+                    if child.count:
+                        lines.append('%s%s: %d, avg %.1fms'
+                                     % (name, label, child.count, child.sum / child.count * 1000))
+                else:
+                    value = child.get() if isinstance(child, GaugeValue) else child.value
+                    if value:
+                        lines.append('%s%s: %s' % (name, label, format_value(value)))
+        return lines
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class MetricsResource(resource.Resource):
+    """
+    Serves a registry's metrics at /metrics.
+    """
+
+    isLeaf = True
+
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        if request.postpath not in ([], [''], ['metrics']):
+            request.setResponseCode(404)
+            return 'not found\n'
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.registry.expose()
+
+
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+# vim: set et sw=4 ts=4 :
@@ -1,3 +1,5 @@
+from __future__ import with_statement
+
 import os
 import shlex
 from twisted.internet import reactor
@@ -23,15 +25,41 @@ else:
     bot = CassBotService(server, nickname=nickname, init_channels=channels,
                          statefile=statefile)
 
+# more networks, each configured by variables prefixed with its name
+auto_admins = {bot.primary.name: os.environ.get('auto_admin', os.environ['LOGNAME'])}
+for netname in shlex.split(os.environ.get('networks', '')):
+    def netconf(key, default=None):
+        return os.environ.get('%s_%s' % (netname, key), default)
+    netchannels = shlex.split(netconf('channels', ''))
+    if netconf('jid') is not None:
+        from xmppbot import XMPPNetwork
+        network = XMPPNetwork(bot, netname, netconf('jid'), netconf('password'),
+                              netconf('jabber_server'), netconf('conference_server'),
+                              nickname=netconf('nickname'), init_channels=netchannels)
+    else:
+        from cassbot import IRCNetwork
+        network = IRCNetwork(bot, netname, netconf('server'),
+                             nickname=netconf('nickname', nickname),
+                             init_channels=netchannels, cmd_prefix=netconf('cmd_prefix'))
+    bot.add_network(network)
+    # a nick is only anyone in particular on its own network
+    if netconf('auto_admin') is not None:
+        auto_admins[netname] = netconf('auto_admin')
+
+metrics_port = os.environ.get('metrics_port')
+if metrics_port:
+    bot.metrics_port = int(metrics_port)
+
 application = service.Application(nickname)
 bot.setServiceParent(application)
 
 def setup():
-    for modname in shlex.split(os.environ.get('autoload_modules', 'Admin')):
-        bot.enable_plugin_by_name(modname)
+    with bot.plugin_batch():
+        for modname in shlex.split(os.environ.get('autoload_modules', 'Admin')):
+            bot.enable_plugin_by_name(modname)
 
-    auto_admin = os.environ.get('auto_admin', os.environ['LOGNAME'])
-    bot.auth.addPriv(auto_admin, 'admin')
+    for netname, auto_admin in auto_admins.iteritems():
+        bot.networks[netname].auth.addPriv(auto_admin, 'admin')
 
     auto_manhole = os.environ.get('auto_manhole')
     if auto_manhole is not None:
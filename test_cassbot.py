@@ -0,0 +1,81 @@
+import threading
+from twisted.trial import unittest
+from twisted.internet import defer
+import cassbot
+
+
+class LineSink:
+    def __init__(self):
+        self.lines = []
+
+    def write(self, data):
+        self.lines.append(data)
+
+    def writeSequence(self, seq):
+        self.lines.extend(seq)
+
+    def loseConnection(self):
+        pass
+
+
+class BlockingPlugin(cassbot.BaseBotPlugin):
+    def __init__(self):
+        self.calls = []
+
+    @cassbot.off_reactor
+    def privmsg(self, bot, user, channel, msg):
+        self.calls.append(('blocking', threading.current_thread().name))
+        bot.address_msg(user, channel, 'seen %s' % msg)
+        return 'done with %s' % msg
+
+
+class PlainPlugin(cassbot.BaseBotPlugin):
+    def __init__(self, calls):
+        self.calls = calls
+
+    def privmsg(self, bot, user, channel, msg):
+        self.calls.append(('plain', threading.current_thread().name))
+
+
+class OffReactorTest(unittest.TestCase):
+    def setUp(self):
+        self.serv = cassbot.CassBotService('tcp:host=localhost:port=6667')
+        self.blocking = BlockingPlugin()
+        self.plain = PlainPlugin(self.blocking.calls)
+        plugins = [self.blocking, self.plain]
+        for p in plugins:
+            self.serv.pluginmap[p.name()] = p
+        self.serv.get_plugin_classes = lambda: [p.__class__ for p in plugins]
+        self.serv.scan_plugins()
+        self.bot = cassbot.CassBotCore(nickname='cassbot')
+        self.serv.initialize_proto_state(self.bot)
+        self.bot.makeConnection(LineSink())
+        del self.bot.transport.lines[:]
+
+    def tearDown(self):
+        self.serv.plugin_pool.stop()
+
+    @defer.inlineCallbacks
+    def test_result_comes_back_through_reactor(self):
+        reactor_thread = threading.current_thread().name
+        call = self.serv.hook_runner(self.blocking.privmsg)
+        d = call(self.bot, 'joe!joe@example.com', '#chan', 'hello')
+        self.assertIsInstance(d, defer.Deferred)
+        fired_in = []
+        d.addCallback(lambda r: fired_in.append(threading.current_thread().name) or r)
+        result = yield d
+        self.assertEqual(result, 'done with hello')
+        self.assertEqual(fired_in, [reactor_thread])
+        self.assertNotEqual(self.blocking.calls[0][1], reactor_thread)
+        self.assertEqual(self.bot.transport.lines, ['PRIVMSG #chan :joe: seen hello\r\n'])
+
+    @defer.inlineCallbacks
+    def test_dispatch_runs_only_marked_hooks_in_pool(self):
+        reactor_thread = threading.current_thread().name
+        yield self.bot.privmsg('joe!joe@example.com', '#chan', 'hello')
+        kinds = [kind for (kind, thread) in self.blocking.calls]
+        self.assertEqual(sorted(kinds), ['blocking', 'plain'])
+        self.assertEqual(dict(self.blocking.calls)['plain'], reactor_thread)
+        self.assertNotEqual(dict(self.blocking.calls)['blocking'], reactor_thread)
+
+# vim: set et sw=4 ts=4 :
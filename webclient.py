@@ -0,0 +1,217 @@
+# shared outbound http for cassbot plugins
+
+import random
+import time
+import urlparse
+from cStringIO import StringIO
+from twisted.internet import defer, error, task
+from twisted.python import log
+from twisted.web import client, error as web_error
+from twisted.web.http_headers import Headers
+import metrics
+
+request_seconds = metrics.histogram('cassbot_http_request_seconds',
+                                    'Outbound http request latency, by host', ('host',))
+request_outcomes = metrics.counter('cassbot_http_requests_total',
+                                   'Outbound http request attempts, by host and outcome',
+                                   ('host', 'outcome'))
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of making a request to a host that has failed too many
+    times in a row recently.
+    """
+
+
+class CircuitBreaker:
+    """
+    Tracks consecutive failures talking to one host. After threshold of
+    them, the circuit opens and requests fail immediately for reset_timeout
+    seconds; after that one request is let through to test the waters. If
+    it succeeds, the circuit closes again, otherwise it stays open for
+    another reset_timeout.
+    """
+
+    def __init__(self, host, clock, threshold=5, reset_timeout=60.0):
+        self.host = host
+        self.clock = clock
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    def check(self):
+        if self.opened_at is None:
+            return
+        now = self.clock.seconds()
+        if now - self.opened_at < self.reset_timeout:
+            raise CircuitOpenError('%s has failed %d times in a row; not trying again for '
+                                   '%d seconds' % (self.host, self.failures,
+                                                   self.opened_at + self.reset_timeout - now))
+        # half-open: let this one through, but hold off everyone else
+        self.opened_at = now
+
+    def succeeded(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failed(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                log.msg('Circuit to %s opened after %d failures' % (self.host, self.failures))
+            self.opened_at = self.clock.seconds()
+
+
+class OutboundHTTP:
+    """
+    Outbound http for everything in the bot: one Agent over a persistent
+    HTTPConnectionPool, so repeated calls to the same host reuse warm
+    connections. Redirects are followed, as client.getPage did. Adds per-host concurrency limits, request timeouts,
+    retries with exponential backoff and jitter for transient failures,
+    and a circuit breaker per host.
+    """
+
+    connect_timeout = 10
+    request_timeout = 30
+    max_per_host = 4
+    retries = 2
+    backoff_base = 0.5
+    backoff_max = 30.0
+    breaker_threshold = 5
+    breaker_reset = 60.0
+    redirect_limit = 20
+
+    # failures worth trying again after a pause
+    transient_errors = (error.ConnectError, error.DNSLookupError, error.TimeoutError,
+                        client.ResponseFailed)
+    transient_codes = (502, 503, 504)
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.pool = client.HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = self.max_per_host
+        self.agent = client.RedirectAgent(
+            client.Agent(reactor, connectTimeout=self.connect_timeout, pool=self.pool),
+            redirectLimit=self.redirect_limit)
+        self.host_limits = {}
+        self.breakers = {}
+
+    def limit_for(self, host):
+        try:
+            return self.host_limits[host]
+        except KeyError:
+            sem = self.host_limits[host] = defer.DeferredSemaphore(self.max_per_host)
+            return sem
+
+    def breaker_for(self, host):
+        try:
+            return self.breakers[host]
+        except KeyError:
+            b = self.breakers[host] = CircuitBreaker(host, self.reactor, self.breaker_threshold,
+                                                     self.breaker_reset)
+            return b
+
+    def backoff(self, attempt):
+        """
+        Return a Deferred which fires after a random delay of up to
+        backoff_base * 2**attempt seconds (capped at backoff_max).
+        """
+
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        return task.deferLater(self.reactor, delay, lambda: None)
+
+    @defer.inlineCallbacks
+    def request(self, method, url, body=None, headers=None, retries=None):
+        """
+        Make an http request and fire with the response body. Responses
+        with a status of 400 or more fail with twisted.web.error.Error, as
+        with client.getPage. Connection problems, timeouts and 502-504
+        responses are retried up to retries times.
+        """
+
+        if retries is None:
+            retries = self.retries
+        host = urlparse.urlsplit(url).netloc
+        breaker = self.breaker_for(host)
+        limit = self.limit_for(host)
+        for attempt in range(retries + 1):
+            breaker.check()
+            start = time.time()
+            try:
+                code, data = yield limit.run(self.request_once, method, url, body, headers)
+            except self.transient_errors:
+                request_outcomes.labels(host, 'error').inc()
+                breaker.failed()
+                if attempt == retries:
+                    raise
+            else:
+                request_seconds.labels(host).observe(time.time() - start)
+                request_outcomes.labels(host, str(code)).inc()
+                if code not in self.transient_codes:
+                    breaker.succeeded()
+                    if code >= 400:
+                        raise web_error.Error(str(code), response=data)
+                    defer.returnValue(data)
+                breaker.failed()
+                if attempt == retries:
+                    raise web_error.Error(str(code), response=data)
+            yield self.backoff(attempt)
+
+    def request_once(self, method, url, body, headers):
+        producer = None
+        if body is not None:
+            producer = client.FileBodyProducer(StringIO(body))
+        hdrs = Headers(dict((k, [v]) for (k, v) in (headers or {}).iteritems()))
+        d = self.agent.request(method, url, hdrs, producer)
+        d.addCallback(lambda resp: client.readBody(resp).addCallback(lambda data: (resp.code, data)))
+        d.addErrback(self.unwrap_redirect_failure)
+
+        timeout = self.reactor.callLater(self.request_timeout, d.cancel)
+        def finished(result):
+            if timeout.active():
+                timeout.cancel()
+                return result
+            raise error.TimeoutError(string='%s %s took longer than %ds'
+                                            % (method, url, self.request_timeout))
+        d.addBoth(finished)
+        return d
+
+    @staticmethod
+    def unwrap_redirect_failure(f):
+        """
+        RedirectAgent reports redirect loops and redirects it won't follow
+        as ResponseFailed, which would otherwise be retried as a transient
+        error. Raise the underlying twisted.web.error.Error instead.
+        """
+
+        f.trap(client.ResponseFailed)
+        for reason in f.value.reasons:
+            if reason.check(web_error.Error):
+                reason.raiseException()
+        return f
+
+    def close(self):
+        return self.pool.closeCachedConnections()
+
+
+_shared_clients = {}
+
+def shared_client(reactor=None):
+    """
+    Return the OutboundHTTP instance for the given reactor (or the global
+    one), creating it if necessary. CassBotService exposes this as its
+    http attribute; code without access to the service can use this
+    directly and still share its connection pool.
+    """
+
+    if reactor is None:
+        from twisted.internet import reactor
+    try:
+        return _shared_clients[reactor]
+    except KeyError:
+        c = _shared_clients[reactor] = OutboundHTTP(reactor)
+        return c
+
+# vim: set et sw=4 ts=4 :
@@ -18,11 +18,25 @@ class XMPPCassBotAdapter(cassbot.CassBotCore):
     room a user is in
     """
 
+    # xmpp messages can hold multiple lines and have no 512-byte limit
+    send_joiner = '\n'
+    send_max_line = None
+
     def join(self, channel, key=None):
         if key is not None:
             raise NotImplemented("can't use channel keys through xmpp client")
         return self.factory.join(channel)
 
+    def join_batch(self, channels):
+        for channel in channels:
+            self.join(channel)
+
+    def joined(self, channel):
+        cassbot.CassBotCore.joined(self, channel)
+        # a room's occupants have all been announced by the time the join
+        # completes; there's no separate names list to wait for
+        self.chanSynced(channel)
+
     def leave(self, channel, reason=None):
         self.join_channels.discard(channel)
         return self.factory.leave(channel)
@@ -81,9 +95,10 @@ class XMPPCassBot(muc.MUCClient):
     adapter_class = XMPPCassBotAdapter
     prot = None
 
-    def __init__(self, botservice, nickname='cassbot'):
+    def __init__(self, network, nickname='cassbot'):
         muc.MUCClient.__init__(self)
-        self.botservice = botservice
+        self.network = network
+        self.botservice = network.service
         self.nickname = nickname
 
     def my_jid(self):
@@ -93,9 +108,8 @@ class XMPPCassBot(muc.MUCClient):
         self.xmlstream.addObserver(muc.CHAT_BODY, self._onPrivateChat)
 
         prot = self.adapter_class(nickname=self.nickname.encode('utf-8'))
-        prot.service = self.botservice
         prot.factory = self
-        self.botservice.initialize_proto_state(prot)
+        self.network.initialize_proto_state(prot)
         prot.signedOn()
 
     def resetDelay(self):
@@ -203,19 +217,22 @@ class XMPPCassBot(muc.MUCClient):
             log.err(e, 'could not ping server')
 
 
-class XMPPCassBotService(cassbot.CassBotService):
+class XMPPNetwork(cassbot.IRCNetwork):
+    """
+    A connection to an XMPP server, with its MUC rooms standing in for
+    channels. Can be the primary network of an XMPPCassBotService, or added
+    to any CassBotService alongside IRC networks.
+    """
+
     xmppbot = None
 
-    def __init__(self, user_jid, password, jabber_server=None, conference_server=None,
-                 nickname=None, init_channels=(), statefile='cassbot.state.db',
-                 reactor=None):
+    def __init__(self, service, name, user_jid, password, jabber_server=None,
+                 conference_server=None, nickname=None, init_channels=()):
         self.jid = jid.internJID(user_jid)
         if nickname is None:
             nickname = self.jid.user
-
-        cassbot.CassBotService.__init__(self, self.jid.full(), nickname=nickname,
-                                        init_channels=init_channels, reactor=reactor,
-                                        statefile=statefile)
+        cassbot.IRCNetwork.__init__(self, service, name, self.jid.full(), nickname=nickname,
+                                    init_channels=init_channels)
 
         self.password = password
         if jabber_server is None:
@@ -225,30 +242,54 @@ class XMPPCassBotService(cassbot.CassBotService):
         self.jabber_server = jabber_server
         self.conference_server = conference_server
 
-    def setupConnectionParams(self, conffile):
-        self.endpoint_desc = 'conffile=%s' % (conffile,)
+    def setupConnectionParams(self, desc):
+        pass
 
-    def setupConnection(self):
+    def connect(self):
         xmppclient = XMPPClient(self.jid, self.password, self.jabber_server)
         xmppclient.logTraffic = False
 
-        xmppbot = XMPPCassBot(self, self.state['nickname'])
+        xmppbot = XMPPCassBot(self, self.get_state()['nickname'])
         xmppbot.conference_server = self.conference_server
         xmppbot.setHandlerParent(xmppclient)
 
-        xmppclient.setServiceParent(self)
+        xmppclient.setServiceParent(self.service)
 
         self.xmppbot = xmppbot
         self.xmppclient = xmppclient
 
-    def teardownConnection(self):
+    def disconnect(self):
         self.xmppclient.disownServiceParent()
         if self.xmppclient.running:
             self.xmppclient.stopService()
         self.xmppbot = None
 
     def getbot(self):
-        return self.xmppbot
+        if self.xmppbot is None:
+            return None
+        return self.xmppbot.prot
+
+
+class XMPPCassBotService(cassbot.CassBotService):
+    """
+    A CassBotService whose primary network is XMPP.
+    """
+
+    def __init__(self, user_jid, password, jabber_server=None, conference_server=None,
+                 nickname=None, init_channels=(), statefile='cassbot.state.db',
+                 reactor=None):
+        self.xmpp_params = (user_jid, password, jabber_server, conference_server)
+        if nickname is None:
+            nickname = jid.internJID(user_jid).user
+        cassbot.CassBotService.__init__(self, jid.internJID(user_jid).full(),
+                                        nickname=nickname, init_channels=init_channels,
+                                        reactor=reactor, statefile=statefile)
+
+    def setupConnectionParams(self, desc):
+        self.endpoint_desc = desc
+        self.primary = self.add_network(XMPPNetwork(self, cassbot.PRIMARY_NETWORK,
+                                                    *self.xmpp_params,
+                                                    nickname=self.state['nickname']))
 
 
 # vim: set et sw=4 ts=4 :